@@ -0,0 +1,476 @@
+"""
+Materialized analytics over the email graph, for the aggregate questions
+analysts ask most: how many (responsive) emails a person sent, received or
+was copied on, how many went from one person to another, how many were
+sent before or after a date, and who sent or received the most.
+
+ingest.py keeps a per-email table (timestamp, responsive flag, Person
+edges) up to date as it loads and saves it next to the manifest
+(ANALYTICS_PATH). The aggregates are derived from that table with NumPy:
+
+- role_counts: (persons, roles, 2) counts of all / responsive emails
+- pair keys and counts: sorted (sender, recipient, role) keys, so a pair
+  is one searchsorted away
+- sorted timestamps of sent (and sent responsive) emails, for date ranges
+
+`route` matches a question against a few fixed phrasings and answers it
+from those arrays, so the server needs neither Cypher generation nor a
+Neo4j round trip for it. Anything it doesn't recognize returns None and
+takes the normal path.
+"""
+import os
+import re
+import threading
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_PATH = os.getenv("ANALYTICS_PATH", "analytics.npz")
+ANALYTICS_FAST_PATH = os.getenv("ANALYTICS_FAST_PATH", "1") != "0"
+
+ROLES = ("SEND", "RECEIVE", "Cc", "Bcc")
+ROLE_INDEX = {role: i for i, role in enumerate(ROLES)}
+SEND = ROLE_INDEX["SEND"]
+NO_DATE = np.iinfo(np.int64).min
+
+
+def _timestamp(value):
+    """Seconds since the epoch for an ISO date string, NO_DATE if missing or unparsable."""
+    if not value:
+        return NO_DATE
+    try:
+        return int(np.datetime64(str(value).replace(" ", "T").rstrip("Z"), "s").astype(np.int64))
+    except ValueError:
+        return NO_DATE
+
+
+class EmailAnalytics:
+    """
+    The per-email table plus the aggregates derived from it. `upsert` and
+    `remove` change the table in place; the aggregates are recomputed
+    (vectorized, milliseconds for this dataset size) on the next query.
+    """
+
+    def __init__(self, topic=""):
+        self.topic = topic
+        self.email_ids = []
+        self._email_row = {}
+        self.timestamps = np.empty(0, dtype=np.int64)
+        self.responsive = np.empty(0, dtype=bool)
+        self.alive = np.empty(0, dtype=bool)
+        self.persons = []
+        self._person_row = {}
+        # Lowercased id -> row, for the lowercased questions `route` matches
+        self._lowered_row = {}
+        # Person edges, one row each: email row, person row, role; dead rows are replaced edges
+        self.edge_email = np.empty(0, dtype=np.int32)
+        self.edge_person = np.empty(0, dtype=np.int32)
+        self.edge_role = np.empty(0, dtype=np.int8)
+        self.edge_alive = np.empty(0, dtype=bool)
+        self._dirty = True
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    def _person(self, person):
+        row = self._person_row.get(person)
+        if row is None:
+            row = self._person_row[person] = len(self.persons)
+            self._lowered_row.setdefault(person.lower(), row)
+            self.persons.append(person)
+        return row
+
+    def person_id(self, person):
+        """The stored id of `person`, matched without regard to case; None if it isn't in the table."""
+        row = self._person_row.get(person)
+        if row is None:
+            row = self._lowered_row.get(person.lower())
+        return None if row is None else self.persons[row]
+
+    def upsert(self, items):
+        """Add or replace emails, given as parsed by ingest.parse_chunk."""
+        latest = {item["email"]["id"]: item for item in items}
+        if not latest:
+            return
+        rows, stamps, flags = [], [], []
+        edge_email, edge_person, edge_role = [], [], []
+        new_ids = []
+        for email_id, item in latest.items():
+            row = self._email_row.get(email_id)
+            if row is None:
+                row = self._email_row[email_id] = len(self.email_ids) + len(new_ids)
+                new_ids.append(email_id)
+            rows.append(row)
+            stamps.append(_timestamp(item["email"].get("date")))
+            flags.append(bool(item["responsive"]))
+            for rel_type, person in item["edges"]:
+                if rel_type in ROLE_INDEX:
+                    edge_email.append(row)
+                    edge_person.append(self._person(person))
+                    edge_role.append(ROLE_INDEX[rel_type])
+        with self._lock:
+            grow = len(new_ids)
+            self.email_ids.extend(new_ids)
+            self.timestamps = np.concatenate([self.timestamps, np.full(grow, NO_DATE, dtype=np.int64)])
+            self.responsive = np.concatenate([self.responsive, np.zeros(grow, dtype=bool)])
+            self.alive = np.concatenate([self.alive, np.zeros(grow, dtype=bool)])
+            rows = np.asarray(rows, dtype=np.int64)
+            self.timestamps[rows] = stamps
+            self.responsive[rows] = flags
+            self.alive[rows] = True
+            # An upserted email's edges are replaced by the ones just parsed
+            self.edge_alive &= ~np.isin(self.edge_email, rows)
+            self.edge_email = np.concatenate([self.edge_email, np.asarray(edge_email, dtype=np.int32)])
+            self.edge_person = np.concatenate([self.edge_person, np.asarray(edge_person, dtype=np.int32)])
+            self.edge_role = np.concatenate([self.edge_role, np.asarray(edge_role, dtype=np.int8)])
+            self.edge_alive = np.concatenate([self.edge_alive, np.ones(len(edge_email), dtype=bool)])
+            self._dirty = True
+
+    def remove(self, email_ids):
+        rows = [self._email_row[i] for i in email_ids if i in self._email_row]
+        if not rows:
+            return
+        with self._lock:
+            self.alive[rows] = False
+            self.edge_alive &= ~np.isin(self.edge_email, rows)
+            self._dirty = True
+
+    def compact(self):
+        """Drop removed emails and replaced edges (before saving)."""
+        with self._lock:
+            keep = self.edge_alive
+            self.edge_email, self.edge_person = self.edge_email[keep], self.edge_person[keep]
+            self.edge_role, self.edge_alive = self.edge_role[keep], self.edge_alive[keep]
+            if self.alive.all():
+                return
+            remap = np.cumsum(self.alive) - 1
+            self.edge_email = remap[self.edge_email].astype(np.int32)
+            self.email_ids = [i for i, alive in zip(self.email_ids, self.alive) if alive]
+            self._email_row = {email_id: row for row, email_id in enumerate(self.email_ids)}
+            self.timestamps, self.responsive = self.timestamps[self.alive], self.responsive[self.alive]
+            self.alive = np.ones(len(self.email_ids), dtype=bool)
+            self._dirty = True
+
+    def save(self, path=ANALYTICS_PATH):
+        self.compact()
+        tmp = path + ".tmp.npz"
+        np.savez_compressed(
+            tmp, topic=np.array(self.topic), email_ids=np.array(self.email_ids, dtype=str),
+            timestamps=self.timestamps, responsive=self.responsive, persons=np.array(self.persons, dtype=str),
+            edge_email=self.edge_email, edge_person=self.edge_person, edge_role=self.edge_role,
+        )
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path=ANALYTICS_PATH):
+        with np.load(path) as data:
+            analytics = cls(topic=str(data["topic"]))
+            analytics.email_ids = data["email_ids"].tolist()
+            analytics.timestamps = data["timestamps"]
+            analytics.responsive = data["responsive"]
+            analytics.persons = data["persons"].tolist()
+            analytics.edge_email = data["edge_email"]
+            analytics.edge_person = data["edge_person"]
+            analytics.edge_role = data["edge_role"]
+        analytics.alive = np.ones(len(analytics.email_ids), dtype=bool)
+        analytics.edge_alive = np.ones(len(analytics.edge_email), dtype=bool)
+        analytics._email_row = {email_id: row for row, email_id in enumerate(analytics.email_ids)}
+        analytics._person_row = {person: row for row, person in enumerate(analytics.persons)}
+        for row, person in enumerate(analytics.persons):
+            analytics._lowered_row.setdefault(person.lower(), row)
+        return analytics
+
+    @classmethod
+    def from_items(cls, items, topic=""):
+        analytics = cls(topic=topic)
+        analytics.upsert(items)
+        return analytics
+
+    def _refresh(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            keep = self.edge_alive & self.alive[self.edge_email]
+            email, person, role = self.edge_email[keep], self.edge_person[keep].astype(np.int64), self.edge_role[keep]
+            responsive = self.responsive[email]
+            n_persons, n_roles = len(self.persons), len(ROLES)
+
+            slots = (person * n_roles + role) * 2
+            counts = np.bincount(slots, minlength=n_persons * n_roles * 2)
+            counts += np.bincount(slots[responsive] + 1, minlength=n_persons * n_roles * 2)
+            self.role_counts = counts.reshape(n_persons, n_roles, 2)
+
+            sent = role == SEND
+            sender_of = np.full(len(self.email_ids), -1, dtype=np.int64)
+            sender_of[email[sent]] = person[sent]
+            self.sender_of = sender_of
+
+            to = ~sent & (sender_of[email] >= 0)
+            keys = (sender_of[email[to]] * n_persons + person[to]) * n_roles + role[to]
+            self.pair_keys, inverse = np.unique(keys, return_inverse=True)
+            self.pair_counts = np.stack([np.bincount(inverse, minlength=len(self.pair_keys)),
+                                         np.bincount(inverse[responsive[to]], minlength=len(self.pair_keys))], 1)
+
+            dated = self.alive & (self.timestamps != NO_DATE)
+            has_sender = sender_of >= 0
+            self.sent_times = np.sort(self.timestamps[dated & has_sender])
+            self.sent_responsive_times = np.sort(self.timestamps[dated & has_sender & self.responsive])
+            self._edge_view = (email, person, role)
+            self._dirty = False
+
+    # --- queries -------------------------------------------------------
+
+    def person_count(self, person, role="SEND", responsive=False, after=None, before=None, inclusive=False):
+        """Emails `person` has `role` on; optionally only responsive ones, or in a date range."""
+        self._refresh()
+        row = self._person_row.get(person)
+        if row is None:
+            return 0
+        if after is None and before is None:
+            return int(self.role_counts[row, ROLE_INDEX[role], int(responsive)])
+        email, person_col, role_col = self._edge_view
+        rows = email[(person_col == row) & (role_col == ROLE_INDEX[role])]
+        mask = self._in_range(self.timestamps[rows], after, before, inclusive)
+        if responsive:
+            mask &= self.responsive[rows]
+        return int(mask.sum())
+
+    def pair_count(self, sender, recipient, role="RECEIVE", responsive=False):
+        """Emails sent by `sender` with `recipient` on the To (or Cc/Bcc) line."""
+        self._refresh()
+        s, r = self._person_row.get(sender), self._person_row.get(recipient)
+        if s is None or r is None:
+            return 0
+        key = (s * len(self.persons) + r) * len(ROLES) + ROLE_INDEX[role]
+        i = np.searchsorted(self.pair_keys, key)
+        if i < len(self.pair_keys) and self.pair_keys[i] == key:
+            return int(self.pair_counts[i, int(responsive)])
+        return 0
+
+    def sent_count(self, after=None, before=None, responsive=False, inclusive=False):
+        """Emails with a sender whose date falls in the range."""
+        self._refresh()
+        times = self.sent_responsive_times if responsive else self.sent_times
+        lo = 0 if after is None else np.searchsorted(times, after, side="left" if inclusive else "right")
+        hi = len(times) if before is None else np.searchsorted(times, before, side="right" if inclusive else "left")
+        return max(0, int(hi - lo))
+
+    def top_persons(self, role="SEND", responsive=False, k=1):
+        """The `k` persons with the most emails in `role`, as (person, count), ties broken by id."""
+        self._refresh()
+        counts = self.role_counts[:, ROLE_INDEX[role], int(responsive)]
+        order = np.lexsort((np.array(self.persons, dtype=object), -counts))
+        return [(self.persons[i], int(counts[i])) for i in order[:k] if counts[i] > 0]
+
+    def monthly_histogram(self, responsive=False):
+        """{'YYYY-MM': emails sent that month}."""
+        self._refresh()
+        times = self.sent_responsive_times if responsive else self.sent_times
+        months, counts = np.unique(times.astype("datetime64[s]").astype("datetime64[M]"), return_counts=True)
+        return {str(month): int(count) for month, count in zip(months, counts)}
+
+    @staticmethod
+    def _in_range(times, after, before, inclusive):
+        mask = times != NO_DATE
+        if after is not None:
+            mask &= times >= after if inclusive else times > after
+        if before is not None:
+            mask &= times <= before if inclusive else times < before
+        return mask
+
+
+class AnalyticsStore:
+    """
+    Serves the analytics saved by ingest.py, reloading when the file
+    changes. `current()` is None until a file exists (or `set` is called),
+    in which case every question takes the normal path.
+    """
+
+    def __init__(self, path=ANALYTICS_PATH):
+        self.path = path
+        self.analytics = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def set(self, analytics):
+        """Serve analytics built elsewhere (e.g. straight from the CSV) instead of the file."""
+        self.analytics, self.path = analytics, None
+
+    def current(self):
+        if self.path is None:
+            return self.analytics
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return self.analytics
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    try:
+                        self.analytics = EmailAnalytics.load(self.path)
+                        logger.info("Analytics loaded: %d emails, %d persons from %s",
+                                    len(self.analytics), len(self.analytics.persons), self.path)
+                    except (OSError, ValueError, KeyError) as e:
+                        logger.warning("Analytics load failed: %s", e)
+                    self._mtime = mtime
+        return self.analytics
+
+
+# --- fast-path intent router -------------------------------------------
+
+ADDRESS = r"[\w.+'-]+@[\w-]+(?:\.[\w-]+)+"
+DATE = r"\d{4}-\d{2}-\d{2}(?:[t ]\d{2}:\d{2}(?::\d{2})?)?"
+_RESP = r"(?P<resp>responsive |relevant )?"
+
+
+def _topic(group):
+    return rf"(?P<{group}> (?:about|on|for|related to|responsive to|relevant to) topic (?P<{group}_name>\w+))?"
+
+
+_TOPIC, _TOPIC2 = _topic("topic"), _topic("topic2")
+_DATE = rf"(?: (?P<dir>after|before|since|until) (?P<date>{DATE}))?"
+_END = r"\s*[?.!]?"
+
+PERSON_VERBS = {
+    "send": "SEND", "sent": "SEND",
+    "receive": "RECEIVE", "received": "RECEIVE", "get": "RECEIVE", "got": "RECEIVE",
+}
+PASSIVE_ROLES = {("sent", "by"): "SEND", ("sent", "to"): "RECEIVE", ("received", "by"): "RECEIVE",
+                 ("cc", "to"): "Cc", ("bcc", "to"): "Bcc"}
+
+INTENTS = [
+    ("pair", re.compile(
+        rf"how many {_RESP}emails{_TOPIC} (?:did|has|have) (?P<a>{ADDRESS}) (?:send|sent) to (?P<b>{ADDRESS}){_TOPIC2}{_END}")),
+    ("person", re.compile(
+        rf"how many {_RESP}emails{_TOPIC} (?:did|has|have) (?P<a>{ADDRESS}) (?P<verb>send|sent|receive|received|get|got)"
+        rf"{_TOPIC2}{_DATE}{_END}")),
+    ("person_passive", re.compile(
+        rf"how many {_RESP}emails{_TOPIC} (?:were|was|have been|has been) (?P<verb>sent|received|(?:b?cc)(?:'d|ed|d)) "
+        rf"(?P<prep>by|to) (?P<a>{ADDRESS}){_DATE}{_END}")),
+    ("dated", re.compile(
+        rf"how many {_RESP}emails{_TOPIC} (?:were|was|have been|has been) sent (?P<dir>after|before|since|until) "
+        rf"(?P<date>{DATE}){_END}")),
+    ("top", re.compile(
+        rf"who (?P<verb>sent|received|got) the most {_RESP}emails{_TOPIC}{_END}")),
+]
+
+
+def _normalize(question, persons):
+    text = question.strip()
+    # Names the NER resolved become their addresses, so one pattern covers both
+    for name, person in sorted((persons or {}).items(), key=lambda item: -len(item[0])):
+        text = re.sub(re.escape(name), person, text, flags=re.IGNORECASE)
+    return re.sub(r"\s+", " ", text).lower()
+
+
+def _responsive(m, topic):
+    """Whether the question restricts to responsive emails; None if it names another topic."""
+    for group in ("topic_name", "topic2_name"):
+        name = m.groupdict().get(group)
+        if name and f"topic {name}" != topic.lower():
+            return None
+    return bool(m.groupdict().get("resp") or m.groupdict().get("topic") or m.groupdict().get("topic2"))
+
+
+def _range(m):
+    if not m.groupdict().get("dir"):
+        return None, None, False
+    stamp = _timestamp(m.group("date").upper())
+    if stamp == NO_DATE:
+        raise ValueError(m.group("date"))
+    direction = m.group("dir")
+    inclusive = direction in ("since", "until")
+    return (stamp, None, inclusive) if direction in ("after", "since") else (None, stamp, inclusive)
+
+
+def _cypher_range(m):
+    if not m.groupdict().get("dir"):
+        return ""
+    op = {"after": ">", "since": ">=", "before": "<", "until": "<="}[m.group("dir")]
+    return f" WHERE e.date_time {op} datetime('{m.group('date').upper()}')"
+
+
+def route(analytics, question, persons=None):
+    """
+    Answer `question` from `analytics` if it matches one of the INTENTS:
+    returns {'intent', 'cypher_query' (the equivalent query), 'results',
+    'natural_response'}, or None to take the normal path.
+    """
+    if analytics is None or not ANALYTICS_FAST_PATH:
+        return None
+    text = _normalize(question, persons)
+    for intent, rx in INTENTS:
+        m = rx.fullmatch(text)
+        if m is None:
+            continue
+        responsive = _responsive(m, analytics.topic)
+        if responsive is None:
+            return None
+        try:
+            after, before, inclusive = _range(m)
+        except ValueError:
+            return None
+        topic = f"-[:RESPONSIVE]->(:Topic {{name: '{analytics.topic}'}})" if responsive else ""
+        kind = "responsive emails" if responsive else "emails"
+        where = _cypher_range(m)
+
+        if intent == "pair":
+            a, b = analytics.person_id(m.group("a")), analytics.person_id(m.group("b"))
+            if a is None or b is None:
+                # Unknown to the table: let the Cypher path answer (or say who it doesn't know)
+                return None
+            count = analytics.pair_count(a, b, responsive=responsive)
+            cypher = (f"MATCH (sender:Person {{id: '{a}'}})-[:SEND]->(e:Email){topic} "
+                      f"MATCH (recipient:Person {{id: '{b}'}})-[:RECEIVE]->(e) RETURN count(e) AS email_count")
+            return _answer(intent, cypher, [{"email_count": count}], f"{a} sent {_emails(count, responsive)} to {b}.")
+
+        if intent in ("person", "person_passive"):
+            a = analytics.person_id(m.group("a"))
+            if a is None:
+                return None
+            verb = m.group("verb")
+            if intent == "person":
+                role = PERSON_VERBS[verb]
+            else:
+                role = PASSIVE_ROLES.get((re.sub(r"'?e?d$", "", verb) if "cc" in verb else verb, m.group("prep")))
+                if role is None:
+                    return None
+            count = analytics.person_count(a, role, responsive=responsive, after=after, before=before,
+                                           inclusive=inclusive)
+            cypher = f"MATCH (p:Person {{id: '{a}'}})-[:{role}]->(e:Email){topic}{where} RETURN count(e) AS email_count"
+            action = {"SEND": "sent", "RECEIVE": "received", "Cc": "was copied on",
+                      "Bcc": "was blind-copied on"}[role]
+            span = f" {m.group('dir')} {m.group('date').upper()}" if m.groupdict().get("dir") else ""
+            return _answer(intent, cypher, [{"email_count": count}], f"{a} {action} {_emails(count, responsive)}{span}.")
+
+        if intent == "dated":
+            count = analytics.sent_count(after=after, before=before, responsive=responsive, inclusive=inclusive)
+            cypher = f"MATCH (:Person)-[:SEND]->(e:Email){topic}{where} RETURN count(e) AS email_count"
+            return _answer(intent, cypher, [{"email_count": count}],
+                           f"{_emails(count, responsive)} {'was' if count == 1 else 'were'} sent "
+                           f"{m.group('dir')} {m.group('date').upper()}.")
+
+        if intent == "top":
+            role = "SEND" if m.group("verb") == "sent" else "RECEIVE"
+            top = analytics.top_persons(role, responsive=responsive, k=1)
+            cypher = (f"MATCH (p:Person)-[:{role}]->(e:Email){topic} "
+                      f"RETURN p.id AS person, count(e) AS email_count ORDER BY email_count DESC, person LIMIT 1")
+            rows = [{"person": person, "email_count": count} for person, count in top]
+            if not rows:
+                return _answer(intent, cypher, rows, f"No {kind} found.")
+            action = "sent" if role == "SEND" else "received"
+            return _answer(intent, cypher, rows, f"{rows[0]['person']} {action} the most {kind} "
+                                                 f"({rows[0]['email_count']}).")
+    return None
+
+
+def _emails(count, responsive):
+    """e.g. "1 responsive email", "3 emails"."""
+    return f"{count} {'responsive ' if responsive else ''}email{'' if count == 1 else 's'}"
+
+
+def _answer(intent, cypher, rows, text):
+    return {"intent": intent, "cypher_query": cypher, "results": rows, "natural_response": text}
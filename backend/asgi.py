@@ -0,0 +1,74 @@
+"""
+ASGI entry point for the chat backend.
+
+Serves the same /chat contract as server.py, but runs the pipeline directly
+on the server's event loop so LLM round trips don't hold a worker thread.
+Run with e.g.:
+
+    hypercorn asgi:app --bind 0.0.0.0:5000
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+from quart import Quart, Response, request, jsonify, make_response
+from quart_cors import cors
+
+from llm_client import BLOCKING_WORKERS
+import metrics
+import server
+
+app = cors(Quart(__name__), allow_origin="*")
+
+
+@app.before_serving
+async def configure_executor():
+    # Neo4j and spaCy calls are offloaded to this pool via asyncio.to_thread
+    asyncio.get_running_loop().set_default_executor(
+        ThreadPoolExecutor(max_workers=BLOCKING_WORKERS)
+    )
+
+
+@app.after_serving
+async def close_llm_client():
+    await server.llm.close()
+
+
+@app.route('/chat', methods=['POST'])
+async def chat():
+    data = await request.get_json() or {}
+    body, status = await server.handle_chat(data)
+    return jsonify(body), status
+
+
+@app.route('/chat/stream', methods=['POST'])
+async def chat_stream():
+    data = await request.get_json() or {}
+    response = await make_response(server.stream_chat(data), server.SSE_HEADERS)
+    response.mimetype = 'text/event-stream'
+    response.timeout = None
+    return response
+
+
+@app.route('/chat/results', methods=['POST'])
+async def chat_results():
+    data = await request.get_json() or {}
+    body, status = await server.handle_results(data)
+    return jsonify(body), status
+
+
+@app.route('/chat/batch', methods=['POST'])
+async def chat_batch():
+    data = await request.get_json() or {}
+    try:
+        questions, clarify, concurrency = server.batch_request(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    response = await make_response(server.json_lines(server.answer_batch(questions, clarify, concurrency)))
+    response.mimetype = server.BATCH_CONTENT_TYPE
+    response.timeout = None
+    return response
+
+
+@app.route('/metrics', methods=['GET'])
+async def metrics_endpoint():
+    return Response(metrics.render(), content_type=server.METRICS_CONTENT_TYPE)
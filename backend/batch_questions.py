@@ -0,0 +1,88 @@
+"""
+Answer a fixed set of questions, e.g. the validation set run against each
+data drop, and write one JSON line per question.
+
+Questions are read from a text file (one per line; blank lines and lines
+starting with # are skipped), a .jsonl file (strings or {"id", "question"}
+objects) or a .csv file with a `question` and optionally an `id` column.
+Clarification is skipped (--clarify auto reframes each question and takes
+the reframing as final). Lines are written as questions finish, each with
+its `index` in the input, `status`, the /chat body and stage timings, then
+a summary line.
+
+By default the pipeline runs in this process (server.py's configuration
+applies: NEO4J_URI, OPENAI_ENDPOINT, LLM_RPM, ...). With --url the
+questions are posted to a running server's /chat/batch instead.
+
+    cd backend
+    python batch_questions.py questions.txt --out answers.jsonl
+    python batch_questions.py questions.csv --url http://localhost:5000 --clarify auto
+"""
+import sys
+import csv
+import json
+import argparse
+
+
+def read_questions(path):
+    if path.endswith(".jsonl"):
+        with open(path) as f:
+            return [json.loads(line) for line in f if line.strip()]
+    if path.endswith(".csv"):
+        with open(path, newline="") as f:
+            return [{"id": row["id"], "question": row["question"]} if row.get("id") else row["question"]
+                    for row in csv.DictReader(f)]
+    with open(path) as f:
+        return [line.strip() for line in f if line.strip() and not line.lstrip().startswith("#")]
+
+
+def run_local(body):
+    import server
+
+    try:
+        questions, clarify, concurrency = server.batch_request(body)
+    except ValueError as e:
+        raise SystemExit(str(e))
+    yield from server.iterate_sync(server.answer_batch(questions, clarify, concurrency))
+
+
+def run_remote(url, body):
+    import requests
+
+    with requests.post(url.rstrip("/") + "/chat/batch", json=body, stream=True, timeout=(10, None)) as response:
+        if response.status_code != 200:
+            raise SystemExit(f"{response.status_code}: {response.text}")
+        for line in response.iter_lines():
+            if line:
+                yield json.loads(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Answer a file of questions without interaction.")
+    parser.add_argument("questions", help=".txt, .jsonl or .csv file of questions")
+    parser.add_argument("--out", help="JSON lines file to write (default: stdout)")
+    parser.add_argument("--url", help="post to this server's /chat/batch instead of running in process")
+    parser.add_argument("--clarify", choices=("skip", "auto"), default="skip")
+    parser.add_argument("--concurrency", type=int, help="questions in flight at once (at most BATCH_CONCURRENCY)")
+    args = parser.parse_args(argv)
+
+    body = {"questions": read_questions(args.questions), "clarify": args.clarify}
+    if args.concurrency:
+        body["concurrency"] = args.concurrency
+    lines = run_remote(args.url, body) if args.url else run_local(body)
+    out = open(args.out, "w") if args.out else sys.stdout
+    try:
+        for line in lines:
+            out.write(json.dumps(line, default=str) + "\n")
+            out.flush()
+            if "summary" in line:
+                summary = line["summary"]
+                print(f"{summary['questions']} questions in {summary['total_ms']} ms, "
+                      f"statuses {summary['statuses']}", file=sys.stderr)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+if __name__ == "__main__":
+    main()
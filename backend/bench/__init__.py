@@ -0,0 +1 @@
+"""Offline benchmark for the /chat pipeline, see bench/run.py."""
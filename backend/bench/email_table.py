@@ -0,0 +1,97 @@
+"""
+Loading the emails from the CSV vs from the converted table (email_table.py).
+
+The CSV's rows are copied --scale times (each copy with its own MessageID)
+into a temporary CSV, which is converted once. Then the emails are read
+the way the loaders do, from each source: every item (ingest.py,
+semantic_index.py), every item without the email text (the graph engine)
+and the Person ids alone (the person index). Both sources must give the
+same items.
+
+    cd backend
+    python -m bench.email_table --scale 200
+"""
+import os
+import json
+import time
+import shutil
+import tempfile
+import argparse
+
+import pandas as pd
+
+from email_table import convert, EmailTable, read_items
+from bench.run import rss_mb
+
+
+def scaled_csv(csv_path, scale, out):
+    df = pd.read_csv(csv_path)
+    copies = []
+    for copy in range(scale):
+        part = df.copy()
+        if copy:
+            part["MessageID"] = part["MessageID"] + f"#{copy}"
+        copies.append(part)
+    pd.concat(copies).to_csv(out, index=False)
+
+
+def timed(fn):
+    started = time.perf_counter()
+    result = fn()
+    return round((time.perf_counter() - started) * 1000, 1), result
+
+
+def run(args):
+    tmp = tempfile.mkdtemp()
+    try:
+        csv_path, table_path = os.path.join(tmp, "emails.csv"), os.path.join(tmp, "table")
+        scaled_csv(args.csv, args.scale, csv_path)
+        convert_ms, emails = timed(lambda: convert(csv_path, table_path))
+        size = {"csv_mb": os.path.getsize(csv_path) / 2 ** 20,
+                "table_mb": sum(os.path.getsize(os.path.join(table_path, f)) for f in os.listdir(table_path)) / 2 ** 20}
+
+        rows = []
+        before = rss_mb()
+        csv_ms, from_csv = timed(lambda: read_items(csv_path))
+        csv_rss = rss_mb() - before
+        table_ms, from_table = timed(lambda: read_items(table_path))
+        if from_csv != from_table:
+            raise SystemExit("the table's items differ from the CSV's")
+        del from_csv, from_table
+        rows.append({"read": "items", "csv_ms": csv_ms, "table_ms": table_ms})
+        csv_ms, _ = timed(lambda: read_items(csv_path, content=False))
+        table_ms, _ = timed(lambda: read_items(table_path, content=False))
+        rows.append({"read": "items, no content", "csv_ms": csv_ms, "table_ms": table_ms})
+        csv_ms, _ = timed(lambda: sorted({person for item in read_items(csv_path) for _, person in item["edges"]}))
+        table_ms, _ = timed(lambda: EmailTable(table_path).person_ids())
+        rows.append({"read": "person ids", "csv_ms": csv_ms, "table_ms": table_ms})
+    finally:
+        shutil.rmtree(tmp)
+    return {"emails": emails, "convert_ms": convert_ms, "csv_rss_growth_mb": round(csv_rss, 1),
+            **{k: round(v, 1) for k, v in size.items()}, "reads": rows}
+
+
+def print_report(report):
+    print(f"{report['emails']} emails: CSV {report['csv_mb']} MB, table {report['table_mb']} MB, "
+          f"converted once in {report['convert_ms']} ms")
+    print(f"{'read':>18} {'CSV ms':>9} {'table ms':>9} {'speedup':>8}")
+    for row in report["reads"]:
+        speedup = row["csv_ms"] / row["table_ms"] if row["table_ms"] else float("inf")
+        print(f"{row['read']:>18} {row['csv_ms']:>9} {row['table_ms']:>9} {speedup:>7.1f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark reading the emails from the CSV vs the converted table.")
+    parser.add_argument("--csv", default="Prompt_Eng_Topic_303_2-20.csv")
+    parser.add_argument("--scale", type=int, default=50, help="copies of the CSV's rows to read")
+    parser.add_argument("--json", help="write the report here")
+    args = parser.parse_args(argv)
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
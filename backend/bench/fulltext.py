@@ -0,0 +1,170 @@
+"""
+Keyword predicates with and without the full-text rewrite (fulltext.py).
+
+In process (default), the emails of the CSV, repeated --scale times, are
+searched the way Neo4j evaluates `e.<field> CONTAINS $value` without an
+index (every email's text is read and scanned) and the way the rewritten
+query runs (TextIndex candidates, then the same CONTAINS on those only;
+a value the index won't narrow down is scanned as before). Both must
+return the same emails. The negated predicate (`NOT e.<field> CONTAINS
+$value`, where an email without the property is neither counted nor
+excluded) is run through the graph engine before and after the rewrite,
+and must give the same count.
+
+With --graph neo4j the original and rewritten queries are run against a
+local Neo4j loaded by ingest.py, with candidates from its `email_text`
+full-text index, both as is and negated.
+
+    cd backend
+    python -m bench.fulltext --scale 50
+    python -m bench.fulltext --graph neo4j --repeat 20
+"""
+import json
+import time
+import argparse
+
+from ingest import NEO4J_URI, NEO4J_USER, NEO4J_PASSWORD
+from database import read_session, read_query
+from email_table import read_items
+from fulltext import (TextIndex, rewrite, lucene_query, FULLTEXT_QUERY, FULLTEXT_INDEX_NAME,
+                      FULLTEXT_MAX_IDS)
+from graph_engine import GraphEngine
+from bench.run import percentile
+
+KEYWORDS = [
+    ("content", "Force Majeure"),
+    ("content", "FERC"),
+    ("content", "Edison"),
+    ("content", "PG&E"),
+    ("content", "lobby"),
+    ("subject", "California"),
+    ("analysis", "lobbying"),
+]
+COUNT_QUERY = "MATCH (e:Email) WHERE e.{field} CONTAINS $p0 RETURN count(e) AS email_count"
+NOT_COUNT_QUERY = "MATCH (e:Email) WHERE NOT e.{field} CONTAINS $p0 RETURN count(e) AS email_count"
+
+
+def scaled_emails(csv_path, scale):
+    emails = [item["email"] for item in read_items(csv_path)]
+    if scale == 1:
+        return emails
+    return [{**email, "id": f"{email['id']}#{copy}"} for copy in range(scale) for email in emails]
+
+
+def time_calls(fn, repeat):
+    timings, result = [], None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return percentile(timings, 0.5), result
+
+
+def run_local(args):
+    emails = scaled_emails(args.csv, args.scale)
+    by_id = {email["id"]: email for email in emails}
+    started = time.perf_counter()
+    index = TextIndex.from_items([{"email": email} for email in emails])
+    build_ms = (time.perf_counter() - started) * 1000
+    graph = GraphEngine.from_items([{"email": email, "edges": [], "responsive": False} for email in emails],
+                                   content=True)
+
+    rows = []
+    for field, value in KEYWORDS:
+        def scan():
+            return [e["id"] for e in emails if value in str(e.get(field) or "")]
+
+        def indexed():
+            # A fresh lookup each time, not the index's memo of the last one
+            index._lookups.clear()
+            ids = index.candidates(field, value)
+            if ids is None:
+                return scan()
+            return [i for i in ids if value in str(by_id[i].get(field) or "")]
+
+        scan_ms, expected = time_calls(scan, args.repeat)
+        index_ms, got = time_calls(indexed, args.repeat)
+        if sorted(got) != sorted(expected):
+            raise SystemExit(f"{field} CONTAINS {value!r}: index returned {len(got)} emails, scan {len(expected)}")
+        template, params = NOT_COUNT_QUERY.format(field=field), {"p0": value}
+        negated = graph.run(template, params)
+        if graph.run(*rewrite(template, params, index.candidates)[:2]) != negated:
+            raise SystemExit(f"NOT {field} CONTAINS {value!r}: the rewritten query's count differs")
+        candidates = index.candidates(field, value)
+        rows.append({"field": field, "value": value, "matches": len(expected),
+                     "negated": negated[0]["email_count"],
+                     "rewritten": candidates is not None,
+                     "scan_ms": round(scan_ms, 3), "index_ms": round(index_ms, 3)})
+    return {"mode": "local", "emails": len(emails), "build_ms": round(build_ms, 1), "queries": rows}
+
+
+def run_neo4j(args):
+    from neo4j import GraphDatabase
+
+    driver = GraphDatabase.driver(NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD))
+
+    def run(query, params):
+        with read_session(driver) as session:
+            return session.run(read_query(query), params).data()
+
+    def candidates(field, value):
+        query = lucene_query(field, value)
+        if query is None:
+            return None
+        return [row["id"] for row in run(FULLTEXT_QUERY, {"index": FULLTEXT_INDEX_NAME, "query": query,
+                                                          "limit": FULLTEXT_MAX_IDS + 1})]
+
+    rows = []
+    try:
+        for field, value in KEYWORDS:
+            template, params = COUNT_QUERY.format(field=field), {"p0": value}
+            scan_ms, expected = time_calls(lambda: run(template, params), args.repeat)
+
+            def indexed():
+                rewritten, bound, _ = rewrite(template, params, candidates)
+                return run(rewritten, bound)
+
+            index_ms, got = time_calls(indexed, args.repeat)
+            if got != expected:
+                raise SystemExit(f"{field} CONTAINS {value!r}: rewritten query returned {got}, original {expected}")
+            template, params = NOT_COUNT_QUERY.format(field=field), {"p0": value}
+            negated = run(template, params)
+            if run(*rewrite(template, params, candidates)[:2]) != negated:
+                raise SystemExit(f"NOT {field} CONTAINS {value!r}: the rewritten query's count differs")
+            rows.append({"field": field, "value": value, "matches": expected[0]["email_count"],
+                         "negated": negated[0]["email_count"],
+                         "rewritten": rewrite(template, params, candidates)[2] > 0,
+                         "scan_ms": round(scan_ms, 3), "index_ms": round(index_ms, 3)})
+    finally:
+        driver.close()
+    return {"mode": "neo4j", "queries": rows}
+
+
+def print_report(report):
+    size = f", {report['emails']} emails, index built in {report['build_ms']} ms" if "emails" in report else ""
+    print(f"CONTAINS scan vs full-text lookup ({report['mode']}{size})")
+    print(f"{'field':>9} {'value':>15} {'matches':>8} {'NOT':>5} {'lookup':>7} {'scan ms':>9} {'index ms':>9} "
+          f"{'speedup':>8}")
+    for row in report["queries"]:
+        speedup = row["scan_ms"] / row["index_ms"] if row["index_ms"] else float("inf")
+        print(f"{row['field']:>9} {row['value']:>15} {row['matches']:>8} {row['negated']:>5} {'yes' if row['rewritten'] else 'no':>7} "
+              f"{row['scan_ms']:>9.3f} {row['index_ms']:>9.3f} {speedup:>7.1f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark keyword predicates with and without full-text lookups.")
+    parser.add_argument("--csv", default="Prompt_Eng_Topic_303_2-20.csv")
+    parser.add_argument("--graph", choices=("local", "neo4j"), default="local")
+    parser.add_argument("--scale", type=int, default=20, help="copies of the CSV's emails to search (local)")
+    parser.add_argument("--repeat", type=int, default=10, help="runs per query; the median is reported")
+    parser.add_argument("--json", help="write the report here")
+    args = parser.parse_args(argv)
+    report = run_neo4j(args) if args.graph == "neo4j" else run_local(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+"""
+Latency and footprint of the embedded graph engine (graph_engine.py).
+
+The CSV's emails are copied --scale times (each copy with its own email
+and person ids, so per-person questions stay the size they are in the
+real data while scans over every email grow) and loaded into a
+GraphEngine. Typical queries, in the parameterized and projected form
+the server sends, are then timed with warm plans.
+
+At --scale 1 the rows of every query recorded in bench/corpus.json are
+also checked against the engine's. Email.content is only loaded with
+--content (GRAPH_ENGINE_CONTENT=1); without it the keyword query is one
+the server leaves to Neo4j.
+
+    cd backend
+    python -m bench.graph_engine --content
+    python -m bench.graph_engine --scale 2000
+"""
+import json
+import time
+import argparse
+
+from ingest import TOPIC_NAME
+from email_table import read_items
+from graph_engine import GraphEngine, Unsupported
+from cypher_schema import repair
+from cypher_params import parameterize
+from result_cache import canonicalize_cypher
+from result_pages import project_nodes, paginate
+from bench.make_corpus import CORPUS_PATH
+from bench.run import percentile, rss_mb
+
+QUERIES = [
+    ("sent responsive", "MATCH (sender:Person {id: $p0})-[:SEND]->(email:Email)-[:RESPONSIVE]->(:Topic {name: $p1}) "
+                        "RETURN count(email) AS responsive_emails_sent"),
+    ("received", "MATCH (recipient:Person {id: $p0})-[:RECEIVE]->(email:Email) RETURN count(email) AS email_count"),
+    ("pair", "MATCH (sender:Person {id: $p0})-[:SEND]->(email:Email) "
+             "MATCH (recipient:Person {id: $p2})-[:RECEIVE]->(email) RETURN count(email) AS email_count"),
+    ("list sent", "MATCH (sender:Person {id: $p0})-[:SEND]->(email:Email) "
+                  "RETURN email {.id, .subject, .date_time, .relevant, .analysis} AS email "
+                  "ORDER BY email.date_time DESC SKIP $result_skip LIMIT $result_limit"),
+    ("cc'd on", "MATCH (p:Person {id: $p0})-[:RECEIVE|Cc|Bcc]->(e:Email) WHERE e.date_time >= datetime($p3) "
+                "RETURN count(DISTINCT e) AS emails"),
+    ("after date", "MATCH (sender:Person)-[:SEND]->(e:Email)-[:RESPONSIVE]->(:Topic {name: $p1}) "
+                   "WHERE e.date_time > datetime($p3) RETURN count(e) AS responsive_emails_after_date"),
+    ("keyword", "MATCH (e:Email) WHERE e.content CONTAINS $p4 RETURN e.id AS id, e.subject AS subject "
+                "SKIP $result_skip LIMIT $result_limit"),
+    ("top senders", "MATCH (p:Person)-[:SEND]->(e:Email) RETURN p.id AS sender, count(e) AS emails "
+                    "ORDER BY emails DESC LIMIT 5"),
+]
+PARAMS = {"p0": "jeff.dasovich@enron.com", "p1": TOPIC_NAME, "p2": "richard.shapiro@enron.com",
+          "p3": "2001-01-01T00:00:00", "p4": "Force Majeure", "result_skip": 0, "result_limit": 101}
+
+
+def scaled_items(csv_path, scale, content=True):
+    items = read_items(csv_path, content=content)
+    if scale == 1:
+        return items
+    out = []
+    for copy in range(scale):
+        suffix = f"#{copy}" if copy else ""
+        for item in items:
+            out.append({**item,
+                        "email": {**item["email"], "id": item["email"]["id"] + suffix},
+                        "edges": [[rel_type, person + suffix] for rel_type, person in item["edges"]]})
+    return out
+
+
+def _plain_dates(value):
+    """The engine returns UTC datetimes with a Z suffix, the corpus has the CSV's strings."""
+    if isinstance(value, dict):
+        return {k: _plain_dates(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_plain_dates(v) for v in value]
+    if isinstance(value, str) and value.endswith("Z") and value[:4].isdigit():
+        return value[:-1]
+    return value
+
+
+def check_corpus(engine, corpus_path):
+    """(matched, unsupported) over the corpus queries; raises SystemExit on a mismatch."""
+    with open(corpus_path) as f:
+        corpus = json.load(f)
+    matched = unsupported = 0
+    for recorded, expected in corpus["results"].items():
+        template, params = parameterize(canonicalize_cypher(repair(recorded)[0]))
+        query = project_nodes(template)
+        query = paginate(query) or query
+        params.update(result_skip=0, result_limit=len(expected) + 1)
+        try:
+            rows = engine.run(query, params)
+        except Unsupported:
+            unsupported += 1
+            continue
+        got = sorted(json.dumps(_plain_dates(row), sort_keys=True) for row in rows)
+        if got != sorted(json.dumps(row, sort_keys=True) for row in expected):
+            raise SystemExit(f"engine rows differ from the corpus for {recorded!r}")
+        matched += 1
+    return matched, unsupported
+
+
+def run(args):
+    items = scaled_items(args.csv, args.scale, content=args.content)
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    engine = GraphEngine.from_items(items, topic=TOPIC_NAME, content=args.content)
+    build_ms = (time.perf_counter() - started) * 1000
+    rss_after = rss_mb()
+    del items
+
+    rows = []
+    for name, query in QUERIES:
+        try:
+            engine.run(query, PARAMS)  # plan and lazily built buffers
+        except Unsupported as e:
+            rows.append({"query": name, "unsupported": str(e)})
+            continue
+        timings = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            result = engine.run(query, PARAMS)
+            timings.append((time.perf_counter() - started) * 1e6)
+        rows.append({"query": name, "rows": len(result), "p50_us": round(percentile(timings, 0.5)),
+                     "p95_us": round(percentile(timings, 0.95))})
+    report = {"emails": len(engine.nodes["Email"]), "persons": len(engine.nodes["Person"]),
+              "edges": engine.edge_count, "build_ms": round(build_ms, 1),
+              "array_mb": round(engine.nbytes / 2 ** 20, 1), "rss_growth_mb": round(rss_after - rss_before, 1),
+              "queries": rows}
+    if args.scale == 1:
+        report["corpus_matched"], report["corpus_unsupported"] = check_corpus(engine, args.corpus)
+    return report
+
+
+def print_report(report):
+    print(f"{report['emails']} emails, {report['persons']} persons, {report['edges']} edges; "
+          f"built in {report['build_ms']} ms, {report['array_mb']} MB of arrays "
+          f"(RSS +{report['rss_growth_mb']} MB)")
+    if "corpus_matched" in report:
+        print(f"corpus: {report['corpus_matched']} queries match the recorded rows, "
+              f"{report['corpus_unsupported']} left to Neo4j")
+    print(f"{'query':>16} {'rows':>6} {'p50 us':>8} {'p95 us':>8}")
+    for row in report["queries"]:
+        if "unsupported" in row:
+            print(f"{row['query']:>16}   left to Neo4j: {row['unsupported']}")
+            continue
+        print(f"{row['query']:>16} {row['rows']:>6} {row['p50_us']:>8} {row['p95_us']:>8}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the embedded graph engine.")
+    parser.add_argument("--csv", default="Prompt_Eng_Topic_303_2-20.csv")
+    parser.add_argument("--corpus", default=CORPUS_PATH)
+    parser.add_argument("--scale", type=int, default=1, help="copies of the CSV's emails to load")
+    parser.add_argument("--repeat", type=int, default=200, help="runs per query")
+    parser.add_argument("--content", action="store_true", help="load Email.content too (GRAPH_ENGINE_CONTENT=1)")
+    parser.add_argument("--json", help="write the report here")
+    args = parser.parse_args(argv)
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=1)
+
+
+if __name__ == "__main__":
+    main()
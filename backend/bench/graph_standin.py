@@ -0,0 +1,76 @@
+"""
+Graph stand-in for benchmarks: serves the rows recorded in the corpus for
+each query instead of running it, with the same stream_cypher /
+execute_cypher interface as server.Neo4jDatabase.
+"""
+import json
+import time
+import threading
+
+from result_cache import canonicalize_cypher
+from result_pages import project_nodes
+from cypher_params import parameterize
+from fulltext import strip_rewrites
+
+PAGE_SUFFIX = " SKIP $result_skip LIMIT $result_limit"
+PAGE_PARAMS = ("result_skip", "result_limit")
+
+
+def _key(query, params=None):
+    """Lookup key for a query as the server sends it (parameterized, projected, maybe paged, full-text narrowed)."""
+    query, params = strip_rewrites(canonicalize_cypher(query), params)
+    if query.endswith(PAGE_SUFFIX):
+        query = query[:-len(PAGE_SUFFIX)]
+    params = {k: v for k, v in (params or {}).items() if k not in PAGE_PARAMS}
+    return query, json.dumps(params, sort_keys=True)
+
+
+def _keys(recorded):
+    """Every form the server may send a recorded query in."""
+    template, params = parameterize(canonicalize_cypher(recorded))
+    return {_key(recorded), _key(template, params), _key(project_nodes(template), params)}
+
+
+class StandInSyntaxError(Exception):
+    pass
+
+
+class StandInGraph:
+    def __init__(self, corpus, latency_ms=0.0, batch_size=50):
+        self.results = {}
+        for query, rows in corpus.get("results", {}).items():
+            for key in _keys(query):
+                self.results[key] = rows
+        self.broken = set()
+        for query in corpus.get("fixes", {}):
+            self.broken.update(_keys(query))
+        self.latency = latency_ms / 1000.0
+        self.batch_size = batch_size
+        self.queries = 0
+        self.unknown = 0
+        self._lock = threading.Lock()
+
+    def execute_cypher(self, query, params=None):
+        rows = []
+        for batch in self.stream_cypher(query, params):
+            rows.extend(batch)
+        return rows
+
+    def stream_cypher(self, query, params=None, batch_size=None):
+        batch_size = batch_size or self.batch_size
+        key = _key(query, params)
+        with self._lock:
+            self.queries += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if key in self.broken:
+            raise StandInSyntaxError(f"SyntaxError: Invalid input 'RETURN' in {query!r}")
+        rows = self.results.get(key)
+        if rows is None:
+            with self._lock:
+                self.unknown += 1
+            rows = []
+        if params and "result_skip" in params:
+            rows = rows[params["result_skip"]:params["result_skip"] + params["result_limit"]]
+        for i in range(0, len(rows), batch_size):
+            yield rows[i:i + batch_size]
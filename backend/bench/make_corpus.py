@@ -0,0 +1,164 @@
+"""
+Build bench/corpus.json from the email CSV.
+
+The corpus holds the conversations to replay, what the mock LLM answers
+for each question (translations, syntax fixes, questions it asks to
+clarify) and the rows the graph stand-in returns for each query. Rows
+are computed from the CSV with the same parsing as ingest.py, so they
+match what a Neo4j loaded from that file would return.
+
+    python -m bench.make_corpus --csv Prompt_Eng_Topic_303_2-20.csv
+"""
+import os
+import json
+import argparse
+from collections import Counter
+
+from ingest import TOPIC_NAME
+from email_table import read_items
+from cypher_schema import repair
+from result_cache import canonicalize_cypher
+
+CORPUS_PATH = os.path.join(os.path.dirname(__file__), "corpus.json")
+
+SENT_QUERY = ("MATCH (sender:Person {{id: '{person}'}})-[:SEND]->(email:Email)-[:RESPONSIVE]->(:Topic {{name:'" + TOPIC_NAME + "'}}) "
+              "RETURN COUNT(email) AS responsive_emails_sent")
+RECEIVED_QUERY = ("MATCH (recipient:Person {{id: '{person}'}})-[:RECEIVE]->(email:Email) "
+                  "RETURN count(email) AS email_count")
+PAIR_QUERY = ("MATCH (sender:Person {{id: '{sender}'}})-[:SEND]->(email:Email) "
+              "MATCH (recipient:Person {{id: '{recipient}'}})-[:RECEIVE]->(email) "
+              "RETURN count(email) AS email_count")
+LIST_QUERY = ("MATCH (sender:Person {{id: '{person}'}})-[:SEND]->(email:Email) "
+              "RETURN email")
+AFTER_QUERY = ("MATCH (sender:Person)-[:SEND]->(e:Email)-[:RESPONSIVE]->(:Topic {{name: '" + TOPIC_NAME + "'}}) "
+               "WHERE e.date_time > datetime('{date}') RETURN count(e) AS responsive_emails_after_date")
+# Relationship drawn backwards, as the LLM sometimes does; cypher_schema.repair flips it without a fix round trip
+REVERSED_QUERY = ("MATCH (email:Email)-[:RECEIVE]->(recipient:Person {{id: '{person}'}}) "
+                  "RETURN count(email) AS email_count")
+# Keyword question; the server narrows the CONTAINS with a full-text lookup (fulltext.py)
+KEYWORD_QUERY = "MATCH (e:Email) WHERE e.content CONTAINS '{keyword}' RETURN e.id AS id, e.subject AS subject"
+KEYWORDS = ("Force Majeure", "FERC", "Edison")
+# A quoted phrase with a sender: the keyword path, not a semantic search (semantic_index.QUOTED_RX)
+SENDER_KEYWORD_QUERY = ("MATCH (sender:Person {{id: '{person}'}})-[:SEND]->(e:Email) "
+                        "WHERE e.content CONTAINS '{keyword}' RETURN e.id AS id, e.subject AS subject")
+# Deliberately broken so error_handling_query's fix-up round trip is exercised
+BROKEN_SUFFIX = " RETURN RETURN"
+
+
+def _name(address):
+    local = address.split("@")[0]
+    parts = local.split(".")
+    if len(parts) != 2 or not all(p.isalpha() for p in parts):
+        return None
+    return " ".join(p.capitalize() for p in parts)
+
+
+def build(csv_path, max_people=12):
+    emails = read_items(csv_path)
+    senders, receivers, pairs = Counter(), Counter(), Counter()
+    responsive_sent = Counter()
+    for item in emails:
+        sender = [p for rel, p in item["edges"] if rel == "SEND"]
+        recipients = [p for rel, p in item["edges"] if rel == "RECEIVE"]
+        for s in sender:
+            senders[s] += 1
+            if item["responsive"]:
+                responsive_sent[s] += 1
+            for r in recipients:
+                pairs[(s, r)] += 1
+        for r in recipients:
+            receivers[r] += 1
+
+    translations, results, fixes = {}, {}, {}
+    conversations = []
+
+    def add(question, query, rows):
+        translations[question] = query
+        results[canonicalize_cypher(query)] = rows
+        return {"user_input": question}
+
+    for person, _ in senders.most_common(max_people):
+        turns = [add(f"How many responsive emails did {person} send?",
+                     SENT_QUERY.format(person=person), [{"responsive_emails_sent": responsive_sent[person]}])]
+        sent = [item["email"] for item in emails if ["SEND", person] in item["edges"]]
+        turns.append(add(f"List the emails sent by {person}", LIST_QUERY.format(person=person),
+                         [{"email": {"id": email["id"], "subject": email["subject"], "date_time": email["date"],
+                                     "relevant": email["relevant"], "analysis": email["analysis"]}}
+                          for email in sent]))
+        name = _name(person)
+        if name:
+            turns.append(add(f"How many emails did {name} receive?", RECEIVED_QUERY.format(person=person),
+                             [{"email_count": receivers[person]}]))
+        conversations.append({"turns": turns})
+
+    for (sender, recipient), count in pairs.most_common(max_people):
+        question = f"How many emails did {sender} send to {recipient}?"
+        conversations.append({"turns": [add(question, PAIR_QUERY.format(sender=sender, recipient=recipient),
+                                            [{"email_count": count}])]})
+
+    for person, count in receivers.most_common(4):
+        query = REVERSED_QUERY.format(person=person)
+        turn = add(f"How many emails were addressed to {person}?", query, [])
+        results.pop(canonicalize_cypher(query))
+        results[canonicalize_cypher(repair(query)[0])] = [{"email_count": count}]
+        conversations.append({"turns": [turn]})
+
+    for keyword in KEYWORDS:
+        rows = [{"id": item["email"]["id"], "subject": item["email"]["subject"]}
+                for item in emails if keyword in (item["email"]["content"] or "")]
+        conversations.append({"turns": [add(f"Which emails mention '{keyword}'?",
+                                            KEYWORD_QUERY.format(keyword=keyword), rows)]})
+    keyword = KEYWORDS[0]
+    matching = [item for item in emails if keyword in (item["email"]["content"] or "")]
+    by_sender = Counter(person for item in matching for rel, person in item["edges"] if rel == "SEND")
+    if by_sender:
+        person = by_sender.most_common(1)[0][0]
+        rows = [{"id": item["email"]["id"], "subject": item["email"]["subject"]}
+                for item in matching if ["SEND", person] in item["edges"]]
+        conversations.append({"turns": [add(f'Emails mentioning "{keyword}" sent by {person}',
+                                            SENDER_KEYWORD_QUERY.format(person=person, keyword=keyword), rows)]})
+
+    dates = sorted(item["email"]["date"] for item in emails if item["email"]["date"])
+    for date in dates[::max(1, len(dates) // 4)][:4]:
+        query = AFTER_QUERY.format(date=date)
+        count = sum(1 for item in emails if item["responsive"] and item["email"]["date"] > date)
+        question = f"How many responsive emails were sent after {date}?"
+        turn = add(question, query + BROKEN_SUFFIX, [])
+        # The stand-in rejects the broken query; the mock LLM's fix returns the real one
+        fixes[canonicalize_cypher(query + BROKEN_SUFFIX)] = query
+        results[canonicalize_cypher(query)] = [{"responsive_emails_after_date": count}]
+        conversations.append({"turns": [turn]})
+
+    # Vague question: the mock LLM asks for confirmation, the user confirms
+    vague = "Who is the most important person around topic 303?"
+    top = senders.most_common(1)[0][0]
+    conversations.append({"turns": [
+        {"user_input": vague},
+        add("Yes, who sent the most emails?", SENT_QUERY.format(person=top),
+            [{"responsive_emails_sent": responsive_sent[top]}]),
+    ]})
+
+    return {
+        "translations": translations,
+        "fixes": fixes,
+        "clarify": [vague],
+        "results": results,
+        "conversations": conversations,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the benchmark corpus from an email CSV.")
+    parser.add_argument("--csv", default="Prompt_Eng_Topic_303_2-20.csv")
+    parser.add_argument("--out", default=CORPUS_PATH)
+    parser.add_argument("--max-people", type=int, default=12)
+    args = parser.parse_args(argv)
+    corpus = build(args.csv, args.max_people)
+    with open(args.out, "w") as f:
+        json.dump(corpus, f, indent=1, default=str)
+    print(f"Wrote {len(corpus['conversations'])} conversations, "
+          f"{len(corpus['results'])} result sets to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
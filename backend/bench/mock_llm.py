@@ -0,0 +1,114 @@
+"""
+Deterministic stand-in for the chat completions endpoint.
+
+Answers the three kinds of prompt server.py sends (clarification,
+Cypher translation / syntax fix, result formatting) from the benchmark
+corpus, after `latency_ms` plus one `1 / token_rate` delay per generated
+token. Supports "stream": true the same way the real endpoint does.
+
+    python -m bench.mock_llm --port 8765 --latency-ms 200 --token-rate 80
+"""
+import re
+import json
+import asyncio
+import argparse
+import threading
+
+from aiohttp import web
+
+from result_cache import canonicalize_cypher
+
+USER_QUERY_RX = re.compile(r'User Query: "(.*?)"\s*$', re.S | re.M)
+ORIGINAL_QUERY_RX = re.compile(r"Original query: (.*?)\n\s*Error message:", re.S)
+CLARIFY = "Please clarify. Question is too ambiguous"
+
+
+class MockLLM:
+    def __init__(self, corpus, latency_ms=0.0, token_rate=0.0, answer_tokens=24):
+        self.translations = corpus.get("translations", {})
+        self.fixes = corpus.get("fixes", {})
+        self.clarify = set(corpus.get("clarify", []))
+        self.latency = latency_ms / 1000.0
+        self.token_delay = 1.0 / token_rate if token_rate > 0 else 0.0
+        self.answer_tokens = answer_tokens
+        self.requests = 0
+
+    def reply(self, messages):
+        """The text the model would generate for `messages`."""
+        # Instructions may be in the system message and the question in the last one
+        text = "\n".join(m["content"] for m in messages)
+        if messages[0]["role"] == "developer":
+            question = next((m["content"] for m in reversed(messages) if m["role"] == "user"), "")
+            return json.dumps({
+                "reframed_question": question,
+                "explanation": "Reframed for the benchmark.",
+                "confirmation_message": "Is this what you meant?",
+                "termination_status": question not in self.clarify,
+            })
+        if "turns Cypher query results" in text:
+            words = ["The", "query", "returned", "the", "requested", "data"]
+            return " ".join(words[i % len(words)] for i in range(self.answer_tokens)) + "."
+        original = ORIGINAL_QUERY_RX.search(text)
+        if original:
+            return self.fixes.get(canonicalize_cypher(original.group(1)), original.group(1))
+        match = USER_QUERY_RX.search(text)
+        return self.translations.get(match.group(1), CLARIFY) if match else CLARIFY
+
+    async def handle(self, request):
+        body = await request.json()
+        self.requests += 1
+        text = self.reply(body["messages"])
+        tokens = re.findall(r"\S+\s*", text) or [text]
+        await asyncio.sleep(self.latency)
+        if not body.get("stream"):
+            await asyncio.sleep(self.token_delay * len(tokens))
+            return web.json_response({
+                "choices": [{"message": {"role": "assistant", "content": text}}],
+                "usage": {"prompt_tokens": sum(len(m["content"].split()) for m in body["messages"]),
+                          "completion_tokens": len(tokens)},
+            })
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for token in tokens:
+            await asyncio.sleep(self.token_delay)
+            chunk = {"choices": [{"delta": {"content": token}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/{tail:.*}", self.handle)
+        return app
+
+
+def start_in_thread(mock, host="127.0.0.1", port=0):
+    """Serve `mock` from a background thread; returns the endpoint URL."""
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(mock.app(), access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, host, port)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    threading.Thread(target=loop.run_forever, name="mock-llm", daemon=True).start()
+    return f"http://{host}:{port}/chat/completions"
+
+
+def main(argv=None):
+    from bench.make_corpus import CORPUS_PATH
+    parser = argparse.ArgumentParser(description="Serve a deterministic mock completions endpoint.")
+    parser.add_argument("--corpus", default=CORPUS_PATH)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--token-rate", type=float, default=0.0, help="tokens/s; 0 = instant")
+    parser.add_argument("--answer-tokens", type=int, default=24)
+    args = parser.parse_args(argv)
+    with open(args.corpus) as f:
+        corpus = json.load(f)
+    mock = MockLLM(corpus, args.latency_ms, args.token_rate, args.answer_tokens)
+    web.run_app(mock.app(), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
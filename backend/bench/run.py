@@ -0,0 +1,327 @@
+"""
+Replay the benchmark corpus against the Flask app, fully offline.
+
+The completions endpoint is replaced by bench/mock_llm.py and, unless
+--graph neo4j is given, Neo4j by the recorded rows in bench/graph_standin.py.
+Conversations are replayed through the Flask test client at each
+concurrency level, and the report gives throughput, end-to-end and
+per-stage latency percentiles (from the request traces, see metrics.py)
+and memory.
+
+    cd backend
+    python -m bench.run --levels 1,4,16 --conversations 64 --llm-latency-ms 150 --token-rate 100
+    python -m bench.run --json after.json --baseline before.json
+    python -m bench.run --no-analytics    # every question through Cypher generation
+    python -m bench.run --speculative     # SPECULATIVE_CHAT=1
+    python -m bench.run --full-prompts    # every few-shot example, no token budget
+    python -m bench.run --no-fulltext     # CONTAINS without full-text lookups (FULLTEXT_BACKEND=off)
+    python -m bench.run --engine          # reads through the embedded graph engine (GRAPH_ENGINE=1)
+
+`python -m bench.fulltext` measures the full-text lookups themselves and
+`python -m bench.graph_engine` the graph engine's queries.
+
+With --baseline, the run fails (exit code 1) if p95 latency or throughput
+at any level is more than --max-regression worse than in the baseline.
+"""
+import os
+import sys
+import gc
+import json
+import time
+import uuid
+import logging
+import resource
+import argparse
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.make_corpus import CORPUS_PATH
+from bench.mock_llm import MockLLM, start_in_thread
+from bench.graph_standin import StandInGraph
+from graph_engine import EngineFirst
+
+STAGES = ("clarify", "speculation", "demo_check", "analytics", "prompt_to_cypher", "error_handling_query", "syntax_fix",
+          "format_result_naturally")
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def rss_mb():
+    """Current resident set size (Linux), falling back to the peak elsewhere."""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def setup_server(args, corpus):
+    """Point the app at the mock LLM (and stand-in graph), then import it."""
+    os.environ["OPENAI_ENDPOINT"] = args.llm_url
+    os.environ.setdefault("NER_BACKEND", "gazetteer")
+    os.environ.setdefault("SESSION_BACKEND", "memory")
+    if args.speculative:
+        os.environ["SPECULATIVE_CHAT"] = "1"
+    if args.no_fulltext:
+        os.environ["FULLTEXT_BACKEND"] = "off"
+    if args.full_prompts:
+        os.environ["CYPHER_EXAMPLES_K"] = "0"
+        os.environ["PROMPT_TOKEN_BUDGET"] = str(10 ** 9)
+    if args.engine and args.graph == "neo4j":
+        os.environ["GRAPH_ENGINE"] = "1"
+    if args.graph == "standin":
+        # Nothing to poll: the stand-in's data never changes
+        os.environ.setdefault("DATASET_POLL_SECONDS", "86400")
+    import server
+    from ingest import TOPIC_NAME
+    from email_table import read_items
+    from analytics import EmailAnalytics
+    from fulltext import TextIndex
+    from graph_engine import GraphEngine
+    import metrics
+    from database import ROW_BATCH_SIZE
+    # server.py logs every request at INFO; that would be measured too
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.ERROR)
+
+    if args.graph == "standin":
+        server.db = StandInGraph(corpus, latency_ms=args.graph_latency_ms, batch_size=ROW_BATCH_SIZE)
+        items = read_items(args.csv)
+        ids = sorted({person for item in items for _, person in item["edges"]})
+        server.person_resolver.load_ids(ids, generation=0)
+        # What ingest.py would have saved for the same CSV
+        server.analytics_store.set(EmailAnalytics.from_items(items, topic=TOPIC_NAME))
+        server.text_index_store.set(TextIndex.from_items(items))
+        if args.engine:
+            # The engine answers what it supports from the CSV, the stand-in the rest
+            server.graph_engine_store.set(GraphEngine.from_items(items, topic=TOPIC_NAME))
+            server.db = EngineFirst(server.db, server.graph_engine_store)
+            metrics.registry.add_collector(metrics.graph_engine_collector(server.db))
+        # The stand-in has no rows recorded for semantic search's filter queries
+        server.semantic_store.set(None, None)
+    if args.no_analytics:
+        server.analytics_store.set(None)
+    else:
+        deadline = time.monotonic() + 30
+        while server.person_resolver.index is None and time.monotonic() < deadline:
+            time.sleep(0.2)
+    return server
+
+
+def replay(client, conversation, stream=False):
+    """Play one conversation; returns a list of (seconds, status, spans) per turn."""
+    conversation_id = uuid.uuid4().hex
+    out = []
+    for turn in conversation["turns"]:
+        body = {"user_input": turn["user_input"], "conversation_id": conversation_id, "trace": True}
+        started = time.perf_counter()
+        if stream:
+            response = client.post("/chat/stream", json=body)
+            data = response.get_data(as_text=True)
+            result = {}
+            for event in data.split("\n\n"):
+                if event.startswith("event: result"):
+                    result = json.loads(event.split("data: ", 1)[1])
+            status = result.get("status", response.status_code)
+        else:
+            response = client.post("/chat", json=body)
+            result = response.get_json() or {}
+            status = response.status_code
+        out.append((time.perf_counter() - started, status, result.get("trace", {}).get("spans", [])))
+    return out
+
+
+def token_counts(metrics):
+    """{stage: prompt tokens} so far: counted locally, and as reported by the endpoint."""
+    local = {dict(key)["stage"]: value for key, value in metrics.registry.counter("llm_prompt_tokens_total").items()}
+    reported = {}
+    for key, value in metrics.registry.counter("llm_tokens_total").items():
+        labels = dict(key)
+        if labels.get("kind") == "prompt":
+            reported[labels["stage"]] = value
+    return local, reported
+
+
+def run_level(server, conversations, level, total, stream):
+    def worker(i):
+        return replay(server.app.test_client(), conversations[i % len(conversations)], stream)
+
+    local_before, reported_before = token_counts(server.metrics)
+    gc.collect()
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=level) as pool:
+        results = [turn for conversation in pool.map(worker, range(total)) for turn in conversation]
+    elapsed = time.perf_counter() - started
+
+    local_after, reported_after = token_counts(server.metrics)
+    prompt_tokens = {stage: round((local_after[stage] - local_before.get(stage, 0)) / len(results), 1)
+                     for stage in local_after if local_after[stage] != local_before.get(stage, 0)}
+    reported = sum(reported_after.values()) - sum(reported_before.values())
+
+    latencies = [seconds for seconds, _, _ in results]
+    stages = {stage: [] for stage in STAGES}
+    for _, _, spans in results:
+        for item in spans:
+            stages.setdefault(item["stage"], []).append(item["ms"] / 1000.0)
+    return {
+        "concurrency": level,
+        "conversations": total,
+        "requests": len(results),
+        "errors": sum(1 for _, status, _ in results if status >= 500),
+        "seconds": round(elapsed, 3),
+        "throughput_rps": round(len(results) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {f"p{int(q * 100)}": round(percentile(latencies, q) * 1000, 2) for q in (0.5, 0.95, 0.99)},
+        "stages_ms": {
+            stage: {f"p{int(q * 100)}": round(percentile(values, q) * 1000, 2) for q in (0.5, 0.95, 0.99)}
+            for stage, values in stages.items() if values
+        },
+        # Per /chat request, by stage; "reported" is the endpoint's usage (the mock counts words)
+        "prompt_tokens_per_request": prompt_tokens,
+        "prompt_tokens_reported_per_request": round(reported / len(results), 1) if results else 0.0,
+        "rss_mb": round(rss_mb(), 1),
+        "rss_growth_mb": round(rss_mb() - rss_before, 1),
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+
+
+def print_report(report):
+    print(f"\nLLM latency {report['config']['llm_latency_ms']} ms, "
+          f"{report['config']['token_rate'] or 'instant'} tokens/s, graph: {report['config']['graph']}")
+    print(f"{'conc':>5} {'reqs':>6} {'err':>4} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'RSS MB':>8}")
+    for level in report["levels"]:
+        lat = level["latency_ms"]
+        print(f"{level['concurrency']:>5} {level['requests']:>6} {level['errors']:>4} {level['throughput_rps']:>8} "
+              f"{lat['p50']:>9} {lat['p95']:>9} {lat['p99']:>9} {level['rss_mb']:>8}")
+    for level in report["levels"]:
+        print(f"\nStages at concurrency {level['concurrency']} (p50 / p95 / p99 ms):")
+        for stage, values in level["stages_ms"].items():
+            print(f"  {stage:<26} {values['p50']:>9} {values['p95']:>9} {values['p99']:>9}")
+    for level in report["levels"]:
+        tokens = level["prompt_tokens_per_request"]
+        print(f"\nPrompt tokens per request at concurrency {level['concurrency']}: "
+              f"{round(sum(tokens.values()), 1)} ({', '.join(f'{k} {v}' for k, v in sorted(tokens.items()))})")
+    if report.get("graph_engine"):
+        stats = report["graph_engine"]
+        print(f"\nGraph engine: {stats['served']} queries served, {stats['fallbacks']} left to the graph, "
+              f"{stats['errors']} errors")
+    if report.get("tracemalloc_peak_mb") is not None:
+        print(f"\nPython heap peak (tracemalloc): {report['tracemalloc_peak_mb']} MB")
+
+
+def compare(report, baseline, max_regression):
+    """Return a list of regressions of `report` against `baseline`, per concurrency level."""
+    if baseline.get("config") != report["config"]:
+        print("note: the baseline was run with a different configuration", file=sys.stderr)
+    previous = {level["concurrency"]: level for level in baseline.get("levels", [])}
+    problems = []
+    for level in report["levels"]:
+        before = previous.get(level["concurrency"])
+        if before is None:
+            continue
+        if level["latency_ms"]["p95"] > before["latency_ms"]["p95"] * (1 + max_regression):
+            problems.append(f"concurrency {level['concurrency']}: p95 {before['latency_ms']['p95']} -> "
+                            f"{level['latency_ms']['p95']} ms")
+        if level["throughput_rps"] < before["throughput_rps"] * (1 - max_regression):
+            problems.append(f"concurrency {level['concurrency']}: throughput {before['throughput_rps']} -> "
+                            f"{level['throughput_rps']} req/s")
+    return problems
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark of the /chat pipeline.")
+    parser.add_argument("--corpus", default=CORPUS_PATH)
+    parser.add_argument("--csv", default="Prompt_Eng_Topic_303_2-20.csv", help="source of the Person ids")
+    parser.add_argument("--levels", default="1,4,16", help="comma-separated concurrency levels")
+    parser.add_argument("--conversations", type=int, default=0,
+                        help="conversations replayed per level (default: the whole corpus)")
+    parser.add_argument("--graph", choices=("standin", "neo4j"), default="standin",
+                        help="recorded rows, or the Neo4j configured by NEO4J_URI (load it with ingest.py)")
+    parser.add_argument("--graph-latency-ms", type=float, default=0.0, help="per-query delay of the stand-in")
+    parser.add_argument("--llm-url", help="use an already running mock (python -m bench.mock_llm)")
+    parser.add_argument("--llm-latency-ms", type=float, default=50.0)
+    parser.add_argument("--token-rate", type=float, default=0.0, help="mock tokens/s; 0 = instant")
+    parser.add_argument("--answer-tokens", type=int, default=24)
+    parser.add_argument("--stream", action="store_true", help="replay through /chat/stream")
+    parser.add_argument("--warm", action="store_true", help="keep the caches between levels")
+    parser.add_argument("--tracemalloc", action="store_true", help="also report the Python heap peak (slower)")
+    parser.add_argument("--no-analytics", action="store_true",
+                        help="answer every question through Cypher generation")
+    parser.add_argument("--speculative", action="store_true",
+                        help="draft the Cypher while clarify runs (SPECULATIVE_CHAT=1)")
+    parser.add_argument("--no-fulltext", action="store_true",
+                        help="run CONTAINS predicates without full-text lookups (FULLTEXT_BACKEND=off)")
+    parser.add_argument("--full-prompts", action="store_true",
+                        help="send every few-shot example and no token budget (CYPHER_EXAMPLES_K=0)")
+    parser.add_argument("--engine", action="store_true",
+                        help="answer reads from the embedded graph engine where it can (GRAPH_ENGINE=1)")
+    parser.add_argument("--verbose", action="store_true", help="keep the app's INFO logging")
+    parser.add_argument("--json", help="write the report here")
+    parser.add_argument("--baseline", help="report from an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    with open(args.corpus) as f:
+        corpus = json.load(f)
+    mock = None
+    if not args.llm_url:
+        mock = MockLLM(corpus, args.llm_latency_ms, args.token_rate, args.answer_tokens)
+        args.llm_url = start_in_thread(mock)
+    server = setup_server(args, corpus)
+
+    conversations = corpus["conversations"]
+    total = args.conversations or len(conversations)
+    if args.tracemalloc:
+        tracemalloc.start()
+    levels = []
+    for level in (int(x) for x in args.levels.split(",") if x.strip()):
+        if not args.warm:
+            server.translation_cache.clear()
+            if hasattr(server.db, "result_cache"):
+                server.db.result_cache.clear()
+        levels.append(run_level(server, conversations, level, total, args.stream))
+    report = {
+        "config": {
+            "graph": args.graph,
+            "llm_latency_ms": args.llm_latency_ms,
+            "token_rate": args.token_rate,
+            "answer_tokens": args.answer_tokens,
+            "stream": args.stream,
+            "warm": args.warm,
+            "analytics": not args.no_analytics,
+            "speculative": args.speculative,
+            "full_prompts": args.full_prompts,
+            "fulltext": not args.no_fulltext,
+            "engine": args.engine,
+        },
+        "levels": levels,
+        "llm_requests": mock.requests if mock else None,
+        "tracemalloc_peak_mb": round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 1) if args.tracemalloc else None,
+    }
+    if isinstance(server.db, EngineFirst):
+        report["graph_engine"] = server.db.stats()
+    standin = getattr(server.db, "database", server.db)
+    if isinstance(standin, StandInGraph) and standin.unknown:
+        print(f"warning: {standin.unknown} queries had no recorded rows", file=sys.stderr)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            problems = compare(report, json.load(f), args.max_regression)
+        for problem in problems:
+            print(f"REGRESSION {problem}", file=sys.stderr)
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""
+Literal lifting for generated Cypher.
+
+The LLM inlines every value ({id: 'jeff.dasovich@enron.com'},
+datetime("1997-09-10T08:00:00")), so each new address is a new query text
+that Neo4j has to parse and plan again, and the value is spliced into the
+query. `parameterize` turns string literals (and numbers compared against)
+into $params, so questions that differ only in their values share one
+template and one cached plan.
+"""
+import os
+import re
+import threading
+from collections import OrderedDict
+
+from result_cache import canonicalize_cypher
+
+PREPARED_CACHE_SIZE = int(os.getenv("PREPARED_CACHE_SIZE", "2048"))
+
+# String literal, or a number right after a comparison operator
+LITERAL_RX = re.compile(
+    r"'((?:[^'\\]|\\.)*)'"
+    r"|\"((?:[^\"\\]|\\.)*)\""
+    r"|(?<=[=<>])(\s*)(-?\d+(?:\.\d+)?)\b(?!\s*\.\.)"
+)
+ESCAPE_RX = re.compile(r"\\(.)")
+
+
+def _unescape(text):
+    return ESCAPE_RX.sub(lambda m: {"n": "\n", "t": "\t"}.get(m.group(1), m.group(1)), text)
+
+
+def parameterize(query):
+    """
+    Return (template, params): `query` with its literals replaced by $p0,
+    $p1, ... (equal values share a parameter) and the values to bind.
+    """
+    params = {}
+    names = {}
+
+    def slot(value):
+        key = (type(value), value)
+        if key not in names:
+            names[key] = f"p{len(names)}"
+            params[names[key]] = value
+        return "$" + names[key]
+
+    def repl(m):
+        if m.group(1) is not None:
+            return slot(_unescape(m.group(1)))
+        if m.group(2) is not None:
+            return slot(_unescape(m.group(2)))
+        number = m.group(4)
+        return m.group(3) + slot(float(number) if "." in number else int(number))
+
+    return LITERAL_RX.sub(repl, query), params
+
+
+class PreparedQueries:
+    """
+    LRU of generated query text -> (template, params), plus how often each
+    template has been executed. A template seen before means Neo4j can
+    reuse the plan it cached for it; `stats()` reports that reuse rate.
+    """
+
+    def __init__(self, max_entries=PREPARED_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.executions = 0
+        self.template_reuses = 0
+        self._prepared = OrderedDict()  # canonical query -> (template, params)
+        self._templates = OrderedDict()  # template -> executions
+        self._lock = threading.Lock()
+
+    def prepare(self, query):
+        key = canonicalize_cypher(query)
+        with self._lock:
+            prepared = self._prepared.get(key)
+            if prepared is not None:
+                self._prepared.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+        if prepared is None:
+            prepared = parameterize(key)
+            with self._lock:
+                self._prepared[key] = prepared
+                while len(self._prepared) > self.max_entries:
+                    self._prepared.popitem(last=False)
+        template, params = prepared
+        with self._lock:
+            self.executions += 1
+            if template in self._templates:
+                self.template_reuses += 1
+                self._templates[template] += 1
+                self._templates.move_to_end(template)
+            else:
+                self._templates[template] = 1
+                while len(self._templates) > self.max_entries:
+                    self._templates.popitem(last=False)
+        return template, dict(params)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._prepared),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "templates": len(self._templates),
+                "executions": self.executions,
+                "template_reuse_rate": self.template_reuses / self.executions if self.executions else 0.0,
+            }
@@ -0,0 +1,238 @@
+"""
+The graph schema the prompts describe, and a static check of generated
+Cypher against it, so a query naming an unknown label, relationship type
+or property, pointing a relationship the wrong way, missing its RETURN,
+leaving a string open or trying to write is caught before it reaches
+Neo4j. `repair` fixes the common mistakes deterministically, so only what
+it can't fix costs another LLM round trip.
+"""
+import re
+
+NODE_PROPERTIES = {
+    "Email": {"id", "date_time", "subject", "content", "relevant", "analysis"},
+    "Person": {"id"},
+    "Topic": {"name"},
+}
+RELATIONSHIP_PROPERTIES = {
+    "SEND": set(),
+    "RECEIVE": set(),
+    "Cc": set(),
+    "Bcc": set(),
+    "RESPONSIVE": {"analysis"},
+}
+# (source label, target label) of each relationship type
+RELATIONSHIP_ENDPOINTS = {
+    "SEND": ("Person", "Email"),
+    "RECEIVE": ("Person", "Email"),
+    "Cc": ("Person", "Email"),
+    "Bcc": ("Person", "Email"),
+    "RESPONSIVE": ("Email", "Topic"),
+}
+# Spellings the LLM produces, folded case-insensitively to the real names
+LABEL_ALIASES = {name.lower(): name for name in NODE_PROPERTIES}
+REL_TYPE_ALIASES = {name.lower(): name for name in RELATIONSHIP_PROPERTIES}
+REL_TYPE_ALIASES.update({"sent": "SEND", "sends": "SEND", "received": "RECEIVE", "receives": "RECEIVE",
+                         "recieve": "RECEIVE", "cced": "Cc", "bcced": "Bcc"})
+PROPERTY_ALIASES = {
+    "Email": {"date": "date_time", "datetime": "date_time", "sent_date": "date_time", "timestamp": "date_time",
+              "body": "content", "text": "content", "message": "content", "title": "subject",
+              "message_id": "id"},
+    "Person": {"email": "id", "address": "id", "email_address": "id"},
+    "Topic": {"id": "name", "title": "name"},
+}
+# Procedures generated queries may CALL; everything else could write
+READ_ONLY_PROCEDURES = {"db.index.fulltext.querynodes"}
+
+STRING_RX = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+NODE_RX = re.compile(r"\(\s*(\w*)\s*((?::\s*`?\w+`?\s*)+)")
+REL_RX = re.compile(r"\[\s*(\w*)\s*:\s*([\w`|:\s]+?)\s*(?:\*[\d.]*\s*)?(?:\{|\])")
+PROPERTY_RX = re.compile(r"\b(\w+)\.(\w+)\b")
+WRITE_RX = re.compile(r"\b(CREATE|MERGE|SET|DELETE|DETACH|REMOVE|DROP|FOREACH|LOAD\s+CSV)\b", re.IGNORECASE)
+CALL_RX = re.compile(r"\bCALL\s+([\w.]+|\{)", re.IGNORECASE)
+RETURN_RX = re.compile(r"\bRETURN\b", re.IGNORECASE)
+NODE_TEXT_RX = re.compile(r"\(\s*(\w*)\s*(?::\s*`?(\w+)`?)?[^()]*\)")
+# node, arrow tail, relationship, arrow head; the next node is a lookahead so hops in a chain overlap
+HOP_RX = re.compile(r"(\([^()]*\))\s*(<-|-)\s*\[([^\[\]]*)\]\s*(->|-)\s*(?=(\([^()]*\)))")
+REL_TYPES_RX = re.compile(r":\s*([\w`|:\s]+?)\s*(?:\*|\{|$)")
+LABEL_TOKEN_RX = re.compile(r":\s*`?(\w+)`?")
+UNQUOTED_EMAIL_RX = re.compile(r"((?:[:=,\[]|\bCONTAINS\b)\s*)([\w.+-]+@[\w-]+(?:\.[\w-]+)+)", re.IGNORECASE)
+PREFIX_RX = re.compile(r"^\s*cypher(?:\s+query)?\s*:?\s*(?=(?:MATCH|OPTIONAL|WITH|CALL|UNWIND|RETURN)\b)",
+                       re.IGNORECASE)
+SMART_QUOTES = str.maketrans({"\u2018": "'", "\u2019": "'", "\u201c": '"', "\u201d": '"'})
+
+
+class CypherValidationError(Exception):
+    """A generated query doesn't fit the schema; handled like a syntax error."""
+
+
+def mask_strings(query):
+    """Blank out string literals (keeping their length) so keywords inside them aren't matched."""
+    return STRING_RX.sub(lambda m: m.group(0)[0] + "_" * (len(m.group(0)) - 2) + m.group(0)[-1], query)
+
+
+def _apply(query, edits):
+    """Apply (start, end, replacement) edits found on the masked copy; masking keeps offsets."""
+    for start, end, replacement in sorted(edits, reverse=True):
+        query = query[:start] + replacement + query[end:]
+    return query
+
+
+def _label(name):
+    return LABEL_ALIASES.get(name.lower(), name)
+
+
+def _variable_labels(masked):
+    labels = {}
+    for m in NODE_TEXT_RX.finditer(masked):
+        if m.group(1) and m.group(2):
+            labels[m.group(1)] = _label(m.group(2))
+    return labels
+
+
+def _node_label(node, labels):
+    m = NODE_TEXT_RX.match(node)
+    if m is None:
+        return None
+    return _label(m.group(2)) if m.group(2) else labels.get(m.group(1))
+
+
+def _reversed_hops(masked):
+    """(start, end, flipped text, type) of each relationship drawn against the schema's direction."""
+    labels = _variable_labels(masked)
+    hops = []
+    for m in HOP_RX.finditer(masked):
+        tail, body, head = m.group(2), m.group(3), m.group(4)
+        if (tail == "<-") == (head == "->"):
+            continue  # undirected
+        types = REL_TYPES_RX.search(body)
+        if types is None:
+            continue
+        names = [REL_TYPE_ALIASES.get(t.lower(), t) for t in re.findall(r"\w+", types.group(1))]
+        ends = {RELATIONSHIP_ENDPOINTS.get(name) for name in names}
+        if len(ends) != 1 or None in ends:
+            continue
+        source, target = ends.pop()
+        left, right = _node_label(m.group(1), labels), _node_label(m.group(5), labels)
+        actual = (left, right) if head == "->" else (right, left)
+        if actual == (target, source):
+            rel = "[" + body + "]"
+            flipped = "-" + rel + "->" if tail == "<-" else "<-" + rel + "-"
+            hops.append((m.start(2), m.end(4), flipped, names[0]))
+    return hops
+
+
+def repair(query):
+    """
+    Fix the mistakes that have exactly one sensible correction and return
+    (query, repairs made): a "Cypher:" prefix, typographic quotes, unquoted
+    email addresses, misspelled or wrong-case labels and relationship
+    types, known property misnomers, relationships drawn backwards and a
+    missing RETURN.
+    """
+    repairs = []
+    fixed = PREFIX_RX.sub("", query).translate(SMART_QUOTES)
+    if fixed != query:
+        repairs.append("removed prefix or typographic quotes")
+
+    masked = mask_strings(fixed)
+    edits = []
+    for m in UNQUOTED_EMAIL_RX.finditer(masked):
+        edits.append((m.start(2), m.end(2), f"'{m.group(2)}'"))
+        repairs.append(f"quoted {m.group(2)}")
+    for m in NODE_RX.finditer(masked):
+        for token in LABEL_TOKEN_RX.finditer(m.group(2)):
+            name, wanted = token.group(1), LABEL_ALIASES.get(token.group(1).lower())
+            if wanted and wanted != name:
+                start = m.start(2) + token.start(1)
+                edits.append((start, start + len(name), wanted))
+                repairs.append(f":{name} -> :{wanted}")
+    for m in REL_RX.finditer(masked):
+        for token in re.finditer(r"\w+", m.group(2)):
+            name, wanted = token.group(0), REL_TYPE_ALIASES.get(token.group(0).lower())
+            if wanted and wanted != name:
+                start = m.start(2) + token.start()
+                edits.append((start, start + len(name), wanted))
+                repairs.append(f":{name} -> :{wanted}")
+    fixed = _apply(fixed, edits)
+
+    masked = mask_strings(fixed)
+    labels = _variable_labels(masked)
+    edits = []
+    for m in PROPERTY_RX.finditer(masked):
+        label, prop = labels.get(m.group(1)), m.group(2)
+        if label in NODE_PROPERTIES and prop not in NODE_PROPERTIES[label]:
+            wanted = PROPERTY_ALIASES[label].get(prop.lower())
+            if wanted:
+                edits.append((m.start(2), m.end(2), wanted))
+                repairs.append(f"{m.group(1)}.{prop} -> {m.group(1)}.{wanted}")
+    for start, end, flipped, rel_type in _reversed_hops(masked):
+        edits.append((start, end, flipped))
+        repairs.append(f"reversed :{rel_type}")
+    fixed = _apply(fixed, edits)
+
+    masked = mask_strings(fixed)
+    if not RETURN_RX.search(masked) and not _unterminated(masked):
+        labels = _variable_labels(masked)
+        returned = [var for var, label in labels.items() if label == "Email"] or list(labels)
+        if returned:
+            fixed = fixed.rstrip().rstrip(";").rstrip() + "\nRETURN " + ", ".join(returned)
+            repairs.append("added RETURN " + ", ".join(returned))
+    return fixed, repairs
+
+
+def _unterminated(masked):
+    rest = STRING_RX.sub("", masked)
+    return "'" in rest or '"' in rest
+
+
+def schema_summary():
+    """The schema in a few lines, for prompts that only need to fix a query."""
+    lines = ["Graph schema:"]
+    for label, props in NODE_PROPERTIES.items():
+        lines.append(f"(:{label} {{{', '.join(sorted(props))}}})")
+    for rel_type, (source, target) in RELATIONSHIP_ENDPOINTS.items():
+        props = RELATIONSHIP_PROPERTIES[rel_type]
+        lines.append(f"(:{source})-[:{rel_type}{' {' + ', '.join(sorted(props)) + '}' if props else ''}]->(:{target})")
+    lines.append("Person ids are email addresses. Queries must be read-only and end with RETURN.")
+    return "\n".join(lines)
+
+
+def validate(query):
+    """Return a list of problems with `query`; empty if it fits the schema."""
+    masked = mask_strings(query)
+    problems = []
+    if _unterminated(masked):
+        problems.append("Unterminated string literal")
+    if not RETURN_RX.search(masked):
+        problems.append("Missing RETURN clause")
+    write = WRITE_RX.search(masked)
+    if write:
+        problems.append(f"{write.group(1).upper()} is not allowed, queries must be read-only")
+    for call in CALL_RX.finditer(masked):
+        name = call.group(1)
+        if name != "{" and name.lower() not in READ_ONLY_PROCEDURES:
+            problems.append(f"Procedure {name} is not allowed")
+
+    variables = {}
+    for var, labels in NODE_RX.findall(masked):
+        for label in re.findall(r"\w+", labels):
+            if label not in NODE_PROPERTIES:
+                problems.append(f"Unknown node label :{label} (expected one of {', '.join(NODE_PROPERTIES)})")
+            elif var:
+                variables[var] = NODE_PROPERTIES[label]
+    for var, types in REL_RX.findall(masked):
+        for rel_type in re.findall(r"\w+", types):
+            if rel_type not in RELATIONSHIP_PROPERTIES:
+                problems.append(f"Unknown relationship type :{rel_type} "
+                                f"(expected one of {', '.join(RELATIONSHIP_PROPERTIES)})")
+            elif var:
+                variables[var] = RELATIONSHIP_PROPERTIES[rel_type]
+    for var, prop in PROPERTY_RX.findall(masked):
+        allowed = variables.get(var)
+        if allowed is not None and prop not in allowed:
+            problems.append(f"Unknown property {var}.{prop}")
+    for _, _, _, rel_type in _reversed_hops(masked):
+        source, target = RELATIONSHIP_ENDPOINTS[rel_type]
+        problems.append(f"Relationship :{rel_type} goes from :{source} to :{target}")
+    # Keep the order stable but drop repeats
+    return list(dict.fromkeys(problems))
@@ -0,0 +1,221 @@
+"""
+Neo4j access for the server.
+
+One driver per process, with a bounded connection pool and acquisition
+timeout so a burst of requests waits briefly and then fails instead of
+queueing forever. Every query the server sends is a read, so it runs in
+a read transaction:
+
+- `execute_cypher` in a managed one (`execute_read`), which the driver
+  retries on transient errors and leader changes;
+- `stream_cypher` in an explicit one, since rows are handed out while the
+  transaction is open. Failures are retried the same way until the first
+  batch has gone out.
+
+Both carry a server-side timeout (NEO4J_QUERY_TIMEOUT), so a runaway
+generated query is stopped by Neo4j instead of holding a connection and
+the database's memory. With a `neo4j://` NEO4J_URI the driver routes
+these reads to the cluster's followers and read replicas.
+"""
+import os
+import time
+import threading
+import logging
+from contextlib import contextmanager
+
+from neo4j import GraphDatabase, Query, READ_ACCESS, unit_of_work
+from neo4j.exceptions import TransientError, ServiceUnavailable, SessionExpired
+
+import metrics
+from result_cache import ResultCache
+from dataset_version import GenerationWatcher
+
+logger = logging.getLogger(__name__)
+
+# None: the server's default (home) database, resolved with an extra round trip
+NEO4J_DATABASE = os.getenv("NEO4J_DATABASE") or None
+NEO4J_POOL_SIZE = int(os.getenv("NEO4J_POOL_SIZE", "50"))
+# Seconds to wait for a free pooled connection, and to open a new one
+NEO4J_ACQUIRE_TIMEOUT = float(os.getenv("NEO4J_ACQUIRE_TIMEOUT", "5"))
+NEO4J_CONNECT_TIMEOUT = float(os.getenv("NEO4J_CONNECT_TIMEOUT", "5"))
+# Connections are recycled after this long (stay under any proxy / LB idle cutoff)
+NEO4J_CONNECTION_LIFETIME = float(os.getenv("NEO4J_CONNECTION_LIFETIME", "3600"))
+# Server-side transaction timeout in seconds; 0 leaves the server's dbms.transaction.timeout
+NEO4J_QUERY_TIMEOUT = float(os.getenv("NEO4J_QUERY_TIMEOUT", "30"))
+# Records per PULL from the server while streaming; -1 fetches everything at once
+NEO4J_FETCH_SIZE = int(os.getenv("NEO4J_FETCH_SIZE", "1000"))
+# Total time spent retrying a read after transient failures
+NEO4J_RETRY_SECONDS = float(os.getenv("NEO4J_RETRY_SECONDS", "15"))
+# Rows per batch when streaming results off the Neo4j cursor
+ROW_BATCH_SIZE = int(os.getenv("ROW_BATCH_SIZE", "50"))
+
+RETRYABLE = (TransientError, ServiceUnavailable, SessionExpired)
+TX_METADATA = {"app": "chatbox"}
+
+
+class Neo4jDatabase:
+    """The server's Neo4j reads, with their results cached per dataset generation."""
+
+    def __init__(self, uri, user, password):
+        self.driver = GraphDatabase.driver(
+            uri, auth=(user, password),
+            max_connection_pool_size=NEO4J_POOL_SIZE,
+            connection_acquisition_timeout=NEO4J_ACQUIRE_TIMEOUT,
+            connection_timeout=NEO4J_CONNECT_TIMEOUT,
+            max_connection_lifetime=NEO4J_CONNECTION_LIFETIME,
+            max_transaction_retry_time=NEO4J_RETRY_SECONDS,
+        )
+        # Read results are cached until the import job bumps the dataset generation
+        self.generation = GenerationWatcher(self.driver)
+        self.result_cache = ResultCache()
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def close(self):
+        self.driver.close()
+
+    def session(self, **config):
+        return read_session(self.driver, **config)
+
+    def execute_cypher(self, query, params=None):
+        if not ResultCache.cacheable(query):
+            return self._read(query, params)
+        key = ResultCache.make_key(query, params)
+        generation = self.generation.current()
+        rows = self.result_cache.get(key, generation)
+        if rows is None:
+            rows = self._read(query, params)
+            self.result_cache.put(key, rows, generation)
+        return rows
+
+    def stream_cypher(self, query, params=None, batch_size=ROW_BATCH_SIZE):
+        """Yield result rows in lists of up to `batch_size` as they come off the cursor."""
+        if not ResultCache.cacheable(query):
+            yield from self._stream(query, params, batch_size)
+            return
+        key = ResultCache.make_key(query, params)
+        generation = self.generation.current()
+        rows = self.result_cache.get(key, generation)
+        if rows is not None:
+            yield from _batched(rows, batch_size)
+            return
+        rows = []
+        for batch in self._stream(query, params, batch_size):
+            rows.extend(batch)
+            yield batch
+        self.result_cache.put(key, rows, generation)
+
+    def _read(self, query, params):
+        """All rows of `query`, from a managed read transaction."""
+        requested = time.perf_counter()
+
+        @unit_of_work(timeout=NEO4J_QUERY_TIMEOUT or None, metadata=TX_METADATA)
+        def work(tx):
+            _acquired(requested)
+            return [_plain(record.data()) for record in tx.run(query, params)]
+
+        try:
+            with self._busy(), self.session() as session:
+                return session.execute_read(work)
+        except Exception as e:
+            _count_failure(e)
+            raise
+
+    def _stream(self, query, params, batch_size):
+        deadline = time.monotonic() + NEO4J_RETRY_SECONDS
+        delay = 0.5
+        while True:
+            sent = False
+            try:
+                requested = time.perf_counter()
+                with self._busy(), self.session() as session:
+                    with session.begin_transaction(metadata=TX_METADATA,
+                                                   timeout=NEO4J_QUERY_TIMEOUT or None) as tx:
+                        _acquired(requested)
+                        for batch in _batched((_plain(record.data()) for record in tx.run(query, params)),
+                                              batch_size):
+                            sent = True
+                            yield batch
+                        # Read-only, so there is nothing to commit; closing rolls back
+                return
+            except RETRYABLE as e:
+                # Rows already handed out can't be taken back
+                if sent or time.monotonic() + delay > deadline:
+                    raise
+                logger.info("Transient Neo4j failure, retrying in %.1fs: %s", delay, e)
+                metrics.registry.inc("neo4j_read_retries_total")
+                time.sleep(delay)
+                delay *= 2
+            except Exception as e:
+                _count_failure(e)
+                raise
+
+    @contextmanager
+    def _busy(self):
+        with self._lock:
+            self.in_flight += 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    def pool_stats(self):
+        """Connections per server by state, from the driver's pool, plus reads in flight here."""
+        stats = {"max_size": NEO4J_POOL_SIZE, "in_flight": self.in_flight, "servers": {}}
+        # The driver has no public pool statistics; skip them if its internals change
+        pool = getattr(self.driver, "_pool", None)
+        try:
+            with pool.lock:
+                for address, connections in pool.connections.items():
+                    in_use = sum(1 for connection in connections if connection.in_use)
+                    stats["servers"][str(address)] = {"in_use": in_use, "idle": len(connections) - in_use}
+        except Exception:
+            pass
+        return stats
+
+
+def read_session(driver, **config):
+    """A read session on `driver` with the configured database and fetch size."""
+    return driver.session(database=NEO4J_DATABASE, default_access_mode=READ_ACCESS,
+                          fetch_size=NEO4J_FETCH_SIZE, **config)
+
+
+def read_query(query, timeout=NEO4J_QUERY_TIMEOUT):
+    """`query` for `session.run`, with a server-side timeout (by default the managed reads') and metadata."""
+    return Query(query, timeout=timeout or None, metadata=TX_METADATA)
+
+
+def _acquired(requested):
+    # Pool wait, routing and BEGIN: what a read waits for before its query runs
+    metrics.registry.observe("neo4j_acquire_seconds", time.perf_counter() - requested)
+
+
+def _count_failure(e):
+    code = getattr(e, "code", None) or ""
+    if "TransactionTimedOut" in code:
+        metrics.registry.inc("neo4j_query_timeouts_total")
+    elif "failed to obtain a connection from the pool" in str(e):
+        metrics.registry.inc("neo4j_acquire_timeouts_total")
+
+
+def _plain(value):
+    """Neo4j temporal values as ISO strings, so rows are plain JSON."""
+    if isinstance(value, dict):
+        return {k: _plain(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_plain(v) for v in value]
+    if hasattr(value, 'iso_format'):
+        return value.iso_format()
+    return value
+
+
+def _batched(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
@@ -0,0 +1,70 @@
+import os
+import time
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+DATASET_POLL_SECONDS = float(os.getenv("DATASET_POLL_SECONDS", "5"))
+
+# The import job bumps this counter every time it writes to the graph;
+# anything cached from the graph is only valid for the generation it was read at.
+GENERATION_QUERY = """
+MATCH (d:DatasetVersion {id: 'default'})
+RETURN d.generation AS generation
+"""
+
+BUMP_GENERATION_QUERY = """
+MERGE (d:DatasetVersion {id: 'default'})
+SET d.generation = coalesce(d.generation, 0) + 1,
+    d.updated_at = datetime()
+RETURN d.generation AS generation
+"""
+
+
+def bump_generation(tx):
+    """Transaction function for import jobs: mark the dataset as changed."""
+    record = tx.run(BUMP_GENERATION_QUERY).single()
+    return record["generation"]
+
+
+class GenerationWatcher:
+    """
+    Cheap view of the dataset generation: reads it from Neo4j at most once
+    every `poll_seconds` and serves the last value in between.
+    """
+
+    def __init__(self, driver, poll_seconds=DATASET_POLL_SECONDS):
+        self.driver = driver
+        self.poll_seconds = poll_seconds
+        self._generation = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def current(self):
+        now = time.monotonic()
+        if self._generation is not None and now - self._checked_at < self.poll_seconds:
+            return self._generation
+        with self._lock:
+            if self._generation is None or now - self._checked_at >= self.poll_seconds:
+                # database.py imports this module
+                from database import read_session, read_query
+
+                try:
+                    with read_session(self.driver) as session:
+                        record = session.run(read_query(GENERATION_QUERY)).single()
+                    generation = record["generation"] if record else 0
+                    if generation != self._generation:
+                        logger.info("Dataset generation is now %s", generation)
+                    self._generation = generation
+                except Exception as e:
+                    # Keep serving the last known value if Neo4j is unreachable
+                    logger.warning("Could not read dataset generation: %s", e)
+                    if self._generation is None:
+                        self._generation = 0
+                self._checked_at = now
+        return self._generation
+
+    def refresh(self):
+        """Force the next current() call to hit Neo4j."""
+        self._checked_at = 0.0
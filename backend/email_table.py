@@ -0,0 +1,221 @@
+"""
+Columnar copy of an email CSV, converted once and memory-mapped after.
+
+The CSV is slow to parse: multi-line quoted bodies, and several large text
+columns nothing here reads. Every reader also re-splits To/Cc/Bcc.
+`convert` writes the columns that matter as uncompressed Arrow IPC files in
+a directory:
+
+    persons.arrow  every address, interned: person n is row n
+    emails.arrow   one row per email: id, date_time (parsed once), subject,
+                   content (the segmented_content column), relevant,
+                   analysis, responsive, sender (a person number) and
+                   to / cc / bcc (lists of person numbers, stored as one
+                   offsets array plus the values)
+
+Opening a table maps the files, so a column is only read from disk when
+it is used. The person index touches persons.arrow alone, and items
+without content never touch the email text. `read_chunks` yields the same
+dicts as ingest.parse_chunk, from a table or straight from a CSV, so every
+loader takes either.
+
+    cd backend
+    python email_table.py --csv Prompt_Eng_Topic_303_2-20.csv --out emails_table
+    python ingest.py --csv emails_table
+"""
+import os
+import argparse
+import logging
+
+import pandas as pd
+import pyarrow as pa
+
+logger = logging.getLogger(__name__)
+
+# A converted table the server reads Person ids from at startup; '' = ask Neo4j
+EMAIL_TABLE_PATH = os.getenv("EMAIL_TABLE_PATH", "")
+
+FORMAT_VERSION = "1"
+EMAILS_FILE = "emails.arrow"
+PERSONS_FILE = "persons.arrow"
+CHUNK_SIZE = 2000
+CSV_COLUMNS = ["MessageID", "Date", "From", "To", "Cc", "Bcc", "Subject", "segmented_content", "Relevant",
+               "Analysis"]
+# Table column -> CSV column, relationship type (as ingest.RECIPIENT_COLUMNS)
+RECIPIENT_FIELDS = {"to": ("To", "RECEIVE"), "cc": ("Cc", "Cc"), "bcc": ("Bcc", "Bcc")}
+
+EMAILS_SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("date_time", pa.timestamp("s")),
+    ("subject", pa.string()),
+    ("content", pa.string()),
+    ("relevant", pa.string()),
+    ("analysis", pa.string()),
+    ("responsive", pa.bool_()),
+    ("sender", pa.int32()),
+    ("to", pa.list_(pa.int32())),
+    ("cc", pa.list_(pa.int32())),
+    ("bcc", pa.list_(pa.int32())),
+])
+
+
+def _text(values):
+    return [None if pd.isna(value) else str(value) for value in values]
+
+
+def _dates(values):
+    """ISO strings as naive UTC timestamps; ones with an offset are converted, unparseable ones are null."""
+    parsed = pd.to_datetime(pd.Series(values, dtype=object), errors="coerce", format="ISO8601", utc=True)
+    return pa.array(parsed.dt.tz_localize(None).astype("datetime64[s]"), type=pa.timestamp("s"))
+
+
+def _batch(chunk, persons):
+    """One record batch for a CSV chunk, interning its addresses into `persons` (address -> number)."""
+    from ingest import clean, split_addresses
+
+    chunk = chunk[chunk["MessageID"].notna()]
+    relevant = [clean(value) for value in chunk["Relevant"]]
+    senders = [None if pd.isna(value) else persons.setdefault(value, len(persons)) for value in chunk["From"]]
+    columns = {
+        "id": pa.array(_text(chunk["MessageID"]), pa.string()),
+        "date_time": _dates(chunk["Date"]),
+        "subject": pa.array(_text(chunk["Subject"]), pa.string()),
+        "content": pa.array(_text(chunk["segmented_content"]), pa.string()),
+        "relevant": pa.array(relevant, pa.string()),
+        "analysis": pa.array(_text(chunk["Analysis"]), pa.string()),
+        "responsive": pa.array([value == "yes" for value in relevant], pa.bool_()),
+        "sender": pa.array(senders, pa.int32()),
+    }
+    for field, (column, _) in RECIPIENT_FIELDS.items():
+        offsets, values = [0], []
+        for cell in chunk[column]:
+            values.extend(persons.setdefault(address, len(persons)) for address in split_addresses(cell))
+            offsets.append(len(values))
+        columns[field] = pa.ListArray.from_arrays(pa.array(offsets, pa.int32()), pa.array(values, pa.int32()))
+    return pa.record_batch([columns[name] for name in EMAILS_SCHEMA.names], schema=EMAILS_SCHEMA)
+
+
+def convert(csv_path, out=EMAIL_TABLE_PATH or "emails_table", chunk_size=CHUNK_SIZE):
+    """Write `csv_path` as a table under `out`; returns the number of emails."""
+    os.makedirs(out, exist_ok=True)
+    stat = os.stat(csv_path)
+    schema = EMAILS_SCHEMA.with_metadata({"version": FORMAT_VERSION, "source": os.path.abspath(csv_path),
+                                          "source_size": str(stat.st_size),
+                                          "source_mtime": str(stat.st_mtime)})
+    persons, emails = {}, 0
+    emails_path, persons_path = os.path.join(out, EMAILS_FILE), os.path.join(out, PERSONS_FILE)
+    with pa.OSFile(emails_path + ".tmp", "wb") as sink, pa.ipc.new_file(sink, schema) as writer:
+        for chunk in pd.read_csv(csv_path, chunksize=chunk_size, usecols=CSV_COLUMNS, dtype=str):
+            batch = _batch(chunk, persons)
+            writer.write_batch(batch)
+            emails += batch.num_rows
+    with pa.OSFile(persons_path + ".tmp", "wb") as sink:
+        table = pa.table({"id": pa.array(list(persons), pa.string())})
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(persons_path + ".tmp", persons_path)
+    os.replace(emails_path + ".tmp", emails_path)
+    logger.info("Converted %s: %d emails, %d persons -> %s", csv_path, emails, len(persons), out)
+    return emails
+
+
+def _open(path):
+    # Zero-copy: the table's buffers are the mapped file
+    return pa.ipc.open_file(pa.memory_map(path)).read_all()
+
+
+class EmailTable:
+    """A table written by `convert`, memory-mapped."""
+
+    def __init__(self, path):
+        self.path = path
+        self.emails = _open(os.path.join(path, EMAILS_FILE))
+        metadata = self.emails.schema.metadata or {}
+        if metadata.get(b"version") != FORMAT_VERSION.encode():
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} email table; convert the CSV again")
+        self._persons = None
+
+    def check_source(self):
+        """Raise ValueError unless the CSV the table was converted from is still there, unchanged."""
+        metadata = self.emails.schema.metadata
+        source = metadata.get(b"source", b"").decode()
+        try:
+            stat = os.stat(source)
+        except OSError:
+            raise ValueError(f"the CSV {self.path} was converted from ({source or 'unknown'}) is gone")
+        converted = (metadata.get(b"source_size", b"").decode(), metadata.get(b"source_mtime", b"").decode())
+        if converted != (str(stat.st_size), str(stat.st_mtime)):
+            raise ValueError(f"{source} has changed since {self.path} was converted; convert it again")
+
+    def __len__(self):
+        return self.emails.num_rows
+
+    def person_ids(self):
+        """Every address, indexed by person number."""
+        if self._persons is None:
+            self._persons = _open(os.path.join(self.path, PERSONS_FILE)).column("id").to_pylist()
+        return self._persons
+
+    def items(self, start=0, stop=None, content=True):
+        """Emails [start, stop) as ingest.parse_chunk returns them; without `content` the text is never read."""
+        rows = self.emails.slice(start, (stop if stop is not None else len(self)) - start)
+        persons = self.person_ids()
+        columns = {name: rows.column(name).to_pylist()
+                   for name in ("id", "subject", "relevant", "analysis", "responsive", "sender", "to", "cc", "bcc")}
+        dates = rows.column("date_time").to_pylist()
+        texts = rows.column("content").to_pylist() if content else [None] * rows.num_rows
+        items = []
+        for i, email_id in enumerate(columns["id"]):
+            edges = set()
+            if columns["sender"][i] is not None:
+                edges.add(("SEND", persons[columns["sender"][i]]))
+            for field, (_, rel_type) in RECIPIENT_FIELDS.items():
+                edges.update((rel_type, persons[person]) for person in columns[field][i])
+            items.append({
+                "email": {
+                    "id": email_id,
+                    "date": dates[i].isoformat() if dates[i] is not None else None,
+                    "subject": columns["subject"][i],
+                    "content": texts[i],
+                    "relevant": columns["relevant"][i],
+                    "analysis": columns["analysis"][i],
+                },
+                "edges": sorted(list(edge) for edge in edges),
+                "responsive": columns["responsive"][i],
+            })
+        return items
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE, content=True):
+    """
+    Lists of at most `chunk_size` emails as ingest.parse_chunk returns them,
+    from a directory written by `convert` or from a CSV.
+    """
+    if os.path.isdir(path):
+        table = EmailTable(path)
+        for start in range(0, len(table), chunk_size):
+            yield table.items(start, start + chunk_size, content=content)
+        return
+    from ingest import parse_chunk
+
+    for chunk in pd.read_csv(path, chunksize=chunk_size):
+        yield parse_chunk(chunk)
+
+
+def read_items(path, content=True):
+    """Every email in `path` (a converted table or a CSV), as ingest.parse_chunk returns them."""
+    return [item for chunk in read_chunks(path, chunk_size=10 ** 6, content=content) for item in chunk]
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Convert an email CSV to a memory-mapped columnar table.")
+    parser.add_argument("--csv", default="Prompt_Eng_Topic_303_2-20.csv")
+    parser.add_argument("--out", default=EMAIL_TABLE_PATH or "emails_table", help="directory to write")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="CSV rows read per chunk")
+    args = parser.parse_args(argv)
+    convert(args.csv, args.out, chunk_size=args.chunk_size)
+
+
+if __name__ == "__main__":
+    main()
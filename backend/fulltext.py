@@ -0,0 +1,413 @@
+"""
+Index lookups for keyword predicates in generated Cypher.
+
+The LLM can only express a keyword question as `e.content CONTAINS '...'`,
+which Neo4j answers by reading the content of every Email. `rewrite`
+wraps each such predicate on Email.subject/content/analysis as
+
+    (e.id IN $ft_content_p0 AND e.content CONTAINS $p0)
+
+where the ids are the emails a full-text index says can contain the
+value. The original predicate stays, so results are exactly what the
+query asked for, but Neo4j starts from a unique-index seek on the few
+candidates instead of a scan. A predicate that isn't a plain AND-ed term
+of a WHERE (under NOT or OR, say) is wrapped as
+
+    ((e.id IN $ft_content_p0 OR e.content IS NULL) AND e.content CONTAINS $p0)
+
+instead, so an email without the property still gives null, not false.
+Two backends give the candidates:
+
+- neo4j: the `email_text` full-text index ingest.py creates, queried with
+  db.index.fulltext.queryNodes (Lucene, maintained by Neo4j on write)
+- local: TextIndex, an inverted index over the same fields that ingest.py
+  keeps next to the analytics (FULLTEXT_PATH)
+
+Either way a value the index can't narrow down (no word characters, or
+matching more than FULLTEXT_MAX_IDS emails, or more than FULLTEXT_MAX_RATIO
+of them) is left as a plain scan.
+"""
+import os
+import re
+import bisect
+import threading
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FULLTEXT_PATH = os.getenv("FULLTEXT_PATH", "fulltext.npz")
+# local, neo4j, off; auto uses the local index when FULLTEXT_PATH exists, else Neo4j's
+FULLTEXT_BACKEND = os.getenv("FULLTEXT_BACKEND", "auto")
+FULLTEXT_MAX_IDS = int(os.getenv("FULLTEXT_MAX_IDS", "5000"))
+# Past this share of all emails the id list costs more than the scan it saves
+FULLTEXT_MAX_RATIO = float(os.getenv("FULLTEXT_MAX_RATIO", "0.2"))
+FULLTEXT_INDEX_NAME = "email_text"
+TEXT_FIELDS = ("subject", "content", "analysis")
+
+CREATE_FULLTEXT_INDEX = (f"CREATE FULLTEXT INDEX {FULLTEXT_INDEX_NAME} IF NOT EXISTS "
+                         f"FOR (e:Email) ON EACH [{', '.join('e.' + field for field in TEXT_FIELDS)}]")
+FULLTEXT_QUERY = ("CALL db.index.fulltext.queryNodes($index, $query) YIELD node "
+                  "RETURN node.id AS id LIMIT $limit")
+
+WORD_RX = re.compile(r"\w+")
+# e.content CONTAINS $p0, toLower(e.content) CONTAINS $p0 or ... CONTAINS toLower($p0)
+CONTAINS_RX = re.compile(
+    r"(?P<lower>toLower\(\s*)?\b(?P<var>\w+)\.(?P<field>" + "|".join(TEXT_FIELDS) + r")\b(?(lower)\s*\))"
+    r"\s+CONTAINS\s+(?P<plower>toLower\(\s*)?\$(?P<param>\w+)(?(plower)\s*\))",
+    re.IGNORECASE)
+REWRITTEN_RX = re.compile(r"\((?:\w+\.id IN \$ft_\w+|\(\w+\.id IN \$ft_\w+ OR \w+\.\w+ IS NULL\)) AND "
+                          r"(?P<predicate>[^()]*(?:\([^()]*\)[^()]*)*)\)")
+WHERE_RX = re.compile(r"\bWHERE\b", re.IGNORECASE)
+# Where a WHERE clause ends, at its own nesting depth
+CLAUSE_END_RX = re.compile(r"\b(?:RETURN|WITH|MATCH|OPTIONAL|ORDER|SKIP|LIMIT|UNWIND|CALL|UNION)\b", re.IGNORECASE)
+AND_RX = re.compile(r"\bAND\b", re.IGNORECASE)
+EMAIL_VAR_RX = re.compile(r"\(\s*(\w+)\s*:\s*`?Email`?\b")
+
+
+def _token_rules(value):
+    """
+    [(token, rule)] a word must satisfy for `value` to occur in a text:
+    'exact', 'prefix' (the value may continue past it), 'suffix' (it may
+    start mid-word) or 'infix'. Tokens are lowercased, as indexed.
+    """
+    tokens = [(m.group(0).lower(), m.start(), m.end()) for m in WORD_RX.finditer(value)]
+    rules = []
+    for i, (token, start, end) in enumerate(tokens):
+        open_start = i == 0 and start == 0
+        open_end = i == len(tokens) - 1 and end == len(value)
+        rule = {(True, True): "infix", (True, False): "suffix", (False, True): "prefix"}.get(
+            (open_start, open_end), "exact")
+        rules.append((token, rule))
+    return rules
+
+
+def lucene_query(field, value):
+    """A Lucene query matching every `field` that can contain `value`, or None if it can't be expressed."""
+    # Lucene's analyzer splits some punctuation differently; only plain words are translated
+    if not value.strip() or not re.fullmatch(r"[\w ]+", value):
+        return None
+    terms = []
+    for token, rule in _token_rules(value):
+        terms.append({"exact": token, "prefix": f"{token}*", "suffix": f"*{token}", "infix": f"*{token}*"}[rule])
+    return f"{field}:({' AND '.join(terms)})"
+
+
+class TextIndex:
+    """
+    Inverted index over the TEXT_FIELDS of each email: per field, sorted
+    row lists for every lowercased word. Rows of changed or removed emails
+    are marked dead and dropped by `compact`, as in EmailAnalytics.
+    """
+
+    def __init__(self):
+        self.email_ids = []
+        self.alive = np.empty(0, dtype=bool)
+        self._email_row = {}
+        self.postings = {field: {} for field in TEXT_FIELDS}
+        self._vocab = {}
+        self._lookups = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return int(self.alive.sum())
+
+    def upsert(self, items):
+        """Add or replace emails, given as parsed by ingest.parse_chunk."""
+        latest = {item["email"]["id"]: item["email"] for item in items}
+        if not latest:
+            return
+        with self._lock:
+            old = [self._email_row[email_id] for email_id in latest if email_id in self._email_row]
+            alive = np.concatenate([self.alive, np.ones(len(latest), dtype=bool)])
+            alive[old] = False
+            for email_id, email in latest.items():
+                row = len(self.email_ids)
+                self.email_ids.append(email_id)
+                self._email_row[email_id] = row
+                for field in TEXT_FIELDS:
+                    postings = self.postings[field]
+                    for word in set(WORD_RX.findall(str(email.get(field) or "").lower())):
+                        postings.setdefault(word, []).append(row)
+            self.alive = alive
+            self._changed()
+
+    def remove(self, email_ids):
+        with self._lock:
+            rows = [self._email_row.pop(i) for i in email_ids if i in self._email_row]
+            if rows:
+                self.alive[rows] = False
+                self._changed()
+
+    def _changed(self):
+        self._vocab = {}
+        self._lookups.clear()
+
+    def compact(self):
+        """Drop dead rows (before saving)."""
+        with self._lock:
+            if self.alive.all():
+                return
+            remap = np.cumsum(self.alive) - 1
+            for field in TEXT_FIELDS:
+                kept = {}
+                for word, rows in self.postings[field].items():
+                    rows = [int(remap[r]) for r in rows if self.alive[r]]
+                    if rows:
+                        kept[word] = rows
+                self.postings[field] = kept
+            self.email_ids = [i for i, alive in zip(self.email_ids, self.alive) if alive]
+            self._email_row = {email_id: row for row, email_id in enumerate(self.email_ids)}
+            self.alive = np.ones(len(self.email_ids), dtype=bool)
+            self._changed()
+
+    def save(self, path=FULLTEXT_PATH):
+        self.compact()
+        arrays = {"email_ids": np.array(self.email_ids, dtype=str)}
+        for field in TEXT_FIELDS:
+            words = sorted(self.postings[field])
+            lists = [self.postings[field][word] for word in words]
+            arrays[f"{field}_words"] = np.array(words, dtype=str)
+            arrays[f"{field}_offsets"] = np.cumsum([0] + [len(rows) for rows in lists]).astype(np.int64)
+            arrays[f"{field}_rows"] = np.array([r for rows in lists for r in rows], dtype=np.int32)
+        tmp = path + ".tmp.npz"
+        np.savez_compressed(tmp, **arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path=FULLTEXT_PATH):
+        index = cls()
+        with np.load(path) as data:
+            index.email_ids = data["email_ids"].tolist()
+            for field in TEXT_FIELDS:
+                words, offsets, rows = data[f"{field}_words"], data[f"{field}_offsets"], data[f"{field}_rows"]
+                index.postings[field] = {word: rows[offsets[i]:offsets[i + 1]].tolist()
+                                         for i, word in enumerate(words.tolist())}
+        index.alive = np.ones(len(index.email_ids), dtype=bool)
+        index._email_row = {email_id: row for row, email_id in enumerate(index.email_ids)}
+        return index
+
+    @classmethod
+    def from_items(cls, items):
+        index = cls()
+        index.upsert(items)
+        return index
+
+    def _words(self, field):
+        """
+        (sorted words, sorted reversed words, trigram -> word numbers) of
+        `field`, built on first use; the trigrams find the words a token
+        can sit inside without scanning the whole vocabulary.
+        """
+        vocab = self._vocab.get(field)
+        if vocab is None:
+            words = sorted(self.postings[field])
+            grams = {}
+            for n, word in enumerate(words):
+                for gram in {word[i:i + 3] for i in range(len(word) - 2)}:
+                    grams.setdefault(gram, []).append(n)
+            vocab = self._vocab[field] = (words, sorted(word[::-1] for word in words), grams)
+        return vocab
+
+    def _matching(self, field, token, rule):
+        words, reversed_words, grams = self._words(field)
+        if rule == "exact":
+            return [token] if token in self.postings[field] else []
+        if rule == "prefix":
+            i = bisect.bisect_left(words, token)
+            j = bisect.bisect_left(words, token + "\uffff")
+            return words[i:j]
+        if rule == "suffix":
+            key = token[::-1]
+            i = bisect.bisect_left(reversed_words, key)
+            j = bisect.bisect_left(reversed_words, key + "\uffff")
+            return [word[::-1] for word in reversed_words[i:j]]
+        if len(token) < 3:
+            return [word for word in words if token in word]
+        numbers = None
+        for gram in sorted({token[i:i + 3] for i in range(len(token) - 2)}, key=lambda g: len(grams.get(g, ()))):
+            found = grams.get(gram)
+            if not found:
+                return []
+            numbers = set(found) if numbers is None else numbers.intersection(found)
+        return [words[n] for n in sorted(numbers) if token in words[n]]
+
+    def candidates(self, field, value):
+        """
+        Ids of the live emails whose `field` can contain `value` (case
+        folded, so also right for toLower(...) CONTAINS), or None if the
+        value has no words to look up or matches too many emails to help.
+        """
+        rules = _token_rules(value)
+        if not rules or field not in self.postings:
+            return None
+        key = (field, value.lower())
+        with self._lock:
+            if key in self._lookups:
+                self._lookups.move_to_end(key)
+                return self._lookups[key]
+            postings = self.postings[field]
+            rows = None
+            for token, rule in sorted(rules, key=lambda item: item[1] != "exact"):
+                matched = set()
+                for word in self._matching(field, token, rule):
+                    matched.update(postings[word])
+                rows = matched if rows is None else rows & matched
+                if not rows:
+                    break
+            ids = [self.email_ids[r] for r in sorted(rows) if self.alive[r]]
+            if len(ids) > FULLTEXT_MAX_RATIO * len(self):
+                ids = None
+            self._lookups[key] = ids
+            while len(self._lookups) > 1024:
+                self._lookups.popitem(last=False)
+            return ids
+
+
+class TextIndexStore:
+    """Serves the TextIndex saved by ingest.py, reloading when the file changes (see AnalyticsStore)."""
+
+    def __init__(self, path=FULLTEXT_PATH):
+        self.path = path
+        self.index = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def set(self, index):
+        self.index, self.path = index, None
+
+    def current(self):
+        if self.path is None:
+            return self.index
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return self.index
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    try:
+                        self.index = TextIndex.load(self.path)
+                        logger.info("Full-text index loaded: %d emails from %s", len(self.index), self.path)
+                    except (OSError, ValueError, KeyError) as e:
+                        logger.warning("Full-text index load failed: %s", e)
+                    self._mtime = mtime
+        return self.index
+
+
+def _clause_end(text, start):
+    """Where the clause starting at `start` ends: the next clause keyword or a closing bracket at its level."""
+    depth = 0
+    i = start
+    while i < len(text):
+        ch = text[i]
+        if ch in "([{":
+            depth += 1
+        elif ch in ")]}":
+            depth -= 1
+            if depth < 0:
+                return i
+        elif depth == 0 and CLAUSE_END_RX.match(text, i):
+            return i
+        i += 1
+    return len(text)
+
+
+def _split_and(text):
+    """`text` split at its top-level ANDs."""
+    parts, depth, last = [], 0, 0
+    for i, ch in enumerate(text):
+        if ch in "([{":
+            depth += 1
+        elif ch in ")]}":
+            depth -= 1
+        elif depth == 0 and AND_RX.match(text, i):
+            parts.append(text[last:i])
+            last = i + 3
+    parts.append(text[last:])
+    return parts
+
+
+def _unwrap(text):
+    text = text.strip()
+    while text.startswith("(") and text.endswith(")") and _balanced(text[1:-1]):
+        text = text[1:-1].strip()
+    return text
+
+
+def _balanced(text):
+    depth = 0
+    for ch in text:
+        depth += ch in "([{"
+        depth -= ch in ")]}"
+        if depth < 0:
+            return False
+    return depth == 0
+
+
+def _conjuncts(text):
+    """The AND-ed terms of a WHERE condition, through any grouping parentheses."""
+    parts = _split_and(_unwrap(text))
+    if len(parts) == 1:
+        return [_unwrap(parts[0])]
+    return [term for part in parts for term in _conjuncts(part)]
+
+
+def _filter_spans(template):
+    """(start, end) of every predicate that is a plain AND-ed term of a WHERE, so null and false both drop the row."""
+    spans = set()
+    for where in WHERE_RX.finditer(template):
+        start = where.end()
+        end = _clause_end(template, start)
+        clause = template[start:end]
+        offset = 0
+        for term in _conjuncts(clause):
+            at = clause.find(term, offset)
+            if at >= 0:
+                spans.add((start + at, start + at + len(term)))
+                offset = at + len(term)
+    return spans
+
+
+def rewrite(template, params, lookup):
+    """
+    Add an id lookup in front of every CONTAINS predicate on an Email text
+    property of `template` (parameterized, see cypher_params). `lookup(field,
+    value)` returns candidate ids or None to leave the predicate alone.
+    Returns (template, params, number of predicates rewritten).
+    """
+    if "CONTAINS" not in template.upper():
+        return template, params, 0
+    email_vars = set(EMAIL_VAR_RX.findall(template))
+    filters = _filter_spans(template)
+    params = dict(params)
+    count = 0
+
+    def repl(m):
+        nonlocal count
+        value = params.get(m.group("param"))
+        if m.group("var") not in email_vars or not isinstance(value, str):
+            return m.group(0)
+        ids = lookup(m.group("field").lower(), value)
+        if ids is None or len(ids) > FULLTEXT_MAX_IDS:
+            return m.group(0)
+        name = f"ft_{m.group('field').lower()}_{m.group('param')}"
+        params[name] = list(ids)
+        count += 1
+        if m.span() in filters:
+            return f"({m.group('var')}.id IN ${name} AND {m.group(0)})"
+        # Under NOT / OR, or as a value, a null property must stay null rather than become false
+        return (f"(({m.group('var')}.id IN ${name} OR {m.group('var')}.{m.group('field')} IS NULL) "
+                f"AND {m.group(0)})")
+
+    template = CONTAINS_RX.sub(repl, template)
+    return template, params, count
+
+
+def strip_rewrites(query, params=None):
+    """`query` and `params` without the lookups `rewrite` added."""
+    query = REWRITTEN_RX.sub(lambda m: m.group("predicate"), query)
+    params = {k: v for k, v in (params or {}).items() if not k.startswith("ft_")}
+    return query, params
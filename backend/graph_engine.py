@@ -0,0 +1,1759 @@
+"""
+Embedded read-only graph engine for the email graph.
+
+The schema (cypher_schema.py) is small and fixed: Person, Email and Topic
+nodes and five relationship types. GraphEngine holds a snapshot of the
+whole graph in arrays:
+
+- per label, node properties as columns: strings in one UTF-8 buffer with
+  offsets (StringColumn), Email.date_time as int64 seconds (NO_DATE when
+  missing); ids and topic names are interned to row numbers by a dict
+- per relationship type, CSR adjacency in both directions (row pointers,
+  neighbour rows, edge ids), so a hop from N nodes is a few NumPy ops
+
+`run(query, params)` executes the subset of Cypher generated for this
+schema: MATCH clauses of node/relationship chains with property maps;
+WHERE with comparisons, CONTAINS / STARTS WITH / ENDS WITH, IN, IS NULL,
+datetime() / date(), toLower / toUpper, AND / OR / NOT, EXISTS { MATCH ... }
+and pattern predicates; RETURN of properties, nodes and map projections
+with count / collect / min / max / sum / avg, DISTINCT, ORDER BY, SKIP and
+LIMIT. Anything else raises Unsupported and the query goes to Neo4j.
+
+GraphEngineStore loads the snapshot from Neo4j in the background and
+reloads it when the dataset generation changes; EngineFirst puts it in
+front of a database wrapper (server.Neo4jDatabase).
+"""
+import os
+import re
+import time
+import threading
+import logging
+from datetime import datetime, timezone
+from functools import lru_cache
+
+import numpy as np
+
+from analytics import NO_DATE
+from database import read_session, read_query
+from cypher_schema import NODE_PROPERTIES, RELATIONSHIP_ENDPOINTS
+
+logger = logging.getLogger(__name__)
+
+GRAPH_ENGINE = os.getenv("GRAPH_ENGINE", "0") == "1"
+# Email.content is most of the graph's size; without it, queries reading it go to Neo4j
+GRAPH_ENGINE_CONTENT = os.getenv("GRAPH_ENGINE_CONTENT", "0") == "1"
+# Intermediate rows above which a query is handed to Neo4j instead
+GRAPH_ENGINE_MAX_ROWS = int(os.getenv("GRAPH_ENGINE_MAX_ROWS", "2000000"))
+# Server-side timeout in seconds for each snapshot export query; 0 leaves the server's dbms.transaction.timeout.
+# Not NEO4J_QUERY_TIMEOUT: exporting every email takes far longer than any generated query should
+GRAPH_ENGINE_EXPORT_TIMEOUT = float(os.getenv("GRAPH_ENGINE_EXPORT_TIMEOUT", "0"))
+# Longest wait between snapshot loads after failures; the wait doubles from DATASET_POLL_SECONDS
+GRAPH_ENGINE_RETRY_MAX = float(os.getenv("GRAPH_ENGINE_RETRY_MAX", "600"))
+# Matching rows above which CONTAINS scans the whole text buffer instead of row by row
+SCAN_RATIO = 0.125
+# A bound variable with this many times more rows than a pattern's seeded end is joined, not expanded
+JOIN_RATIO = 8
+# Bindings tested per step when a LIMIT without ORDER BY lets the WHERE stop early
+WHERE_CHUNK = 4096
+
+KEY_PROPERTIES = {"Person": "id", "Email": "id", "Topic": "name"}
+DATE_PROPERTIES = {"Email": {"date_time"}}
+REL_TYPES = tuple(RELATIONSHIP_ENDPOINTS)
+AGGREGATES = {"count", "collect", "min", "max", "sum", "avg"}
+FUNCTIONS = AGGREGATES | {"tolower", "toupper", "lower", "upper", "datetime", "date"}
+DATE_PARTS = {"year": "Y", "month": "M", "day": "D"}
+
+EXPORT_PERSONS = "MATCH (p:Person) RETURN p.id AS id"
+EXPORT_TOPICS = "MATCH (t:Topic) RETURN t.name AS name"
+EXPORT_EMAILS = """
+MATCH (e:Email)
+RETURN e.id AS id, e.date_time.epochSeconds AS date_time, e.subject AS subject,
+       {content} AS content, e.relevant AS relevant, e.analysis AS analysis
+"""
+EXPORT_EDGES = "MATCH (p:Person)-[r]->(e:Email) RETURN type(r) AS type, p.id AS person, e.id AS email"
+EXPORT_RESPONSIVE = """
+MATCH (e:Email)-[r:RESPONSIVE]->(t:Topic)
+RETURN e.id AS email, t.name AS topic, r.analysis AS analysis
+"""
+
+
+class Unsupported(Exception):
+    """The query uses something the engine doesn't execute; run it on Neo4j."""
+
+
+def _seconds(value):
+    """Seconds since the epoch (UTC) of an ISO date or datetime string, None if it isn't one."""
+    try:
+        parsed = datetime.fromisoformat(str(value).strip().replace(" ", "T").replace("Z", "+00:00"))
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return int(parsed.timestamp())
+
+
+def _iso(seconds, kind="datetime"):
+    if seconds is None or seconds == NO_DATE:
+        return None
+    text = str(np.datetime64(int(seconds), "s"))
+    return text[:10] if kind == "date" else text + "Z"
+
+
+# --- storage ---------------------------------------------------------------
+
+class StringColumn:
+    """
+    Strings as one UTF-8 buffer plus offsets; missing values are flagged in
+    `null`. Substring tests run on the bytes (UTF-8 substrings are character
+    substrings), so nothing is decoded except what is returned.
+    """
+
+    def __init__(self, data, offsets, null):
+        self.data = data
+        self.offsets = offsets
+        self.null = null
+        self._cased = {}
+
+    @classmethod
+    def from_values(cls, values):
+        encoded = [b"" if v is None else str(v).encode("utf-8") for v in values]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(b) for b in encoded], out=offsets[1:])
+        null = np.array([v is None for v in values], dtype=bool)
+        return cls(b"".join(encoded), offsets, null)
+
+    def __len__(self):
+        return len(self.null)
+
+    @property
+    def nbytes(self):
+        return len(self.data) + self.offsets.nbytes + self.null.nbytes
+
+    def _buffer(self, case):
+        """(data, offsets) for the values as they are, lowercased or uppercased (built on first use)."""
+        if case is None:
+            return self.data, self.offsets
+        cased = self._cased.get(case)
+        if cased is None:
+            convert = str.lower if case == "lower" else str.upper
+            cased = StringColumn.from_values([convert(v) if v is not None else None for v in self.values()])
+            self._cased[case] = cased
+        return cased.data, cased.offsets
+
+    def values(self, rows=None, case=None):
+        data, offsets = self._buffer(case)
+        if rows is None:
+            rows = np.arange(len(self))
+        starts, ends = offsets[rows].tolist(), offsets[rows + 1].tolist()
+        null = self.null[rows].tolist()
+        return [None if n else data[s:e].decode("utf-8") for s, e, n in zip(starts, ends, null)]
+
+    def test(self, rows, op, needle, case=None):
+        """Boolean array: does each row's value equal / contain / start with / end with `needle`."""
+        data, offsets = self._buffer(case)
+        nb = needle.encode("utf-8")
+        starts, ends = offsets[rows], offsets[rows + 1]
+        if op == "=":
+            out = (ends - starts) == len(nb)
+            hits = np.flatnonzero(out)
+            if len(hits):
+                out[hits] = [data.startswith(nb, s) for s in starts[hits].tolist()]
+        elif op == "contains" and nb and len(rows) > SCAN_RATIO * len(self):
+            out = self._scan(data, offsets, nb)[rows]
+        else:
+            method = {"contains": data.find, "starts": data.startswith, "ends": data.endswith}[op]
+            pairs = zip(starts.tolist(), ends.tolist())
+            if op == "contains":
+                out = np.fromiter((method(nb, s, e) >= 0 for s, e in pairs), dtype=bool, count=len(rows))
+            else:
+                out = np.fromiter((method(nb, s, e) for s, e in pairs), dtype=bool, count=len(rows))
+        return out & ~self.null[rows]
+
+    def _scan(self, data, offsets, nb):
+        """Rows containing `nb`, found by jumping from match to match through the whole buffer."""
+        found = np.zeros(len(self), dtype=bool)
+        pos = data.find(nb)
+        while pos >= 0:
+            row = int(np.searchsorted(offsets, pos, side="right")) - 1
+            end = int(offsets[row + 1])
+            if pos + len(nb) <= end:
+                found[row] = True
+                pos = data.find(nb, end)
+            else:
+                pos = data.find(nb, pos + 1)
+        return found
+
+
+class NodeTable:
+    """
+    The nodes of one label: property columns and the key property's value
+    -> row dict. Properties in `missing` exist in the graph but weren't loaded.
+    """
+
+    def __init__(self, label, columns, key, missing=()):
+        self.label = label
+        self.columns = columns
+        self.key = key
+        self.missing = set(missing)
+        self.index = {v: i for i, v in enumerate(columns[key].values()) if v is not None}
+
+    def __len__(self):
+        return len(self.columns[self.key])
+
+    @property
+    def nbytes(self):
+        return sum(c.nbytes for c in self.columns.values())
+
+    def rows_for(self, values):
+        rows = {self.index.get(v) for v in values if isinstance(v, str)}
+        rows.discard(None)
+        return np.array(sorted(rows), dtype=np.int64)
+
+
+class Adjacency:
+    """CSR over one relationship type and direction: neighbours of row r are nbr[indptr[r]:indptr[r+1]]."""
+
+    def __init__(self, sources, targets, edge_ids, size):
+        order = np.argsort(sources, kind="stable")
+        self.indptr = np.zeros(size + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=size), out=self.indptr[1:])
+        self.nbr = targets[order].astype(np.int32)
+        self.eid = edge_ids[order].astype(np.int32)
+
+    @property
+    def nbytes(self):
+        return self.indptr.nbytes + self.nbr.nbytes + self.eid.nbytes
+
+    def expand(self, rows):
+        """(owner, neighbour, edge id): one entry per edge leaving `rows`, owner indexing `rows`."""
+        starts = self.indptr[rows]
+        counts = self.indptr[rows + 1] - starts
+        total = int(counts.sum())
+        if total == 0:
+            empty = np.empty(0, dtype=np.int64)
+            return empty, empty, empty
+        owner = np.repeat(np.arange(len(rows)), counts)
+        pos = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(total)
+        return owner, self.nbr[pos].astype(np.int64), self.eid[pos].astype(np.int64)
+
+
+class _Builder:
+    """Collects nodes and edges (by key) and freezes them into a GraphEngine."""
+
+    def __init__(self, content=GRAPH_ENGINE_CONTENT):
+        self.rows = {label: {} for label in NODE_PROPERTIES}
+        self.skipped = {"Email": {"content"}} if not content else {}
+        self.props = {label: {prop: [] for prop in props
+                              if prop not in DATE_PROPERTIES.get(label, ()) and prop not in self.skipped.get(label, ())}
+                      for label, props in NODE_PROPERTIES.items()}
+        self.dates = []
+        self.edges = {rel_type: ([], [], []) for rel_type in REL_TYPES}
+
+    def node(self, label, key, props=None, date=NO_DATE):
+        rows = self.rows[label]
+        row = rows.get(key)
+        columns = self.props[label]
+        if row is None:
+            row = rows[key] = len(rows)
+            for prop, column in columns.items():
+                column.append(key if prop == KEY_PROPERTIES[label] else None)
+            if label == "Email":
+                self.dates.append(NO_DATE)
+        if props is not None:
+            for prop, column in columns.items():
+                if prop != KEY_PROPERTIES[label]:
+                    column[row] = props.get(prop)
+            self.dates[row] = date
+        return row
+
+    def edge(self, rel_type, source, target, analysis=None):
+        sources, targets, analyses = self.edges[rel_type]
+        sources.append(source)
+        targets.append(target)
+        analyses.append(analysis)
+
+    def build(self):
+        nodes = {label: NodeTable(label, {prop: StringColumn.from_values(values)
+                                          for prop, values in self.props[label].items()}, KEY_PROPERTIES[label],
+                                  self.skipped.get(label, ()))
+                 for label in NODE_PROPERTIES}
+        nodes["Email"].columns["date_time"] = np.array(self.dates, dtype=np.int64)
+        edges, base = {}, 0
+        for rel_type, (sources, targets, analyses) in self.edges.items():
+            sources = np.array(sources, dtype=np.int64)
+            targets = np.array(targets, dtype=np.int64)
+            # MERGE semantics: one edge per (source, target), the last one written wins
+            keys = (sources << 32) | targets
+            _, last = np.unique(keys[::-1], return_index=True)
+            keep = np.sort(len(keys) - 1 - last)
+            edges[rel_type] = (sources[keep], targets[keep], [analyses[i] for i in keep.tolist()], base)
+            base += len(keep)
+        return GraphEngine(nodes, edges)
+
+
+# --- the engine --------------------------------------------------------------
+
+class GraphEngine:
+    """An immutable snapshot of the graph; `run` answers supported queries from it."""
+
+    def __init__(self, nodes, edges):
+        self.nodes = nodes
+        self.base = {}
+        self.out = {}
+        self.inc = {}
+        self.edge_count = 0
+        responsive = []
+        for rel_type, (sources, targets, analyses, base) in edges.items():
+            source_label, target_label = RELATIONSHIP_ENDPOINTS[rel_type]
+            ids = np.arange(base, base + len(sources), dtype=np.int64)
+            self.base[rel_type] = base
+            self.out[rel_type] = Adjacency(sources, targets, ids, len(nodes[source_label]))
+            self.inc[rel_type] = Adjacency(targets, sources, ids, len(nodes[target_label]))
+            self.edge_count += len(sources)
+            if rel_type == "RESPONSIVE":
+                responsive = analyses
+        # Only RESPONSIVE edges carry a property
+        self.responsive_analysis = StringColumn.from_values(responsive)
+
+    @classmethod
+    def from_items(cls, items, topic="", content=GRAPH_ENGINE_CONTENT):
+        """Snapshot of what ingest.py writes for parsed CSV rows (ingest.parse_chunk)."""
+        builder = _Builder(content)
+        topic_row = builder.node("Topic", topic) if topic else None
+        for item in items:
+            email = item["email"]
+            seconds = _seconds(email["date"]) if email.get("date") else None
+            row = builder.node("Email", email["id"], email, NO_DATE if seconds is None else seconds)
+            for rel_type, person in item["edges"]:
+                builder.edge(rel_type, builder.node("Person", person), row)
+            if item["responsive"] and topic_row is not None:
+                builder.edge("RESPONSIVE", row, topic_row, email.get("analysis"))
+        return builder.build()
+
+    @classmethod
+    def from_neo4j(cls, driver, content=GRAPH_ENGINE_CONTENT):
+        """Snapshot of the graph in Neo4j, read with one query per label and relationship group."""
+        builder = _Builder(content)
+        with read_session(driver) as session:
+            for record in session.run(read_query(EXPORT_PERSONS, GRAPH_ENGINE_EXPORT_TIMEOUT)):
+                if record["id"] is not None:
+                    builder.node("Person", record["id"])
+            for record in session.run(read_query(EXPORT_TOPICS, GRAPH_ENGINE_EXPORT_TIMEOUT)):
+                if record["name"] is not None:
+                    builder.node("Topic", record["name"])
+            emails = EXPORT_EMAILS.format(content="e.content" if content else "null")
+            for record in session.run(read_query(emails, GRAPH_ENGINE_EXPORT_TIMEOUT)):
+                if record["id"] is not None:
+                    date = record["date_time"]
+                    builder.node("Email", record["id"], record.data(), NO_DATE if date is None else date)
+            for record in session.run(read_query(EXPORT_EDGES, GRAPH_ENGINE_EXPORT_TIMEOUT)):
+                if record["type"] in REL_TYPES and record["type"] != "RESPONSIVE":
+                    builder.edge(record["type"], builder.node("Person", record["person"]),
+                                 builder.node("Email", record["email"]))
+            for record in session.run(read_query(EXPORT_RESPONSIVE, GRAPH_ENGINE_EXPORT_TIMEOUT)):
+                builder.edge("RESPONSIVE", builder.node("Email", record["email"]),
+                             builder.node("Topic", record["topic"]), record["analysis"])
+        return builder.build()
+
+    def __len__(self):
+        return sum(len(table) for table in self.nodes.values())
+
+    @property
+    def nbytes(self):
+        """Bytes held in arrays and buffers (the key dicts come on top)."""
+        return (sum(table.nbytes for table in self.nodes.values())
+                + sum(a.nbytes for a in self.out.values()) + sum(a.nbytes for a in self.inc.values())
+                + self.responsive_analysis.nbytes)
+
+    def person_ids(self):
+        return list(self.nodes["Person"].index)
+
+    def run(self, query, params=None):
+        """Result rows of `query` as Neo4j would return them; raises Unsupported for anything else."""
+        plan = _compile(query)
+        if isinstance(plan, Unsupported):
+            raise plan
+        return _Execution(self, params or {}).run(plan)
+
+
+# --- parsing -----------------------------------------------------------------
+
+TOKEN_RX = re.compile(r"""
+    (?P<space>\s+|//[^\n]*)
+  | (?P<str>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+  | (?P<num>\d+(?:\.\d+)?)
+  | (?P<param>\$\w+)
+  | (?P<name>[A-Za-z_]\w*|`[^`]+`)
+  | (?P<op><>|<=|>=|=~|->|<-|\.\.|[-=<>(){}\[\],.:|*+/%;^])
+""", re.VERBOSE)
+ESCAPE_RX = re.compile(r"\\(.)")
+
+
+def _tokens(query):
+    tokens, pos = [], 0
+    while pos < len(query):
+        m = TOKEN_RX.match(query, pos)
+        if m is None:
+            raise Unsupported(f"unexpected character {query[pos]!r}")
+        if m.lastgroup != "space":
+            text = m.group()
+            if m.lastgroup == "name" and text.startswith("`"):
+                text = text[1:-1]
+            tokens.append((m.lastgroup, text, m.start(), m.end()))
+        pos = m.end()
+    tokens.append(("end", "", len(query), len(query)))
+    return tokens
+
+
+class _Parser:
+    """
+    Recursive descent over the supported subset. Expressions become tuples:
+    ('const', v), ('param', name), ('var', name), ('prop', expr, name),
+    ('map', var, [(key, expr)]), ('call', name, distinct, [args]),
+    ('cmp', op, a, b), ('text', op, a, b), ('in', a, b), ('isnull', a, negate),
+    ('and', a, b), ('or', a, b), ('not', a), ('list', [items]),
+    ('exists', [clause]).
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.tokens = _tokens(query)
+        self.pos = 0
+        self.anonymous = 0
+
+    def peek(self, offset=0):
+        return self.tokens[min(self.pos + offset, len(self.tokens) - 1)]
+
+    def next(self):
+        token = self.tokens[self.pos]
+        self.pos += 1
+        return token
+
+    def at(self, *values, offset=0):
+        kind, text, _, _ = self.peek(offset)
+        return (kind == "op" and text in values) or (kind == "name" and text.upper() in values)
+
+    def accept(self, *values):
+        if self.at(*values):
+            return self.next()
+        return None
+
+    def expect(self, *values):
+        token = self.accept(*values)
+        if token is None:
+            raise Unsupported(f"expected {' or '.join(values)} at {self.peek()[1]!r}")
+        return token
+
+    def name(self):
+        kind, text, _, _ = self.next()
+        if kind != "name":
+            raise Unsupported(f"expected a name, got {text!r}")
+        return text
+
+    def hidden(self):
+        self.anonymous += 1
+        return f" {self.anonymous}"
+
+    # query structure
+
+    def parse(self):
+        clauses = []
+        while self.at("MATCH"):
+            clauses.append(self.match_clause())
+        if not clauses:
+            raise Unsupported("query doesn't start with MATCH")
+        self.expect("RETURN")
+        distinct = bool(self.accept("DISTINCT"))
+        if self.at("*"):
+            raise Unsupported("RETURN *")
+        items = [self.return_item()]
+        while self.accept(","):
+            items.append(self.return_item())
+        order = []
+        if self.accept("ORDER"):
+            self.expect("BY")
+            while True:
+                expr = self.expr()
+                descending = bool(self.accept("DESC", "DESCENDING"))
+                if not descending:
+                    self.accept("ASC", "ASCENDING")
+                order.append((expr, descending))
+                if not self.accept(","):
+                    break
+        skip = self.expr() if self.accept("SKIP") else None
+        limit = self.expr() if self.accept("LIMIT") else None
+        self.accept(";")
+        if self.peek()[0] != "end":
+            raise Unsupported(f"unsupported clause at {self.peek()[1]!r}")
+        return {"clauses": clauses, "distinct": distinct, "items": items, "order": order,
+                "skip": skip, "limit": limit}
+
+    def match_clause(self):
+        self.expect("MATCH")
+        patterns = [self.pattern()]
+        while self.accept(","):
+            patterns.append(self.pattern())
+        where = self.expr() if self.accept("WHERE") else None
+        return patterns, where
+
+    def return_item(self):
+        start = self.peek()[2]
+        expr = self.expr()
+        end = self.tokens[self.pos - 1][3]
+        key = self.name() if self.accept("AS") else self.query[start:end].strip()
+        return expr, key
+
+    def pattern(self):
+        if self.peek()[0] == "name" and self.at("=", offset=1):
+            raise Unsupported("path variables")
+        nodes, rels = [self.node()], []
+        while self.at("-", "<-"):
+            rels.append(self.relationship())
+            nodes.append(self.node())
+        return nodes, rels
+
+    def node(self):
+        self.expect("(")
+        var = self.name() if self.peek()[0] == "name" else self.hidden()
+        label = None
+        if self.accept(":"):
+            label = self.name()
+            if self.at(":", "&", "|"):
+                raise Unsupported("several labels")
+        props = self.properties() if self.at("{") else []
+        self.expect(")")
+        return {"var": var, "label": label, "props": props}
+
+    def relationship(self):
+        left = self.next()[1]
+        var, types, props = None, None, []
+        if self.accept("["):
+            if self.peek()[0] == "name":
+                var = self.name()
+            if self.accept(":"):
+                types = [self.name()]
+                while self.accept("|"):
+                    self.accept(":")
+                    types.append(self.name())
+            if self.at("*"):
+                raise Unsupported("variable-length relationships")
+            if self.at("{"):
+                props = self.properties()
+            self.expect("]")
+        right = self.expect("-", "->")[1]
+        direction = "in" if left == "<-" and right == "-" else "out" if left == "-" and right == "->" else "both"
+        return {"var": var or self.hidden(), "types": types, "direction": direction, "props": props}
+
+    def properties(self):
+        self.expect("{")
+        props = []
+        if not self.at("}"):
+            while True:
+                key = self.name()
+                self.expect(":")
+                props.append((key, self.expr()))
+                if not self.accept(","):
+                    break
+        self.expect("}")
+        return props
+
+    # expressions
+
+    def expr(self):
+        left = self.conjunction()
+        while self.accept("OR"):
+            left = ("or", left, self.conjunction())
+        if self.at("XOR"):
+            raise Unsupported("XOR")
+        return left
+
+    def conjunction(self):
+        left = self.negation()
+        while self.accept("AND"):
+            left = ("and", left, self.negation())
+        return left
+
+    def negation(self):
+        if self.accept("NOT"):
+            return ("not", self.negation())
+        return self.comparison()
+
+    def comparison(self):
+        left = self.postfix()
+        token = self.accept("=", "<>", "<", ">", "<=", ">=")
+        if token:
+            return ("cmp", token[1], left, self.postfix())
+        if self.accept("CONTAINS"):
+            return ("text", "contains", left, self.postfix())
+        if self.accept("STARTS"):
+            self.expect("WITH")
+            return ("text", "starts", left, self.postfix())
+        if self.accept("ENDS"):
+            self.expect("WITH")
+            return ("text", "ends", left, self.postfix())
+        if self.accept("IN"):
+            return ("in", left, self.postfix())
+        if self.accept("IS"):
+            negate = bool(self.accept("NOT"))
+            self.expect("NULL")
+            return ("isnull", left, negate)
+        if self.at("=~", "+", "-", "*", "/", "%", "^", "[", ".."):
+            raise Unsupported(f"operator {self.peek()[1]!r}")
+        return left
+
+    def postfix(self):
+        expr = self.atom()
+        while self.accept("."):
+            expr = ("prop", expr, self.name())
+        return expr
+
+    def atom(self):
+        kind, text, _, _ = self.peek()
+        if kind == "str":
+            self.next()
+            return ("const", ESCAPE_RX.sub(lambda m: {"n": "\n", "t": "\t"}.get(m.group(1), m.group(1)), text[1:-1]))
+        if kind == "num":
+            self.next()
+            return ("const", float(text) if "." in text else int(text))
+        if kind == "param":
+            self.next()
+            return ("param", text[1:])
+        if self.at("-") and self.peek(1)[0] == "num":
+            self.next()
+            value = self.atom()[1]
+            return ("const", -value)
+        if self.accept("["):
+            items = []
+            if not self.at("]"):
+                items.append(self.expr())
+                while self.accept(","):
+                    items.append(self.expr())
+            self.expect("]")
+            return ("list", items)
+        if self.at("("):
+            return self.parenthesized()
+        if kind != "name":
+            raise Unsupported(f"unexpected {text!r}")
+        upper = text.upper()
+        if upper in ("TRUE", "FALSE", "NULL"):
+            self.next()
+            return ("const", {"TRUE": True, "FALSE": False, "NULL": None}[upper])
+        if upper == "EXISTS" and self.at("{", offset=1):
+            self.next()
+            return self.exists()
+        if upper in ("CASE", "COUNT") and self.at("{", offset=1):
+            raise Unsupported(f"{upper} subqueries")
+        self.next()
+        if self.at("("):
+            return self.call(text.lower())
+        if self.at("{"):
+            return self.map_projection(text)
+        return ("var", text)
+
+    def parenthesized(self):
+        # A pattern predicate like (p)-[:SEND]->(e), or a parenthesized expression
+        start = self.pos
+        try:
+            nodes, rels = self.pattern()
+            if rels:
+                return ("exists", [([(nodes, rels)], None)])
+        except Unsupported:
+            pass
+        self.pos = start
+        self.expect("(")
+        expr = self.expr()
+        self.expect(")")
+        return expr
+
+    def exists(self):
+        self.expect("{")
+        if self.at("MATCH"):
+            clause = self.match_clause()
+        else:
+            patterns = [self.pattern()]
+            clause = (patterns, self.expr() if self.accept("WHERE") else None)
+        self.expect("}")
+        return ("exists", [clause])
+
+    def call(self, name):
+        if name not in FUNCTIONS:
+            raise Unsupported(f"function {name}()")
+        self.expect("(")
+        if name == "count" and self.accept("*"):
+            self.expect(")")
+            return ("call", "count", False, [])
+        distinct = bool(self.accept("DISTINCT"))
+        args = []
+        if not self.at(")"):
+            args.append(self.expr())
+            while self.accept(","):
+                args.append(self.expr())
+        self.expect(")")
+        return ("call", name, distinct, args)
+
+    def map_projection(self, var):
+        self.expect("{")
+        entries = []
+        while True:
+            if self.accept("."):
+                if self.at("*"):
+                    raise Unsupported("all-properties projection")
+                prop = self.name()
+                entries.append((prop, ("prop", ("var", var), prop)))
+            else:
+                key = self.name()
+                self.expect(":")
+                entries.append((key, self.expr()))
+            if not self.accept(","):
+                break
+        self.expect("}")
+        return ("map", var, entries)
+
+
+@lru_cache(maxsize=1024)
+def _compile(query):
+    """Parsed plan for a query text, or the Unsupported explaining why there is none (cached either way)."""
+    try:
+        plan = _Parser(query).parse()
+        for expr, _ in plan["items"]:
+            _check_aggregates(expr, top=True)
+        return plan
+    except Unsupported as e:
+        return e
+    except (IndexError, ValueError) as e:
+        return Unsupported(f"could not parse: {e}")
+
+
+def _check_aggregates(expr, top=False):
+    kind = expr[0]
+    if kind == "call":
+        if expr[1] in AGGREGATES and not top:
+            raise Unsupported("nested aggregation")
+        children = expr[3]
+    elif kind == "map":
+        children = [item for _, item in expr[2]]
+    elif kind == "list":
+        children = expr[1]
+    elif kind in ("const", "param", "var", "exists"):
+        children = []
+    else:
+        children = [child for child in expr[1:] if isinstance(child, tuple)]
+    for child in children:
+        _check_aggregates(child)
+
+
+def _is_aggregate(expr):
+    return expr[0] == "call" and expr[1] in AGGREGATES
+
+
+def _conjuncts(expr):
+    if expr is None:
+        return []
+    if expr[0] == "and":
+        return _conjuncts(expr[1]) + _conjuncts(expr[2])
+    return [expr]
+
+
+# --- values --------------------------------------------------------------------
+
+class _Instant:
+    """A datetime() / date() value: seconds since the epoch and which of the two it is."""
+    __slots__ = ("seconds", "kind")
+
+    def __init__(self, seconds, kind):
+        self.seconds, self.kind = seconds, kind
+
+
+class _Const:
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+class _Str:
+    __slots__ = ("column", "rows", "case")
+
+    def __init__(self, column, rows, case=None):
+        self.column, self.rows, self.case = column, rows, case
+
+
+class _Dates:
+    __slots__ = ("values", "kind")
+
+    def __init__(self, values, kind="datetime"):
+        self.values, self.kind = values, kind
+
+
+class _Nums:
+    __slots__ = ("values", "null")
+
+    def __init__(self, values, null):
+        self.values, self.null = values, null
+
+
+class _NodeRef:
+    __slots__ = ("table", "rows")
+
+    def __init__(self, table, rows):
+        self.table, self.rows = table, rows
+
+
+class _RelRef:
+    __slots__ = ("eids",)
+
+    def __init__(self, eids):
+        self.eids = eids
+
+
+class _Map:
+    __slots__ = ("base", "entries")
+
+    def __init__(self, base, entries):
+        self.base, self.entries = base, entries
+
+
+class _Bool:
+    """Three-valued truth per row: t where true, f where false, neither where null."""
+    __slots__ = ("t", "f")
+
+    def __init__(self, t, f):
+        self.t, self.f = t, f
+
+    @classmethod
+    def of(cls, value, n):
+        if value is None:
+            return cls(np.zeros(n, dtype=bool), np.zeros(n, dtype=bool))
+        return cls(np.full(n, bool(value)), np.full(n, not value))
+
+    @classmethod
+    def where(cls, mask, null):
+        return cls(mask & ~null, ~mask & ~null)
+
+
+def _cypher_compare(op, a, b):
+    """Cypher's comparison of two plain values: True, False or None (null)."""
+    if a is None or b is None:
+        return None
+    text = isinstance(a, str) and isinstance(b, str)
+    numbers = all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in (a, b))
+    if op in ("=", "<>"):
+        equal = a == b if (text or numbers or type(a) is type(b)) else False
+        return equal if op == "=" else not equal
+    if op in ("contains", "starts", "ends"):
+        if not text:
+            return None
+        return b in a if op == "contains" else a.startswith(b) if op == "starts" else a.endswith(b)
+    if not (text or numbers):
+        return None
+    return {"<": a < b, ">": a > b, "<=": a <= b, ">=": a >= b}[op]
+
+
+MIRRORED = {"=": "=", "<>": "<>", "<": ">", ">": "<", "<=": ">=", ">=": "<="}
+
+
+# --- execution ---------------------------------------------------------------
+
+class _Table:
+    """Bindings as columns of rows: node variables hold node rows, relationship variables edge ids."""
+    __slots__ = ("cols", "labels", "rels", "size")
+
+    def __init__(self, cols, labels, rels, size):
+        self.cols, self.labels, self.rels, self.size = cols, labels, rels, size
+
+    def take(self, index):
+        return _Table({k: v[index] for k, v in self.cols.items()}, self.labels, self.rels, len(index))
+
+    def with_column(self, var, values, label=None, types=None):
+        cols = dict(self.cols)
+        cols[var] = values
+        labels, rels = self.labels, self.rels
+        if label is not None:
+            labels = {**labels, var: label}
+        else:
+            rels = {**rels, var: types}
+        return _Table(cols, labels, rels, len(values))
+
+
+class _Execution:
+    def __init__(self, engine, params):
+        self.engine = engine
+        self.params = params
+
+    def run(self, plan):
+        table = _Table({}, {}, {}, 1)
+        clauses = plan["clauses"]
+        for i, clause in enumerate(clauses):
+            table = self.match(table, clause, self.wanted(plan) if i == len(clauses) - 1 else None)
+        return self.project(table, plan)
+
+    def wanted(self, plan):
+        """Rows the RETURN will use when that is known before matching (a plain LIMIT), else None."""
+        if plan["limit"] is None or plan["order"] or plan["distinct"] or \
+                any(_is_aggregate(expr) for expr, _ in plan["items"]):
+            return None
+        return (self.count_param(plan["skip"]) or 0) + self.count_param(plan["limit"])
+
+    def _check_size(self, size):
+        if size > GRAPH_ENGINE_MAX_ROWS:
+            raise Unsupported(f"more than {GRAPH_ENGINE_MAX_ROWS} intermediate rows")
+
+    # MATCH
+
+    def match(self, table, clause, wanted=None):
+        patterns, where = clause
+        seeds = self.seeds(where)
+        clause_rels = []
+        for nodes, rels in patterns:
+            table = self.match_pattern(table, nodes, rels, seeds)
+            clause_rels.extend(rels)
+        # Within one MATCH a relationship is only traversed once
+        keep = None
+        for i, a in enumerate(clause_rels):
+            for b in clause_rels[i + 1:]:
+                if a["types"] is None or b["types"] is None or set(a["types"]) & set(b["types"]):
+                    distinct = table.cols[a["var"]] != table.cols[b["var"]]
+                    keep = distinct if keep is None else keep & distinct
+        if keep is not None:
+            table = table.take(np.flatnonzero(keep))
+        if where is None:
+            return table
+        if wanted is None or table.size <= WHERE_CHUNK:
+            return table.take(np.flatnonzero(self.truth(where, table).t))
+        # Only the first `wanted` matches are returned: test the WHERE a chunk at a time until there are enough
+        kept, found = [], 0
+        for start in range(0, table.size, WHERE_CHUNK):
+            rows = np.arange(start, min(start + WHERE_CHUNK, table.size))
+            hits = rows[self.truth(where, table.take(rows)).t]
+            kept.append(hits)
+            found += len(hits)
+            if found >= wanted:
+                break
+        return table.take(np.concatenate(kept))
+
+    def seeds(self, where):
+        """var -> key values it must take, from `v.id = x` / `v.id IN xs` conjuncts of the WHERE."""
+        seeds = {}
+        for expr in _conjuncts(where):
+            if expr[0] == "cmp" and expr[1] == "=":
+                sides = [(expr[2], expr[3]), (expr[3], expr[2])]
+            elif expr[0] == "in":
+                sides = [(expr[1], expr[2])]
+            else:
+                continue
+            for target, value in sides:
+                if target[0] == "prop" and target[1][0] == "var" and value[0] in ("const", "param"):
+                    v = self.constant(value)
+                    values = v if expr[0] == "in" else [v]
+                    if isinstance(values, list):
+                        seeds.setdefault(target[1][1], []).append((target[2], values))
+        return seeds
+
+    def infer_labels(self, table, nodes, rels):
+        labels = []
+        for node in nodes:
+            label = node["label"] or table.labels.get(node["var"])
+            if node["label"] and node["var"] in table.labels and table.labels[node["var"]] != node["label"]:
+                label = "?"
+            if label is not None and label != "?" and label not in NODE_PROPERTIES:
+                raise Unsupported(f"label :{label}")
+            if node["var"] in table.rels:
+                raise Unsupported(f"{node['var']} is a relationship")
+            labels.append(label)
+        for rel in rels:
+            for rel_type in rel["types"] or ():
+                if rel_type not in RELATIONSHIP_ENDPOINTS:
+                    raise Unsupported(f"relationship type :{rel_type}")
+        for _ in range(2):
+            for i, rel in enumerate(rels):
+                ends = self.hop_ends(rel, labels[i], labels[i + 1])
+                for side in (0, 1):
+                    options = {end[side] for end in ends}
+                    if labels[i + side] is None and len(options) == 1:
+                        labels[i + side] = options.pop()
+        if None in labels:
+            raise Unsupported("a node whose label can't be inferred")
+        return labels
+
+    def hop_ends(self, rel, left, right):
+        """(left label, right label, type, left-to-right direction) for each way the hop can be traversed."""
+        ends = []
+        for rel_type in rel["types"] or REL_TYPES:
+            source, target = RELATIONSHIP_ENDPOINTS[rel_type]
+            if rel["direction"] in ("out", "both"):
+                ends.append((source, target, rel_type, "out"))
+            if rel["direction"] in ("in", "both"):
+                ends.append((target, source, rel_type, "in"))
+        return [e for e in ends if left in (None, e[0]) and right in (None, e[1])]
+
+    def match_pattern(self, table, nodes, rels, seeds):
+        labels = self.infer_labels(table, nodes, rels)
+        if "?" in labels:
+            return table.take(np.empty(0, dtype=np.int64))
+        bound = [i for i, node in enumerate(nodes) if node["var"] in table.cols]
+        candidates = {i: self.node_candidates(node, labels[i], seeds)
+                      for i, node in enumerate(nodes) if node["var"] not in table.cols}
+
+        def estimate(i):
+            rows = candidates[i]
+            return len(self.engine.nodes[labels[i]]) if rows is None else len(rows)
+
+        smallest = min(candidates, key=estimate, default=None)
+        if bound:
+            shared = {nodes[i]["var"] for i in bound}
+            if smallest is not None and len(shared) == 1 and estimate(smallest) * JOIN_RATIO < table.size:
+                # Cheaper to match the pattern from its selective end and join on the bound variable
+                mini = self.seed(_Table({}, {}, {}, 1), nodes[smallest]["var"], candidates[smallest], labels[smallest])
+                return self.join(table, self.walk(mini, nodes, rels, labels, smallest), shared.pop())
+            return self.walk(table, nodes, rels, labels, bound[0])
+        table = self.seed(table, nodes[smallest]["var"], candidates[smallest], labels[smallest])
+        return self.walk(table, nodes, rels, labels, smallest)
+
+    def seed(self, table, var, rows, label):
+        """Every binding of `table` combined with each of `rows` (all nodes of `label` if None)."""
+        if rows is None:
+            rows = np.arange(len(self.engine.nodes[label]), dtype=np.int64)
+        self._check_size(table.size * len(rows))
+        size = table.size
+        table = table.take(np.repeat(np.arange(size), len(rows)))
+        return table.with_column(var, np.tile(rows, size), label=label)
+
+    def walk(self, table, nodes, rels, labels, anchor):
+        """Extend bindings of nodes[anchor] along the chain in both directions."""
+        table = self.filter_node(table, nodes[anchor])
+        for i in range(anchor, len(rels)):
+            table = self.hop(table, nodes[i], rels[i], nodes[i + 1], labels[i], labels[i + 1], forward=True)
+        for i in range(anchor - 1, -1, -1):
+            table = self.hop(table, nodes[i + 1], rels[i], nodes[i], labels[i + 1], labels[i], forward=False)
+        return table
+
+    def join(self, table, other, var):
+        """Bindings of `table` and `other` that agree on `var`."""
+        right = other.cols[var]
+        order = np.argsort(right, kind="stable")
+        ordered = right[order]
+        left = table.cols[var]
+        lo = np.searchsorted(ordered, left, side="left")
+        counts = np.searchsorted(ordered, left, side="right") - lo
+        total = int(counts.sum())
+        self._check_size(total)
+        left_index = np.repeat(np.arange(table.size), counts)
+        right_index = order[np.repeat(lo - (np.cumsum(counts) - counts), counts) + np.arange(total)]
+        joined = table.take(left_index)
+        cols = dict(joined.cols)
+        for name, values in other.cols.items():
+            if name != var:
+                cols[name] = values[right_index]
+        return _Table(cols, {**other.labels, **joined.labels}, {**other.rels, **joined.rels}, total)
+
+    def node_candidates(self, node, label, seeds):
+        """Rows `node` can bind to given its key property filters, or None for every node of `label`."""
+        nodes = self.engine.nodes[label]
+        lists = [[self.constant(expr)] for key, expr in node["props"]
+                 if key == nodes.key and expr[0] in ("const", "param")]
+        lists += [values for key, values in seeds.get(node["var"], ()) if key == nodes.key]
+        if not lists:
+            return None
+        return min((nodes.rows_for(values) for values in lists), key=len)
+
+    def filter_node(self, table, node):
+        for key, expr in node["props"]:
+            truth = self.compare("=", self.value(("prop", ("var", node["var"]), key), table),
+                                 self.value(expr, table), table.size)
+            table = table.take(np.flatnonzero(truth.t))
+        return table
+
+    def hop(self, table, here, rel, there, here_label, there_label, forward):
+        owners, targets, eids = [], [], []
+        ends = self.hop_ends(rel, here_label, there_label) if forward else self.hop_ends(rel, there_label, here_label)
+        for _, _, rel_type, direction in ends:
+            if not forward:
+                direction = "in" if direction == "out" else "out"
+            adjacency = (self.engine.out if direction == "out" else self.engine.inc)[rel_type]
+            owner, target, eid = adjacency.expand(table.cols[here["var"]])
+            owners.append(owner)
+            targets.append(target)
+            eids.append(eid)
+        if not owners:
+            return table.take(np.empty(0, dtype=np.int64))
+        owner, target, eid = (np.concatenate(parts) for parts in (owners, targets, eids))
+        self._check_size(len(owner))
+        if rel["var"] in table.cols:
+            raise Unsupported(f"relationship variable {rel['var']} used twice")
+        table = table.take(owner).with_column(rel["var"], eid, types=tuple(rel["types"] or REL_TYPES))
+        if there["var"] in table.cols:
+            table = table.take(np.flatnonzero(table.cols[there["var"]] == target))
+        else:
+            table = table.with_column(there["var"], target, label=there_label)
+        for key, expr in rel["props"]:
+            truth = self.compare("=", self.value(("prop", ("var", rel["var"]), key), table),
+                                 self.value(expr, table), table.size)
+            table = table.take(np.flatnonzero(truth.t))
+        return self.filter_node(table, there)
+
+    # expressions
+
+    def constant(self, expr):
+        if expr[0] == "const":
+            return expr[1]
+        if expr[0] == "param":
+            if expr[1] not in self.params:
+                raise Unsupported(f"missing parameter ${expr[1]}")
+            return self.params[expr[1]]
+        raise Unsupported("not a constant")
+
+    def value(self, expr, table):
+        kind = expr[0]
+        if kind in ("const", "param"):
+            return _Const(self.constant(expr))
+        if kind == "list":
+            values = [self.value(item, table) for item in expr[1]]
+            if not all(isinstance(v, _Const) for v in values):
+                raise Unsupported("list of non-constants")
+            return _Const([v.value for v in values])
+        if kind == "var":
+            var = expr[1]
+            if var in table.labels:
+                return _NodeRef(self.engine.nodes[table.labels[var]], table.cols[var])
+            if var in table.rels:
+                return _RelRef(table.cols[var])
+            raise Unsupported(f"unknown variable {var}")
+        if kind == "prop":
+            return self.property(self.value(expr[1], table), expr[2], expr[1], table)
+        if kind == "map":
+            base = self.value(("var", expr[1]), table)
+            return _Map(base, [(key, self.value(item, table)) for key, item in expr[2]])
+        if kind == "call":
+            return self.function(expr[1], [self.value(arg, table) for arg in expr[3]], table.size)
+        return self.truth(expr, table)
+
+    def property(self, base, name, base_expr, table):
+        if isinstance(base, _NodeRef):
+            if name in base.table.missing:
+                raise Unsupported(f"{base.table.label}.{name} isn't loaded")
+            column = base.table.columns.get(name)
+            if column is None:
+                return _Const(None)
+            if isinstance(column, StringColumn):
+                return _Str(column, base.rows)
+            return _Dates(column[base.rows])
+        if isinstance(base, _RelRef):
+            types = table.rels.get(base_expr[1], ()) if base_expr[0] == "var" else ()
+            if name != "analysis" or "RESPONSIVE" not in types:
+                return _Const(None)
+            if tuple(types) != ("RESPONSIVE",):
+                raise Unsupported("property of a relationship of several types")
+            return _Str(self.engine.responsive_analysis, base.eids - self.engine.base["RESPONSIVE"])
+        if isinstance(base, _Dates) and name in DATE_PARTS:
+            null = base.values == NO_DATE
+            stamps = np.where(null, 0, base.values).astype("datetime64[s]")
+            unit = DATE_PARTS[name]
+            if unit == "Y":
+                parts = stamps.astype("datetime64[Y]").astype(np.int64) + 1970
+            elif unit == "M":
+                parts = stamps.astype("datetime64[M]").astype(np.int64) % 12 + 1
+            else:
+                parts = (stamps.astype("datetime64[D]") - stamps.astype("datetime64[M]")).astype(np.int64) + 1
+            return _Nums(parts, null)
+        if isinstance(base, _Map):
+            for key, item in base.entries:
+                if key == name:
+                    return item
+            return _Const(None)
+        raise Unsupported(f"property .{name} of this value")
+
+    def function(self, name, args, n):
+        if name in AGGREGATES:
+            raise Unsupported("aggregation outside RETURN")
+        if len(args) > 1:
+            raise Unsupported(f"{name}() with several arguments")
+        if name in ("tolower", "toupper", "lower", "upper"):
+            case = "lower" if name in ("tolower", "lower") else "upper"
+            (arg,) = args
+            if isinstance(arg, _Str) and arg.case is None:
+                return _Str(arg.column, arg.rows, case)
+            if isinstance(arg, _Const) and (arg.value is None or isinstance(arg.value, str)):
+                return _Const(None if arg.value is None else arg.value.lower() if case == "lower" else arg.value.upper())
+            raise Unsupported(f"{name}() of this value")
+        # datetime() / date()
+        if not args:
+            now = int(time.time())
+            return _Const(_Instant(now - now % 86400 if name == "date" else now, name))
+        (arg,) = args
+        if isinstance(arg, _Const):
+            if arg.value is None:
+                return _Const(None)
+            seconds = arg.value.seconds if isinstance(arg.value, _Instant) else _seconds(arg.value)
+            if seconds is None:
+                raise Unsupported(f"{name}({arg.value!r})")
+            return _Const(_Instant(seconds - seconds % 86400 if name == "date" else seconds, name))
+        if isinstance(arg, _Dates):
+            if name == "date":
+                values = np.where(arg.values == NO_DATE, NO_DATE, arg.values - arg.values % 86400)
+                return _Dates(values, "date")
+            return _Dates(arg.values, arg.kind)
+        raise Unsupported(f"{name}() of this value")
+
+    def truth(self, expr, table):
+        n = table.size
+        kind = expr[0]
+        if kind == "and":
+            a, b = self.truth(expr[1], table), self.truth(expr[2], table)
+            return _Bool(a.t & b.t, a.f | b.f)
+        if kind == "or":
+            a, b = self.truth(expr[1], table), self.truth(expr[2], table)
+            return _Bool(a.t | b.t, a.f & b.f)
+        if kind == "not":
+            a = self.truth(expr[1], table)
+            return _Bool(a.f, a.t)
+        if kind in ("cmp", "text"):
+            return self.compare(expr[1], self.value(expr[2], table), self.value(expr[3], table), n)
+        if kind == "in":
+            return self.member(self.value(expr[1], table), self.value(expr[2], table), n)
+        if kind == "isnull":
+            null = self.nulls(self.value(expr[1], table), n)
+            return _Bool.where(~null if expr[2] else null, np.zeros(n, dtype=bool))
+        if kind == "exists":
+            return self.exists(expr[1], table)
+        value = self.value(expr, table)
+        if isinstance(value, _Bool):
+            return value
+        if isinstance(value, _Const) and (value.value is None or isinstance(value.value, bool)):
+            return _Bool.of(value.value, n)
+        raise Unsupported("non-boolean condition")
+
+    def exists(self, clauses, table):
+        probe = table.with_column(" row", np.arange(table.size, dtype=np.int64), label="?")
+        for clause in clauses:
+            probe = self.match(probe, clause)
+        found = np.zeros(table.size, dtype=bool)
+        found[probe.cols[" row"]] = True
+        return _Bool(found, ~found)
+
+    def nulls(self, value, n):
+        if isinstance(value, _Str):
+            return value.column.null[value.rows]
+        if isinstance(value, _Dates):
+            return value.values == NO_DATE
+        if isinstance(value, _Nums):
+            return value.null
+        if isinstance(value, _Const):
+            return np.full(n, value.value is None)
+        if isinstance(value, _Bool):
+            return ~value.t & ~value.f
+        return np.zeros(n, dtype=bool)
+
+    def compare(self, op, left, right, n):
+        if isinstance(left, _Const) and not isinstance(right, _Const):
+            if op not in MIRRORED:
+                return self.generic(op, left, right, n)
+            left, right, op = right, left, MIRRORED[op]
+        if isinstance(left, _Const) and isinstance(right, _Const):
+            a, b = left.value, right.value
+            if isinstance(a, _Instant) or isinstance(b, _Instant):
+                return _Bool.of(self.compare_instants(op, a, b), n)
+            return _Bool.of(_cypher_compare(op, a, b), n)
+        dates = isinstance(left, _Dates) or isinstance(right, _Dates) or \
+            (isinstance(right, _Const) and isinstance(right.value, _Instant))
+        if dates:
+            return self.compare_dates(op, left, right, n)
+        if isinstance(left, _Str) and isinstance(right, _Const):
+            needle = right.value
+            if needle is None:
+                return _Bool.of(None, n)
+            if not isinstance(needle, str):
+                return self.generic(op, left, right, n)
+            null = left.column.null[left.rows]
+            if op in ("=", "<>") and left.case is None and self.is_key(left.column):
+                row = self.key_table(left.column).index.get(needle, -1)
+                equal = left.rows == row
+            elif op in ("=", "<>", "contains", "starts", "ends"):
+                equal = left.column.test(left.rows, "=" if op == "<>" else op, needle, left.case)
+            else:
+                return self.generic(op, left, right, n)
+            return _Bool.where(~equal if op == "<>" else equal, null)
+        if isinstance(left, _NodeRef) and isinstance(right, _NodeRef) and op in ("=", "<>"):
+            equal = (left.rows == right.rows) if left.table is right.table else np.zeros(n, dtype=bool)
+            return _Bool.where(~equal if op == "<>" else equal, np.zeros(n, dtype=bool))
+        if isinstance(left, _Nums) and isinstance(right, (_Nums, _Const)):
+            other = right.values if isinstance(right, _Nums) else right.value
+            other_null = right.null if isinstance(right, _Nums) else np.full(n, other is None)
+            if other is None or not isinstance(other, (int, float, np.ndarray)) or isinstance(other, bool):
+                return self.generic(op, left, right, n)
+            return self.numeric(op, left.values, other, left.null | other_null)
+        return self.generic(op, left, right, n)
+
+    def is_key(self, column):
+        return any(table.columns[table.key] is column for table in self.engine.nodes.values())
+
+    def key_table(self, column):
+        return next(table for table in self.engine.nodes.values() if table.columns[table.key] is column)
+
+    def compare_instants(self, op, a, b):
+        if a is None or b is None:
+            return None
+        if not (isinstance(a, _Instant) and isinstance(b, _Instant)) or a.kind != b.kind:
+            return None if op not in ("=", "<>") else op == "<>"
+        return _cypher_compare(op, a.seconds, b.seconds)
+
+    def compare_dates(self, op, left, right, n):
+        if isinstance(left, _Const):
+            left, right, op = right, left, MIRRORED.get(op, op)
+        if op not in MIRRORED:
+            raise Unsupported(f"{op} on a date")
+        if not isinstance(left, _Dates):
+            return self.mismatch(op, self.nulls(left, n))
+        null = left.values == NO_DATE
+        if isinstance(right, _Dates):
+            if right.kind != left.kind:
+                return self.mismatch(op, null | (right.values == NO_DATE))
+            return self.numeric(op, left.values, right.values, null | (right.values == NO_DATE))
+        value = right.value if isinstance(right, _Const) else None
+        if isinstance(right, _Const) and value is None:
+            return _Bool.of(None, n)
+        if not isinstance(value, _Instant) or value.kind != left.kind:
+            # Cypher: a datetime is never equal to (or ordered against) anything else
+            return self.mismatch(op, null)
+        return self.numeric(op, left.values, value.seconds, null)
+
+    def mismatch(self, op, null):
+        n = len(null)
+        if op == "=":
+            return _Bool.where(np.zeros(n, dtype=bool), null)
+        if op == "<>":
+            return _Bool.where(np.ones(n, dtype=bool), null)
+        return _Bool.of(None, n)
+
+    def numeric(self, op, a, b, null):
+        result = {"=": np.equal, "<>": np.not_equal, "<": np.less, ">": np.greater,
+                  "<=": np.less_equal, ">=": np.greater_equal}[op](a, b)
+        return _Bool.where(np.asarray(result, dtype=bool), null)
+
+    def generic(self, op, left, right, n):
+        """Row by row on plain values, for the combinations without a vectorized path."""
+        if any(isinstance(v, (_Dates, _NodeRef, _RelRef, _Map, _Bool)) for v in (left, right)):
+            raise Unsupported(f"{op} between these values")
+        a, b = self.plain(left, n), self.plain(right, n)
+        results = [_cypher_compare(op, x, y) for x, y in zip(a, b)]
+        t = np.array([r is True for r in results], dtype=bool)
+        f = np.array([r is False for r in results], dtype=bool)
+        return _Bool(t, f)
+
+    def member(self, left, right, n):
+        if not isinstance(right, _Const) or not isinstance(right.value, (list, type(None))):
+            raise Unsupported("IN over a non-list")
+        if right.value is None:
+            return _Bool.of(None, n)
+        values = right.value
+        has_null = any(v is None for v in values)
+        if isinstance(left, _Str) and left.case is None and self.is_key(left.column):
+            found = np.isin(left.rows, self.key_table(left.column).rows_for(values))
+            null = left.column.null[left.rows]
+        elif isinstance(left, (_Str, _Nums, _Const)):
+            plain = self.plain(left, n)
+            try:
+                wanted = {v for v in values if v is not None}
+                found = np.array([v in wanted for v in plain], dtype=bool)
+            except TypeError:
+                raise Unsupported("IN over unhashable values")
+            null = np.array([v is None for v in plain], dtype=bool)
+        else:
+            raise Unsupported("IN on this value")
+        if has_null:
+            # x IN [..., null] is null rather than false when x isn't found
+            null = null | ~found
+        return _Bool.where(found, null)
+
+    def plain(self, value, n):
+        """Python values for each row, as they appear in result rows."""
+        if isinstance(value, _Const):
+            v = value.value
+            if isinstance(v, _Instant):
+                v = _iso(v.seconds, v.kind)
+            return [v] * n
+        if isinstance(value, _Str):
+            return value.column.values(value.rows, value.case)
+        if isinstance(value, _Dates):
+            strings = np.datetime_as_string(np.where(value.values == NO_DATE, 0, value.values).astype("datetime64[s]"),
+                                            unit="D" if value.kind == "date" else "s")
+            suffix = "" if value.kind == "date" else "Z"
+            return [None if missing else s + suffix for s, missing in zip(strings.tolist(),
+                                                                       (value.values == NO_DATE).tolist())]
+        if isinstance(value, _Nums):
+            return [None if missing else v for v, missing in zip(value.values.tolist(), value.null.tolist())]
+        if isinstance(value, _Bool):
+            return [True if t else False if f else None for t, f in zip(value.t.tolist(), value.f.tolist())]
+        if isinstance(value, _NodeRef):
+            if value.table.missing:
+                raise Unsupported(f"whole {value.table.label} nodes without {', '.join(sorted(value.table.missing))}")
+            columns = {}
+            for prop, column in value.table.columns.items():
+                columns[prop] = self.plain(_Str(column, value.rows) if isinstance(column, StringColumn)
+                                           else _Dates(column[value.rows]), n)
+            return [{prop: vals[i] for prop, vals in columns.items() if vals[i] is not None} for i in range(n)]
+        if isinstance(value, _Map):
+            columns = [(key, self.plain(item, n)) for key, item in value.entries]
+            return [{key: vals[i] for key, vals in columns} for i in range(n)]
+        raise Unsupported("returning a relationship")
+
+    def sort_keys(self, value, n):
+        """Comparable values per row for grouping, DISTINCT and ORDER BY (None for null)."""
+        if isinstance(value, _NodeRef):
+            return value.rows.tolist()
+        if isinstance(value, _Map):
+            return self.sort_keys(value.base, n)
+        if isinstance(value, _Dates):
+            return [None if v == NO_DATE else v for v in value.values.tolist()]
+        if isinstance(value, _Const) and isinstance(value.value, _Instant):
+            return [value.value.seconds] * n
+        return self.plain(value, n)
+
+    # RETURN
+
+    def group_keys(self, value, n):
+        """An int array identifying equal values per row where one exists cheaply, else sort_keys."""
+        if isinstance(value, _NodeRef):
+            return value.rows
+        if isinstance(value, _Map):
+            return self.group_keys(value.base, n)
+        if isinstance(value, _Str) and value.case is None and self.is_key(value.column):
+            # Key properties are unique per node, so equal rows mean equal values
+            return value.rows
+        if isinstance(value, _Dates):
+            return value.values
+        return self.sort_keys(value, n)
+
+    def project(self, table, plan):
+        items = plan["items"]
+        aggregated = any(_is_aggregate(expr) for expr, _ in items)
+        if not aggregated and not plan["distinct"]:
+            order = self.binding_order(table, plan)
+            rows = self.page(order, plan)
+            table = table.take(rows)
+            return self.materialize(table, items)
+        if not aggregated:
+            rows = self.materialize(table, items)
+            count, column = len(rows), lambda key: [row[key] for row in rows]
+        else:
+            count, column, finish = self.aggregate(table, items)
+        if plan["distinct"]:
+            rows = [{key: values[g] for key, values in ((k, column(k)) for _, k in items)} for g in range(count)]
+            seen, unique = set(), []
+            for row in rows:
+                key = repr(sorted(row.items()))
+                if key not in seen:
+                    seen.add(key)
+                    unique.append(row)
+            rows = unique
+            count, column = len(rows), lambda key: [row[key] for row in rows]
+            finish = lambda selected: [rows[i] for i in selected]
+        index = np.arange(count)
+        if plan["order"]:
+            index = np.array(self.ordered_groups(count, column, items, plan["order"]), dtype=np.int64)
+        return finish(self.page(index, plan).tolist())
+
+    def materialize(self, table, items):
+        columns = [(key, self.plain(self.value(expr, table), table.size)) for expr, key in items]
+        return [{key: values[i] for key, values in columns} for i in range(table.size)]
+
+    def page(self, order, plan):
+        skip = self.count_param(plan["skip"])
+        limit = self.count_param(plan["limit"])
+        if skip:
+            order = order[skip:]
+        if limit is not None:
+            order = order[:limit]
+        return order
+
+    def count_param(self, expr):
+        if expr is None:
+            return None
+        value = self.constant(expr)
+        if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+            raise Unsupported("SKIP/LIMIT must be a non-negative integer")
+        return value
+
+    def binding_order(self, table, plan):
+        index = np.arange(table.size)
+        if not plan["order"]:
+            return index
+        aliases = {key: expr for expr, key in plan["items"]}
+        keys = []
+        for expr, descending in plan["order"]:
+            if expr[0] == "var" and expr[1] in aliases:
+                # A returned alias shadows the variable of the same name
+                expr = aliases[expr[1]]
+            if expr[0] == "var" and expr[1] in table.labels:
+                raise Unsupported("ORDER BY a node")
+            keys.append((self.sort_keys(self.value(expr, table), table.size), descending))
+        return np.array(self.sorted_index(table.size, keys), dtype=np.int64)
+
+    def sorted_index(self, n, keys):
+        arrays = [np.array(values) for values, _ in keys]
+        if all(a.dtype.kind in "iuf" for a in arrays):
+            # No nulls and all numbers: one vectorized stable sort
+            return np.lexsort([-a if descending else a for a, (_, descending) in reversed(list(zip(arrays, keys)))])
+        index = list(range(n))
+        try:
+            # Stable sorts from the last key to the first; null sorts last ascending, first descending
+            for values, descending in reversed(keys):
+                index.sort(key=lambda i: (values[i] is None, values[i] if values[i] is not None else 0),
+                           reverse=descending)
+        except TypeError:
+            raise Unsupported("ORDER BY over mixed types")
+        return index
+
+    def ordered_groups(self, count, column, items, order):
+        """Result row order for ORDER BY over returned columns; `column(key)` gives a column's values."""
+        texts = {repr(expr): key for expr, key in items}
+        returned = {key for _, key in items}
+        keys = []
+        for expr, descending in order:
+            key = texts.get(repr(expr))
+            if key is None and expr[0] == "var" and expr[1] in returned:
+                key = expr[1]
+            if key is not None:
+                values = column(key)
+            elif expr[0] == "prop" and expr[1][0] == "var" and expr[1][1] in returned:
+                values = [value.get(expr[2]) if isinstance(value, dict) else None for value in column(expr[1][1])]
+            else:
+                raise Unsupported("ORDER BY an expression that isn't returned")
+            keys.append((values, descending))
+        return self.sorted_index(count, keys)
+
+    def aggregate(self, table, items):
+        """
+        (group count, column(key), finish(selected groups) -> rows). Aggregates are
+        computed for every group; grouping columns only for the groups asked for.
+        """
+        n = table.size
+        group_items = [(expr, key) for expr, key in items if not _is_aggregate(expr)]
+        if group_items:
+            key_lists = [self.group_keys(self.value(expr, table), n) for expr, _ in group_items]
+            if all(isinstance(keys, np.ndarray) for keys in key_lists):
+                stacked = np.stack(key_lists, axis=1) if len(key_lists) > 1 else key_lists[0]
+                _, firsts, group_of = np.unique(stacked, axis=0 if len(key_lists) > 1 else None,
+                                                return_index=True, return_inverse=True)
+                # Groups in order of first appearance, as the row-by-row path has them
+                order = np.argsort(firsts, kind="stable")
+                rank = np.empty(len(order), dtype=np.int64)
+                rank[order] = np.arange(len(order))
+                group_of, firsts = rank[group_of.reshape(-1)], firsts[order]
+            else:
+                groups, group_of, firsts = {}, np.empty(n, dtype=np.int64), []
+                try:
+                    for i, key in enumerate(zip(*(k.tolist() if isinstance(k, np.ndarray) else k
+                                                  for k in key_lists))):
+                        g = groups.get(key)
+                        if g is None:
+                            g = groups[key] = len(firsts)
+                            firsts.append(i)
+                        group_of[i] = g
+                except TypeError:
+                    raise Unsupported("grouping by unhashable values")
+                firsts = np.array(firsts, dtype=np.int64)
+            count = len(firsts)
+        else:
+            group_of, firsts, count = np.zeros(n, dtype=np.int64), None, 1
+        columns = {}
+        for expr, key in items:
+            if _is_aggregate(expr):
+                columns[key] = self.aggregate_column(expr, table, group_of, count)
+        grouping = dict((key, expr) for expr, key in group_items)
+
+        def column(key):
+            if key not in columns:
+                columns[key] = self.plain(self.value(grouping[key], table.take(firsts)), count)
+            return columns[key]
+
+        def finish(selected):
+            values = {}
+            for expr, key in items:
+                if key in columns:
+                    values[key] = [columns[key][g] for g in selected]
+                else:
+                    values[key] = self.plain(self.value(expr, table.take(firsts[selected])), len(selected))
+            return [{key: values[key][i] for _, key in items} for i in range(len(selected))]
+
+        return count, column, finish
+
+    def aggregate_column(self, expr, table, group_of, count):
+        _, name, distinct, args = expr
+        n = table.size
+        if name == "count" and not args:
+            return np.bincount(group_of, minlength=count).tolist()
+        if len(args) != 1:
+            raise Unsupported(f"{name}() with {len(args)} arguments")
+        value = self.value(args[0], table)
+        present = ~self.nulls(value, n)
+        if name == "count" and not distinct:
+            return np.bincount(group_of, weights=present, minlength=count).astype(np.int64).tolist()
+        keys = self.sort_keys(value, n)
+        if name == "count":
+            pairs = {(g, k) for g, k, p in zip(group_of.tolist(), keys, present.tolist()) if p}
+            return np.bincount(np.array([g for g, _ in pairs], dtype=np.int64), minlength=count).tolist()
+        if name == "collect":
+            plain = self.plain(value, n)
+            out, seen = [[] for _ in range(count)], set()
+            for g, k, v, p in zip(group_of.tolist(), keys, plain, present.tolist()):
+                if not p:
+                    continue
+                if distinct:
+                    try:
+                        if (g, k) in seen:
+                            continue
+                        seen.add((g, k))
+                    except TypeError:
+                        raise Unsupported("collect(DISTINCT) of unhashable values")
+                out[g].append(v)
+            return out
+        if isinstance(value, (_NodeRef, _Map, _Bool)):
+            raise Unsupported(f"{name}() of this value")
+        plain = self.plain(value, n)
+        best = [None] * count
+        members = [[] for _ in range(count)]
+        for g, k, v, p in zip(group_of.tolist(), keys, plain, present.tolist()):
+            if p:
+                members[g].append((k, v))
+        for g, values in enumerate(members):
+            if not values:
+                best[g] = 0 if name == "sum" else None
+                continue
+            try:
+                if name == "min":
+                    best[g] = min(values, key=lambda kv: kv[0])[1]
+                elif name == "max":
+                    best[g] = max(values, key=lambda kv: kv[0])[1]
+                else:
+                    numbers = [v for _, v in values]
+                    if not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in numbers):
+                        raise Unsupported(f"{name}() of non-numbers")
+                    best[g] = sum(numbers) if name == "sum" else sum(numbers) / len(numbers)
+            except TypeError:
+                raise Unsupported(f"{name}() over mixed types")
+        return best
+
+
+# --- serving -------------------------------------------------------------------
+
+class GraphEngineStore:
+    """
+    Serves a GraphEngine snapshot of the Neo4j graph, rebuilt in the
+    background when the dataset generation changes. `current()` is None
+    until a snapshot of the current generation is loaded, so queries go to
+    Neo4j meanwhile. `on_load(engine, generation)` is called after each
+    load (e.g. to refresh the person index without another Neo4j read).
+    """
+
+    def __init__(self, driver=None, generation=None, on_load=None):
+        self.driver = driver
+        self.generation = generation
+        self.on_load = on_load
+        self.engine = None
+        self._engine_generation = None
+        self._loading = False
+        self._attempted_at = 0.0
+        self._failures = 0
+        self._lock = threading.Lock()
+
+    def set(self, engine):
+        """Serve an engine built elsewhere (e.g. straight from the CSV) and never reload it."""
+        self.engine, self.generation = engine, None
+
+    def warm_up(self):
+        if self.generation is not None:
+            self._start_reload(self.generation.current())
+
+    def current(self):
+        if self.generation is None:
+            return self.engine
+        generation = self.generation.current()
+        if generation != self._engine_generation:
+            self._start_reload(generation)
+            return None
+        return self.engine
+
+    def _retry_seconds(self):
+        # Each load exports the whole graph, so failed ones back off exponentially
+        poll = self.generation.poll_seconds
+        return min(poll * 2 ** min(self._failures, 30), max(GRAPH_ENGINE_RETRY_MAX, poll))
+
+    def _start_reload(self, generation):
+        with self._lock:
+            if self._loading or time.monotonic() - self._attempted_at < self._retry_seconds():
+                return
+            self._loading = True
+            self._attempted_at = time.monotonic()
+        threading.Thread(target=self._reload, args=(generation,), name="graph-engine", daemon=True).start()
+
+    def _reload(self, generation):
+        try:
+            started = time.perf_counter()
+            engine = GraphEngine.from_neo4j(self.driver)
+            self.engine, self._engine_generation = engine, generation
+            self._failures = 0
+            logger.info("Graph engine loaded: %d nodes, %d edges, %.1f MB in %.1fs (generation %s)",
+                        len(engine), engine.edge_count, engine.nbytes / 2 ** 20,
+                        time.perf_counter() - started, generation)
+            if self.on_load is not None:
+                self.on_load(engine, generation)
+        except Exception as e:
+            self._failures += 1
+            logger.warning("Graph engine load failed, next attempt in %.0fs: %s", self._retry_seconds(), e)
+        finally:
+            with self._lock:
+                self._loading = False
+
+
+class EngineFirst:
+    """
+    A database wrapper whose execute_cypher / stream_cypher answer from the
+    store's GraphEngine when it supports the query and from `database`
+    otherwise. Every other attribute (driver, generation, result_cache, ...)
+    is the wrapped database's.
+    """
+
+    def __init__(self, database, store):
+        self.database = database
+        self.store = store
+        self.served = 0
+        self.fallbacks = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.database, name)
+
+    def stats(self):
+        with self._lock:
+            return {"served": self.served, "fallbacks": self.fallbacks, "errors": self.errors}
+
+    def _count(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    def execute_cypher(self, query, params=None):
+        rows = []
+        for batch in self.stream_cypher(query, params):
+            rows.extend(batch)
+        return rows
+
+    def stream_cypher(self, query, params=None, batch_size=None):
+        engine = self.store.current()
+        if engine is not None:
+            try:
+                rows = engine.run(query, params)
+            except Unsupported as e:
+                self._count("fallbacks")
+                logger.debug("Graph engine passed on %r: %s", query, e)
+            except Exception as e:
+                self._count("errors")
+                logger.warning("Graph engine failed on %r, using the database: %s", query, e)
+            else:
+                self._count("served")
+                size = batch_size or len(rows) or 1
+                for i in range(0, len(rows), size):
+                    yield rows[i:i + size]
+                return
+        kwargs = {} if batch_size is None else {"batch_size": batch_size}
+        yield from self.database.stream_cypher(query, params, **kwargs)
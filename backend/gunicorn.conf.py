@@ -0,0 +1,15 @@
+"""
+gunicorn settings for server.py: the spaCy model is loaded once here, in
+the master, and shared copy-on-write by the workers forked from it.
+
+The app itself is not preloaded (no --preload): importing server.py opens
+the Neo4j driver and starts the person-index and graph-engine warm-up
+threads, and a forked worker would share the driver's sockets and inherit
+a warm-up marked as running with no thread behind it.
+
+    cd backend
+    gunicorn -c gunicorn.conf.py -w 4 server:app
+"""
+from ner import preload_model
+
+preload_model()
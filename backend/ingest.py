@@ -0,0 +1,563 @@
+"""
+Bulk loader for the email CSVs (replaces the row-by-row load in load_data.ipynb).
+
+Streams the CSV in chunks and writes each chunk in phases (persons, emails,
+relationships, responsive links). Every phase sends `UNWIND $rows` batches
+over a pool of parallel writer sessions. Progress is checkpointed after each
+chunk so an interrupted load can be resumed.
+
+With --incremental, a manifest of MessageID -> content hash and edge list
+from the previous run is diffed against the CSV, and only new or changed
+emails and the recipient edges that actually changed are written.
+
+Either way, the per-email table behind analytics.py (counts per person,
+sender/recipient pairs, dates) is updated alongside and saved to
+--analytics, which the server reloads for its fast path. So is the keyword
+index (--fulltext) the server uses in place of CONTAINS scans; Neo4j's own
+full-text index on the email text is created with the constraints.
+
+    python ingest.py --csv Prompt_Eng_Topic_303_2-20.csv --workers 4
+    python ingest.py --csv big.csv --checkpoint big.ckpt --resume
+    python ingest.py --csv export.csv --incremental --manifest export.manifest --delete-missing
+
+--csv also takes a directory written by email_table.py, which is read
+without parsing the CSV again.
+"""
+import os
+import json
+import sqlite3
+import hashlib
+import math
+import time
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from neo4j import GraphDatabase
+from neo4j.exceptions import ClientError
+
+from database import NEO4J_DATABASE
+from dataset_version import bump_generation
+from analytics import EmailAnalytics, ANALYTICS_PATH
+from fulltext import TextIndex, FULLTEXT_PATH, CREATE_FULLTEXT_INDEX
+from email_table import read_chunks
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+NEO4J_URI = os.getenv("NEO4J_URI", "bolt://localhost:7687")
+NEO4J_USER = os.getenv("NEO4J_USER", "neo4j")
+NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "ML10051005")
+
+TOPIC_NAME = "Topic 303"
+CHUNK_SIZE = 2000
+BATCH_SIZE = 500
+WORKERS = 4
+MANIFEST_PATH = "ingest_manifest.db"
+
+# Column -> relationship type from (:Person) to (:Email)
+RECIPIENT_COLUMNS = {"To": "RECEIVE", "Cc": "Cc", "Bcc": "Bcc"}
+RELATIONSHIP_TYPES = ("SEND", "RECEIVE", "Cc", "Bcc")
+
+CONSTRAINTS = {
+    "email_id_unique": ("Email", "id"),
+    "person_id_unique": ("Person", "id"),
+    "topic_name_unique": ("Topic", "name"),
+}
+
+MERGE_PERSONS = """
+UNWIND $rows AS id
+MERGE (:Person {id: id})
+"""
+
+MERGE_EMAILS = """
+UNWIND $rows AS row
+MERGE (email:Email {id: row.id})
+SET email.date_time = datetime(row.date),
+    email.subject = row.subject,
+    email.content = row.content,
+    email.relevant = row.relevant,
+    email.analysis = row.analysis
+"""
+
+# Relationship types can't be parameters; filled from RELATIONSHIP_TYPES only
+MERGE_RELATIONSHIPS = """
+UNWIND $rows AS row
+MATCH (p:Person {{id: row.person}})
+MATCH (email:Email {{id: row.email}})
+MERGE (p)-[:{rel_type}]->(email)
+"""
+
+MERGE_RESPONSIVE = """
+MERGE (t:Topic {name: $topic})
+WITH t
+UNWIND $rows AS row
+MATCH (email:Email {id: row.id})
+MERGE (email)-[r:RESPONSIVE]->(t)
+SET r.analysis = row.analysis
+"""
+
+DELETE_RELATIONSHIPS = """
+UNWIND $rows AS row
+MATCH (:Person {{id: row.person}})-[r:{rel_type}]->(:Email {{id: row.email}})
+DELETE r
+"""
+
+DELETE_RESPONSIVE = """
+UNWIND $rows AS id
+MATCH (:Email {id: id})-[r:RESPONSIVE]->(:Topic {name: $topic})
+DELETE r
+"""
+
+DELETE_EMAILS = """
+UNWIND $rows AS id
+MATCH (email:Email {id: id})
+DETACH DELETE email
+"""
+
+DELETE_ORPHAN_PERSONS = """
+UNWIND $rows AS id
+MATCH (p:Person {id: id})
+WHERE NOT (p)--()
+DELETE p
+"""
+
+
+def clean(val):
+    return str(val).strip().lower().replace('"', '') if pd.notna(val) else None
+
+
+def _value(val):
+    return None if pd.isna(val) else val
+
+
+def split_addresses(val):
+    if pd.isna(val):
+        return []
+    return [r.strip() for r in str(val).split(',') if r.strip()]
+
+
+def parse_chunk(df):
+    """
+    One dict per email in a DataFrame chunk: its node properties ('email'),
+    its Person edges as sorted [rel_type, person] pairs ('edges') and whether
+    it is responsive.
+    """
+    parsed = []
+    for row in df.itertuples(index=False):
+        message_id = _value(row.MessageID)
+        if message_id is None:
+            continue
+        relevant = clean(row.Relevant)
+        edges = set()
+        sender = _value(row.From)
+        if sender:
+            edges.add(("SEND", sender))
+        for column, rel_type in RECIPIENT_COLUMNS.items():
+            for address in split_addresses(getattr(row, column)):
+                edges.add((rel_type, address))
+        parsed.append({
+            "email": {
+                "id": message_id,
+                "date": _value(row.Date),
+                "subject": _value(row.Subject),
+                "content": _value(row.segmented_content),
+                "relevant": relevant,
+                "analysis": _value(row.Analysis),
+            },
+            "edges": sorted(list(edge) for edge in edges),
+            "responsive": relevant == "yes",
+        })
+    return parsed
+
+
+def group_for_write(parsed, edges=None):
+    """
+    Parameter lists for each write phase: 'persons', 'emails',
+    'relationships' (by type) and 'responsive'. `edges` overrides the
+    [rel_type, person, email] triples to write (default: all of them).
+    """
+    if edges is None:
+        edges = [(rel_type, person, item["email"]["id"]) for item in parsed for rel_type, person in item["edges"]]
+    relationships = {rel_type: [] for rel_type in RELATIONSHIP_TYPES}
+    persons = set()
+    for rel_type, person, email_id in edges:
+        persons.add(person)
+        relationships[rel_type].append({"person": person, "email": email_id})
+    return {
+        "persons": sorted(persons),
+        "emails": [item["email"] for item in parsed],
+        "relationships": relationships,
+        "responsive": [
+            {"id": item["email"]["id"], "analysis": item["email"]["analysis"]}
+            for item in parsed if item["responsive"]
+        ],
+    }
+
+
+def prepare_chunk(df):
+    return group_for_write(parse_chunk(df))
+
+
+def content_hash(email):
+    """Stable hash of an email's node properties."""
+    encoded = json.dumps(email, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+def _batches(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+class Ingestor:
+    def __init__(self, driver, workers=WORKERS, batch_size=BATCH_SIZE, topic=TOPIC_NAME):
+        self.driver = driver
+        self.workers = workers
+        self.batch_size = batch_size
+        self.topic = topic
+        self._pool = ThreadPoolExecutor(max_workers=workers)
+
+    def close(self):
+        self._pool.shutdown()
+
+    def create_constraints(self):
+        """
+        Uniqueness constraints (which also back the MERGE lookups with an
+        index). A plain index left on the same property by the old notebook
+        blocks the constraint, so it is dropped first.
+        """
+        with self.driver.session(database=NEO4J_DATABASE) as session:
+            indexes = session.run(
+                "SHOW INDEXES YIELD name, labelsOrTypes, properties, owningConstraint "
+                "RETURN name, labelsOrTypes, properties, owningConstraint"
+            ).data()
+            for name, (label, prop) in CONSTRAINTS.items():
+                for index in indexes:
+                    if (index["owningConstraint"] is None and index["labelsOrTypes"] == [label]
+                            and index["properties"] == [prop]):
+                        logger.info("Dropping index %s to replace it with a constraint", index["name"])
+                        session.run(f"DROP INDEX `{index['name']}` IF EXISTS").consume()
+                try:
+                    session.run(
+                        f"CREATE CONSTRAINT {name} IF NOT EXISTS "
+                        f"FOR (n:{label}) REQUIRE n.{prop} IS UNIQUE"
+                    ).consume()
+                except ClientError as e:
+                    logger.warning("Could not create constraint %s: %s", name, e)
+            # Lucene index over subject/content/analysis; Neo4j keeps it current on every write
+            try:
+                session.run(CREATE_FULLTEXT_INDEX).consume()
+            except ClientError as e:
+                logger.warning("Could not create the full-text index: %s", e)
+
+    def _write(self, query, rows, **params):
+        def work(tx):
+            tx.run(query, rows=rows, **params).consume()
+        with self.driver.session(database=NEO4J_DATABASE) as session:
+            session.execute_write(work)
+
+    def run_phase(self, query, items, **params):
+        """Write `items` in batches spread over the writer pool; waits for all of them."""
+        futures = [
+            self._pool.submit(self._write, query, batch, **params)
+            for batch in _batches(items, self.batch_size)
+        ]
+        for future in futures:
+            future.result()
+
+    def write_chunk(self, prepared):
+        # Nodes first so the relationship phases only need MATCH
+        self.run_phase(MERGE_PERSONS, prepared["persons"])
+        self.run_phase(MERGE_EMAILS, prepared["emails"])
+        for rel_type, rows in prepared["relationships"].items():
+            if rel_type not in RELATIONSHIP_TYPES:
+                raise ValueError(f"Unknown relationship type {rel_type}")
+            self.run_phase(MERGE_RELATIONSHIPS.format(rel_type=rel_type), rows)
+        self.run_phase(MERGE_RESPONSIVE, prepared["responsive"], topic=self.topic)
+
+    def remove_edges(self, edges):
+        """Delete [rel_type, person, email] edges, then any Person left with none."""
+        by_type = {rel_type: [] for rel_type in RELATIONSHIP_TYPES}
+        for rel_type, person, email_id in edges:
+            by_type[rel_type].append({"person": person, "email": email_id})
+        for rel_type, rows in by_type.items():
+            self.run_phase(DELETE_RELATIONSHIPS.format(rel_type=rel_type), rows)
+        self.run_phase(DELETE_ORPHAN_PERSONS, sorted({person for _, person, _ in edges}))
+
+    def bump_generation(self):
+        with self.driver.session(database=NEO4J_DATABASE) as session:
+            return session.execute_write(bump_generation)
+
+
+class Manifest:
+    """
+    What the last incremental run wrote, per MessageID: the content hash,
+    the edge list and the responsive flag, plus the id of the run that last
+    saw it in the CSV (used to find emails that have been removed).
+    """
+
+    def __init__(self, path=MANIFEST_PATH):
+        self._db = sqlite3.connect(path)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS emails (id TEXT PRIMARY KEY, content_hash TEXT NOT NULL, "
+            "edges TEXT NOT NULL, responsive INTEGER NOT NULL, run_id TEXT NOT NULL)"
+        )
+        self._db.commit()
+
+    def get_many(self, ids):
+        known = {}
+        ids = list(ids)
+        # Stay under SQLite's bound-parameter limit
+        for batch in _batches(ids, 500):
+            placeholders = ",".join("?" * len(batch))
+            for row in self._db.execute(
+                f"SELECT id, content_hash, edges, responsive FROM emails WHERE id IN ({placeholders})", batch
+            ):
+                known[row[0]] = {"content_hash": row[1], "edges": json.loads(row[2]), "responsive": bool(row[3])}
+        return known
+
+    def record(self, entries, run_id):
+        self._db.executemany(
+            "INSERT OR REPLACE INTO emails (id, content_hash, edges, responsive, run_id) VALUES (?, ?, ?, ?, ?)",
+            [(e["id"], e["content_hash"], json.dumps(e["edges"]), int(e["responsive"]), run_id) for e in entries],
+        )
+        self._db.commit()
+
+    def missing(self, run_id):
+        """Entries not seen by run `run_id`: {id: edges}."""
+        return {
+            row[0]: json.loads(row[1])
+            for row in self._db.execute("SELECT id, edges FROM emails WHERE run_id != ?", (run_id,))
+        }
+
+    def forget(self, ids):
+        self._db.executemany("DELETE FROM emails WHERE id = ?", [(i,) for i in ids])
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+def diff_chunk(parsed, known):
+    """
+    Compare parsed emails with their manifest entries. Returns the emails
+    whose properties are new or changed, the [rel_type, person, email]
+    edges to add and to remove, the ids that stopped being responsive and
+    the new manifest entries.
+    """
+    # A repeated MessageID keeps its last row, as the full loader's SET does
+    latest = {item["email"]["id"]: item for item in parsed}
+    changed, added, removed, unresponsive, entries = [], [], [], [], []
+    for email_id, item in latest.items():
+        digest = content_hash(item["email"])
+        prev = known.get(email_id)
+        if prev is None or prev["content_hash"] != digest:
+            changed.append(item)
+        new_edges = set(map(tuple, item["edges"]))
+        old_edges = set(map(tuple, prev["edges"])) if prev else set()
+        added.extend((rel_type, person, email_id) for rel_type, person in sorted(new_edges - old_edges))
+        removed.extend((rel_type, person, email_id) for rel_type, person in sorted(old_edges - new_edges))
+        if prev and prev["responsive"] and not item["responsive"]:
+            unresponsive.append(email_id)
+        entries.append({"id": email_id, "content_hash": digest, "edges": item["edges"],
+                        "responsive": item["responsive"]})
+    return changed, added, removed, unresponsive, entries
+
+
+def load_analytics(path, topic=TOPIC_NAME):
+    """The analytics saved by an earlier run, or an empty table."""
+    if path and os.path.exists(path):
+        try:
+            return EmailAnalytics.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Could not read analytics %s (%s), rebuilding it", path, e)
+    return EmailAnalytics(topic=topic)
+
+
+def load_text_index(path):
+    """(index, complete): the keyword index saved by an earlier run, or an empty one to fill from scratch."""
+    if path and os.path.exists(path):
+        try:
+            return TextIndex.load(path), True
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning("Could not read full-text index %s (%s), rebuilding it", path, e)
+    return TextIndex(), False
+
+
+def ingest_incremental(driver, csv_path, manifest_path=MANIFEST_PATH, chunk_size=CHUNK_SIZE,
+                       batch_size=BATCH_SIZE, workers=WORKERS, delete_missing=False,
+                       analytics_path=ANALYTICS_PATH, fulltext_path=FULLTEXT_PATH):
+    """
+    Write only what changed since the run recorded in the manifest. The
+    manifest is updated after each chunk's writes succeed, so rerunning
+    after a failure simply picks up the remaining differences. The dataset
+    generation is bumped only if anything was written.
+    """
+    ingestor = Ingestor(driver, workers=workers, batch_size=batch_size)
+    manifest = Manifest(manifest_path)
+    analytics = load_analytics(analytics_path, ingestor.topic)
+    text_index, text_complete = load_text_index(fulltext_path)
+    run_id = str(time.time_ns())
+    stats = {"rows": 0, "emails_written": 0, "edges_added": 0, "edges_removed": 0, "emails_deleted": 0}
+    started = time.perf_counter()
+    try:
+        ingestor.create_constraints()
+        for i, parsed in enumerate(read_chunks(csv_path, chunk_size)):
+            known = manifest.get_many(item["email"]["id"] for item in parsed)
+            changed, added, removed, unresponsive, entries = diff_chunk(parsed, known)
+            if removed:
+                ingestor.remove_edges(removed)
+            if unresponsive:
+                ingestor.run_phase(DELETE_RESPONSIVE, unresponsive, topic=ingestor.topic)
+            if changed or added:
+                ingestor.write_chunk(group_for_write(changed, edges=added))
+            manifest.record(entries, run_id)
+            # Cheap enough to refresh every email, changed or not; keeps a lost analytics file self-healing
+            analytics.upsert(parsed)
+            # An incomplete keyword index would hide matches, so a missing one is rebuilt from every row
+            text_index.upsert(changed if text_complete else parsed)
+            stats["rows"] += len(parsed)
+            stats["emails_written"] += len(changed)
+            stats["edges_added"] += len(added)
+            stats["edges_removed"] += len(removed)
+            logger.info("Chunk %d: %d rows, %d emails written, %d edges added, %d removed",
+                        i + 1, len(parsed), len(changed), len(added), len(removed))
+        if delete_missing:
+            missing = manifest.missing(run_id)
+            if missing:
+                ids = list(missing)
+                ingestor.run_phase(DELETE_EMAILS, ids)
+                persons = sorted({person for edges in missing.values() for _, person in edges})
+                ingestor.run_phase(DELETE_ORPHAN_PERSONS, persons)
+                manifest.forget(ids)
+                analytics.remove(ids)
+                text_index.remove(ids)
+                stats["emails_deleted"] = len(ids)
+        if analytics_path:
+            analytics.save(analytics_path)
+        if fulltext_path:
+            text_index.save(fulltext_path)
+        generation = None
+        if stats["emails_written"] or stats["edges_added"] or stats["edges_removed"] or stats["emails_deleted"]:
+            generation = ingestor.bump_generation()
+    finally:
+        ingestor.close()
+        manifest.close()
+    logger.info("Incremental import complete in %.1fs: %s, dataset generation %s",
+                time.perf_counter() - started, stats,
+                generation if generation is not None else "unchanged")
+    return stats
+
+
+def load_checkpoint(path, csv_path, chunk_size):
+    if not path or not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        state = json.load(f)
+    if state.get("csv") != os.path.abspath(csv_path) or state.get("chunk_size") != chunk_size:
+        logger.warning("Checkpoint %s is for a different file or chunk size, ignoring it", path)
+        return 0
+    return state.get("chunks_done", 0)
+
+
+def save_checkpoint(path, csv_path, chunk_size, chunks_done, rows_done):
+    if not path:
+        return
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump({
+            "csv": os.path.abspath(csv_path),
+            "chunk_size": chunk_size,
+            "chunks_done": chunks_done,
+            "rows_done": rows_done,
+        }, f)
+    os.replace(tmp, path)
+
+
+def ingest_csv(driver, csv_path, chunk_size=CHUNK_SIZE, batch_size=BATCH_SIZE, workers=WORKERS,
+               checkpoint=None, resume=False, analytics_path=ANALYTICS_PATH, fulltext_path=FULLTEXT_PATH):
+    ingestor = Ingestor(driver, workers=workers, batch_size=batch_size)
+    analytics = EmailAnalytics(topic=ingestor.topic)
+    text_index = TextIndex()
+    skip_chunks = load_checkpoint(checkpoint, csv_path, chunk_size) if resume else 0
+    rows_done = 0
+    started = time.perf_counter()
+    try:
+        logger.info("Creating constraints...")
+        ingestor.create_constraints()
+        for i, parsed in enumerate(read_chunks(csv_path, chunk_size)):
+            # Chunks skipped on resume are already in Neo4j but still belong in the analytics
+            analytics.upsert(parsed)
+            text_index.upsert(parsed)
+            if i < skip_chunks:
+                continue
+            chunk_started = time.perf_counter()
+            ingestor.write_chunk(group_for_write(parsed))
+            rows_done += len(parsed)
+            save_checkpoint(checkpoint, csv_path, chunk_size, i + 1, rows_done)
+            elapsed = time.perf_counter() - started
+            logger.info(
+                "Chunk %d: %d rows in %.2fs (%.0f rows/s overall, %d rows this run)",
+                i + 1, len(parsed), time.perf_counter() - chunk_started,
+                rows_done / elapsed if elapsed else math.inf, rows_done,
+            )
+        if analytics_path:
+            analytics.save(analytics_path)
+        if fulltext_path:
+            text_index.save(fulltext_path)
+        generation = ingestor.bump_generation()
+    finally:
+        ingestor.close()
+    elapsed = time.perf_counter() - started
+    logger.info("Import complete: %d rows in %.1fs (%.0f rows/s), dataset generation %s",
+                rows_done, elapsed, rows_done / elapsed if elapsed else math.inf, generation)
+    return rows_done
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load an email CSV into Neo4j.")
+    parser.add_argument("--csv", default="Prompt_Eng_Topic_303_2-20.csv",
+                        help="email CSV, or a table converted from one by email_table.py")
+    parser.add_argument("--uri", default=NEO4J_URI)
+    parser.add_argument("--user", default=NEO4J_USER)
+    parser.add_argument("--password", default=NEO4J_PASSWORD)
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="emails read per chunk")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="rows per UNWIND write")
+    parser.add_argument("--workers", type=int, default=WORKERS, help="parallel writer sessions")
+    parser.add_argument("--checkpoint", help="file recording progress after each chunk")
+    parser.add_argument("--resume", action="store_true", help="skip chunks recorded in --checkpoint")
+    parser.add_argument("--incremental", action="store_true",
+                        help="write only emails/edges that changed since the run recorded in --manifest")
+    parser.add_argument("--manifest", default=MANIFEST_PATH, help="manifest file used by --incremental")
+    parser.add_argument("--delete-missing", action="store_true",
+                        help="with --incremental, delete emails that are no longer in the CSV")
+    parser.add_argument("--analytics", default=ANALYTICS_PATH,
+                        help="where to save the aggregates the server answers count questions from ('' to skip)")
+    parser.add_argument("--fulltext", default=FULLTEXT_PATH,
+                        help="where to save the keyword index the server narrows CONTAINS with ('' to skip)")
+    args = parser.parse_args(argv)
+    if args.incremental and args.resume:
+        parser.error("--resume is not needed with --incremental; rerunning skips what was already written")
+    if args.delete_missing and not args.incremental:
+        parser.error("--delete-missing requires --incremental")
+
+    driver = GraphDatabase.driver(args.uri, auth=(args.user, args.password),
+                                  max_connection_pool_size=max(args.workers * 2, 10))
+    try:
+        if args.incremental:
+            ingest_incremental(driver, args.csv, manifest_path=args.manifest, chunk_size=args.chunk_size,
+                               batch_size=args.batch_size, workers=args.workers,
+                               delete_missing=args.delete_missing, analytics_path=args.analytics,
+                               fulltext_path=args.fulltext)
+            return
+        ingest_csv(driver, args.csv, chunk_size=args.chunk_size, batch_size=args.batch_size,
+                   workers=args.workers, checkpoint=args.checkpoint, resume=args.resume,
+                   analytics_path=args.analytics, fulltext_path=args.fulltext)
+    finally:
+        driver.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,431 @@
+"""
+Shared client for the chat completions endpoint. Every LLM call in the
+server goes through one LLMClient, which:
+
+- pools keep-alive connections per event loop
+- coalesces identical in-flight payloads into one request (single-flight)
+- paces requests and tokens with token buckets sized to the deployment's
+  quota (LLM_RPM / LLM_TPM)
+- retries 429s, 5xx and connection errors with jittered exponential
+  backoff, honoring Retry-After; a 429 pauses every caller, not just the
+  one that got it
+- hands out concurrency slots by priority, so interactive /chat calls go
+  ahead of speculative and batch work queued behind them
+"""
+import os
+import json
+import time
+import heapq
+import random
+import hashlib
+import asyncio
+import itertools
+import contextvars
+import threading
+import logging
+from contextlib import contextmanager
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+# Connection pool / concurrency limits for the completions endpoint
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "32"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "16"))
+LLM_KEEPALIVE_SECONDS = float(os.getenv("LLM_KEEPALIVE_SECONDS", "60"))
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "30"))
+BLOCKING_WORKERS = int(os.getenv("BLOCKING_WORKERS", "16"))
+# Deployment quota; 0 = unlimited
+LLM_RPM = float(os.getenv("LLM_RPM", "0"))
+LLM_TPM = float(os.getenv("LLM_TPM", "0"))
+# Attempts per call, including the first, and the backoff bounds between them
+LLM_MAX_ATTEMPTS = int(os.getenv("LLM_MAX_ATTEMPTS", "5"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "30"))
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+
+# Lower runs first when callers are queued for a slot
+PRIORITY_INTERACTIVE = 0
+PRIORITY_SPECULATIVE = 5
+PRIORITY_BATCH = 10
+_priority = contextvars.ContextVar("llm_priority", default=PRIORITY_INTERACTIVE)
+
+
+@contextmanager
+def priority(level):
+    """Run the LLM calls made inside the block at `level` (PRIORITY_*)."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def set_priority(level):
+    """Set the priority for the rest of the current context, e.g. inside a task."""
+    _priority.set(level)
+
+
+class LLMError(Exception):
+    """Raised when the completions endpoint can't be reached or returns an error status."""
+
+    def __init__(self, message, status=None, body=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.body = body
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.status is None or self.status in RETRYABLE_STATUSES
+
+
+def _retry_after(headers):
+    """Seconds the endpoint asked us to wait (retry-after-ms, Retry-After seconds or date), or None."""
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+
+def estimate_tokens(payload):
+    """Rough token cost of a request (4 characters per token, plus the completion budget)."""
+    chars = sum(len(m.get("content") or "") for m in payload.get("messages", []))
+    return chars // 4 + int(payload.get("max_tokens") or 0)
+
+
+class TokenBucket:
+    """
+    `rate` units per minute, bursting up to one minute's worth. Callers
+    take what they need and sleep off any debt, so the long-run rate holds
+    across threads and event loops.
+    """
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, amount):
+        """Take `amount` and return how long to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+            self.level -= amount
+            return -self.level / self.rate if self.level < 0 else 0.0
+
+    def refund(self, amount):
+        """Give back an over-estimate (or take more for an under-estimate)."""
+        with self._lock:
+            self.level = min(self.capacity, self.level + amount)
+
+
+class PrioritySlots:
+    """At most `limit` holders at a time; waiters are admitted lowest priority first, then FIFO."""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._waiters = []
+        self._order = itertools.count()
+
+    @property
+    def queued(self):
+        return len(self._waiters)
+
+    async def acquire(self, level):
+        if self.active < self.limit and not self._waiters:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        entry = (level, next(self._order), future)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted just as we were cancelled: pass the slot on
+                self.release()
+            elif entry in self._waiters:
+                # release() may already have popped it, skipping it as cancelled
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            raise
+
+    def release(self):
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
+
+
+class _LoopState:
+    def __init__(self, session, slots):
+        self.session = session
+        self.slots = slots
+        self.inflight = {}
+        # in-flight request task -> callers awaiting it
+        self.waiters = {}
+
+
+class LLMClient:
+    """
+    Async client for the chat completions endpoint.
+
+    Keeps one keep-alive aiohttp session per event loop, so every call made
+    from that loop reuses pooled TCP/TLS connections, and caps the number of
+    in-flight requests with priority-ordered slots. See the module docstring
+    for coalescing, rate limiting and retries.
+    """
+
+    def __init__(self, endpoint, api_key, pool_size=LLM_POOL_SIZE,
+                 max_concurrency=LLM_MAX_CONCURRENCY, timeout=LLM_TIMEOUT_SECONDS,
+                 rpm=LLM_RPM, tpm=LLM_TPM, max_attempts=LLM_MAX_ATTEMPTS):
+        self.endpoint = endpoint
+        self.api_key = api_key
+        self.pool_size = pool_size
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_attempts = max(1, max_attempts)
+        self.requests = TokenBucket(rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm) if tpm > 0 else None
+        # A 429 pauses every caller until then (time.monotonic())
+        self._paused_until = 0.0
+        self._counts = {"requests": 0, "coalesced": 0, "retries": 0, "throttled": 0, "errors": 0}
+        self._throttled_seconds = 0.0
+        self._states = {}
+        self._lock = threading.Lock()
+
+    def _state(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            state = self._states.get(loop)
+            if state is None or state.session.closed:
+                connector = aiohttp.TCPConnector(
+                    limit=self.pool_size,
+                    keepalive_timeout=LLM_KEEPALIVE_SECONDS,
+                )
+                session = aiohttp.ClientSession(
+                    connector=connector,
+                    headers={"Content-Type": "application/json", "api-key": self.api_key},
+                )
+                state = _LoopState(session, PrioritySlots(self.max_concurrency))
+                self._states[loop] = state
+            return state
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self._counts[name] += amount
+
+    async def _admit(self, payload):
+        """Wait out any 429 pause and the rate limits; returns the tokens reserved."""
+        waited = 0.0
+        pause = self._paused_until - time.monotonic()
+        if pause > 0:
+            await asyncio.sleep(pause)
+            waited += pause
+        delay = self.requests.reserve(1) if self.requests else 0.0
+        cost = estimate_tokens(payload) if self.tokens else 0
+        if self.tokens:
+            delay = max(delay, self.tokens.reserve(cost))
+        if delay > 0:
+            await asyncio.sleep(delay)
+            waited += delay
+        if waited:
+            with self._lock:
+                self._counts["throttled"] += 1
+                self._throttled_seconds += waited
+        return cost
+
+    def _settle_tokens(self, reserved, usage):
+        if self.tokens and usage and usage.get("total_tokens"):
+            self.tokens.refund(reserved - usage["total_tokens"])
+
+    def _backoff(self, attempt, error):
+        """Seconds before the next attempt: Retry-After if given, else full-jitter exponential."""
+        if error.retry_after is not None:
+            delay = min(error.retry_after, LLM_BACKOFF_MAX)
+        else:
+            delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+        if error.status == 429:
+            # Everyone backs off, or the other callers turn one 429 into many
+            with self._lock:
+                self._paused_until = max(self._paused_until, time.monotonic() + delay)
+        return delay
+
+    async def _post(self, state, payload, timeout):
+        client_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        try:
+            async with state.session.post(self.endpoint, json=payload, timeout=client_timeout) as resp:
+                if resp.status >= 400:
+                    body = await resp.text()
+                    raise LLMError(f"{resp.status} error from completions endpoint",
+                                   status=resp.status, body=body, retry_after=_retry_after(resp.headers))
+                return await resp.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise LLMError(f"Request to completions endpoint failed: {e!r}") from e
+
+    async def _complete(self, state, payload, timeout, level):
+        for attempt in range(self.max_attempts):
+            reserved = await self._admit(payload)
+            await state.slots.acquire(level)
+            try:
+                self._count("requests")
+                response = await self._post(state, payload, timeout)
+                self._settle_tokens(reserved, response.get("usage"))
+                return response
+            except LLMError as e:
+                if not e.retryable or attempt + 1 >= self.max_attempts:
+                    self._count("errors")
+                    raise
+                delay = self._backoff(attempt, e)
+                self._count("retries")
+                logger.warning("Completions request failed (%s), retry %d in %.1fs", e, attempt + 1, delay)
+            finally:
+                state.slots.release()
+            await asyncio.sleep(delay)
+
+    async def complete(self, payload, timeout=None):
+        """
+        POST a completions payload and return the decoded JSON body, retrying
+        transient failures. Identical payloads already in flight on this
+        loop share that request instead of sending another; it is cancelled
+        when the last caller waiting on it is.
+        """
+        state = self._state()
+        key = hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+        task = state.inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._complete(state, payload, timeout, _priority.get()))
+            state.inflight[key] = task
+            task.add_done_callback(lambda _: state.inflight.pop(key, None))
+        else:
+            self._count("coalesced")
+        state.waiters[task] = state.waiters.get(task, 0) + 1
+        try:
+            # One caller giving up (cancelled) mustn't cancel the request for the others
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if state.waiters[task] == 1:
+                # ...but with nobody left waiting, stop it rather than spend quota on it
+                task.cancel()
+            raise
+        finally:
+            state.waiters[task] -= 1
+            if not state.waiters[task]:
+                del state.waiters[task]
+
+    async def stream(self, payload, timeout=None):
+        """
+        POST a completions payload with "stream": true and yield the content
+        deltas as they arrive (server-sent `data:` lines). Failures before
+        the first delta are retried like complete(); later ones are raised.
+        """
+        state = self._state()
+        client_timeout = aiohttp.ClientTimeout(total=timeout or self.timeout)
+        payload = {**payload, "stream": True}
+        level = _priority.get()
+        for attempt in range(self.max_attempts):
+            await self._admit(payload)
+            await state.slots.acquire(level)
+            started = False
+            try:
+                self._count("requests")
+                async with state.session.post(self.endpoint, json=payload, timeout=client_timeout) as resp:
+                    if resp.status >= 400:
+                        body = await resp.text()
+                        raise LLMError(f"{resp.status} error from completions endpoint",
+                                       status=resp.status, body=body, retry_after=_retry_after(resp.headers))
+                    async for raw_line in resp.content:
+                        line = raw_line.decode("utf-8").strip()
+                        if not line.startswith("data:"):
+                            continue
+                        data = line[len("data:"):].strip()
+                        if data == "[DONE]":
+                            return
+                        chunk = json.loads(data)
+                        for choice in chunk.get("choices", []):
+                            text = (choice.get("delta") or {}).get("content")
+                            if text:
+                                started = True
+                                yield text
+                return
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, LLMError) as e:
+                error = e if isinstance(e, LLMError) else LLMError(
+                    f"Streaming request to completions endpoint failed: {e!r}")
+                if started or not error.retryable or attempt + 1 >= self.max_attempts:
+                    self._count("errors")
+                    if error is e:
+                        raise
+                    raise error from e
+                delay = self._backoff(attempt, error)
+                self._count("retries")
+                logger.warning("Streaming request failed (%s), retry %d in %.1fs", error, attempt + 1, delay)
+            finally:
+                state.slots.release()
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._counts)
+            stats["throttled_seconds"] = self._throttled_seconds
+            states = list(self._states.values())
+        stats["queued"] = sum(state.slots.queued for state in states)
+        stats["active"] = sum(state.slots.active for state in states)
+        stats["inflight"] = sum(len(state.inflight) for state in states)
+        return stats
+
+    async def close(self):
+        """Close the session owned by the current event loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            state = self._states.pop(loop, None)
+        if state is not None:
+            await state.session.close()
+
+    def close_sync(self):
+        """Close the session held on the shared background loop, if any."""
+        if _loop is not None and _loop in self._states:
+            run_sync(self.close(), timeout=5)
+
+
+# A single background event loop shared by all synchronous (WSGI) callers,
+# so Flask worker threads reuse the same connection pool instead of opening
+# a new one per request.
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def _ensure_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _loop.set_default_executor(ThreadPoolExecutor(max_workers=BLOCKING_WORKERS))
+            threading.Thread(target=_loop.run_forever, name="llm-loop", daemon=True).start()
+        return _loop
+
+
+def run_sync(coro, timeout=None):
+    """Run a coroutine on the shared background loop and block for its result."""
+    future = asyncio.run_coroutine_threadsafe(coro, _ensure_loop())
+    return future.result(timeout)
@@ -0,0 +1,299 @@
+"""
+Per-request spans and process-wide metrics for the /chat pipeline.
+
+Each request runs inside a Trace (held in a context variable, so it follows
+the request through awaits and asyncio.to_thread). `span(stage)` times a
+pipeline stage, adds it to the trace and to a latency summary; counters
+and summaries are rendered in the Prometheus text format by `render()`.
+"""
+import os
+import time
+import uuid
+import threading
+import contextvars
+import logging
+from collections import deque
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Observations kept per summary series for the quantiles (a sliding window)
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", "2048"))
+QUANTILES = (0.5, 0.95, 0.99)
+
+_current_trace = contextvars.ContextVar("trace", default=None)
+_current_stage = contextvars.ContextVar("stage", default=None)
+_llm_calls = contextvars.ContextVar("llm_calls", default=None)
+
+
+def _labels(labels):
+    if not labels:
+        return ""
+    body = ",".join(f'{k}="{_escape(v)}"' for k, v in sorted(labels.items()))
+    return "{" + body + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Summary:
+    """Count, sum and p50/p95/p99 over the last `window` observations."""
+
+    def __init__(self, window=METRICS_WINDOW):
+        self.count = 0
+        self.total = 0.0
+        self._window = deque(maxlen=window)
+
+    def observe(self, value):
+        self.count += 1
+        self.total += value
+        self._window.append(value)
+
+    def quantiles(self):
+        ordered = sorted(self._window)
+        if not ordered:
+            return {q: 0.0 for q in QUANTILES}
+        return {q: ordered[min(len(ordered) - 1, int(q * len(ordered)))] for q in QUANTILES}
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}   # name -> {label tuple: value}
+        self._summaries = {}  # name -> {label tuple: Summary}
+        self._help = {}
+        self._collectors = []
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters.setdefault(name, {})
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._summaries.setdefault(name, {})
+            summary = series.get(key)
+            if summary is None:
+                summary = series[key] = Summary()
+            summary.observe(value)
+
+    def counter(self, name):
+        """Current values of counter `name`, as {label tuple: value}."""
+        with self._lock:
+            return dict(self._counters.get(name, {}))
+
+    def add_collector(self, collector):
+        """`collector()` returns [(name, type, {labels}, value)] read at scrape time, e.g. cache stats."""
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+        with self._lock:
+            for name, series in sorted(self._counters.items()):
+                self._header(lines, name, "counter")
+                for key, value in sorted(series.items()):
+                    lines.append(f"{name}{_labels(dict(key))} {value}")
+            for name, series in sorted(self._summaries.items()):
+                self._header(lines, name, "summary")
+                for key, summary in sorted(series.items()):
+                    labels = dict(key)
+                    for q, value in summary.quantiles().items():
+                        lines.append(f"{name}{_labels({**labels, 'quantile': q})} {value:.6f}")
+                    lines.append(f"{name}_count{_labels(labels)} {summary.count}")
+                    lines.append(f"{name}_sum{_labels(labels)} {summary.total:.6f}")
+        seen = set()
+        for collector in self._collectors:
+            try:
+                samples = collector()
+            except Exception as e:
+                logger.warning("Metrics collector failed: %s", e)
+                continue
+            for name, kind, labels, value in samples:
+                if name not in seen:
+                    seen.add(name)
+                    self._header(lines, name, kind)
+                lines.append(f"{name}{_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def _header(self, lines, name, kind):
+        if name in self._help:
+            lines.append(f"# HELP {name} {self._help[name]}")
+        lines.append(f"# TYPE {name} {kind}")
+
+
+registry = Registry()
+registry.describe("chat_stage_seconds", "Latency of each /chat pipeline stage")
+registry.describe("chat_request_seconds", "End-to-end /chat latency")
+registry.describe("chat_requests_total", "Requests handled, by HTTP status")
+registry.describe("llm_tokens_total", "Tokens reported by the completions endpoint, by stage and kind")
+registry.describe("llm_requests_total", "Completions calls made by the pipeline, by stage")
+registry.describe("llm_prompt_tokens", "Prompt tokens per call, counted before sending, by stage")
+registry.describe("llm_retries_total", "Completions requests retried by the LLM client")
+registry.describe("neo4j_result_rows", "Rows returned per executed query")
+registry.describe("neo4j_rows_total", "Rows read from Neo4j")
+registry.describe("neo4j_acquire_seconds", "Wait for a pooled connection and transaction before a read runs")
+registry.describe("neo4j_read_retries_total", "Streaming reads retried after a transient failure")
+registry.describe("neo4j_query_timeouts_total", "Reads stopped by the server-side transaction timeout")
+registry.describe("neo4j_acquire_timeouts_total", "Reads that found no free pooled connection in time")
+
+
+class Trace:
+    """Stage timings for one request."""
+
+    def __init__(self, trace_id=None):
+        self.id = trace_id or uuid.uuid4().hex
+        self.started = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, stage, seconds, **attrs):
+        with self._lock:
+            self.spans.append({"stage": stage, "ms": round(seconds * 1000, 2), **attrs})
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def to_dict(self):
+        with self._lock:
+            return {"trace_id": self.id, "total_ms": round(self.elapsed() * 1000, 2), "spans": list(self.spans)}
+
+
+def start_trace(trace_id=None):
+    trace = Trace(trace_id)
+    _current_trace.set(trace)
+    return trace
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+def current_stage():
+    return _current_stage.get()
+
+
+@contextmanager
+def span(stage, **attrs):
+    """Time a pipeline stage. A plain context manager, so it wraps sync and awaited code alike."""
+    stage_token = _current_stage.set(stage)
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        _current_stage.reset(stage_token)
+        registry.observe("chat_stage_seconds", elapsed, stage=stage)
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add(stage, elapsed, **attrs)
+        logger.debug("stage %s took %.1f ms", stage, elapsed * 1000)
+
+
+def track_llm_calls(calls):
+    """
+    Count the completions sent from here on in the current context (e.g.
+    inside one task) into the one-item list `calls`.
+    """
+    _llm_calls.set(calls)
+
+
+def count_llm_call():
+    """A completions call is being sent; counted when issued, so one abandoned in flight still counts."""
+    calls = _llm_calls.get()
+    if calls is not None:
+        calls[0] += 1
+
+
+def record_prompt_tokens(count):
+    """Prompt size as counted locally before sending (see prompts.py), against the current stage."""
+    stage = _current_stage.get() or "other"
+    registry.observe("llm_prompt_tokens", count, stage=stage)
+    registry.inc("llm_prompt_tokens_total", count, stage=stage)
+
+
+def record_usage(usage):
+    """Count a completions call and its `usage` block against the current stage."""
+    stage = _current_stage.get() or "other"
+    registry.inc("llm_requests_total", stage=stage)
+    if not usage:
+        return
+    for kind in ("prompt_tokens", "completion_tokens"):
+        if usage.get(kind):
+            registry.inc("llm_tokens_total", usage[kind], stage=stage, kind=kind.split("_")[0])
+
+
+def llm_collector(client):
+    """Collector exporting an llm_client.LLMClient's request, coalescing, retry and queue stats."""
+    def collect():
+        stats = client.stats()
+        return [
+            ("llm_http_requests_total", "counter", {}, stats["requests"]),
+            ("llm_coalesced_total", "counter", {}, stats["coalesced"]),
+            ("llm_retries_total", "counter", {}, stats["retries"]),
+            ("llm_errors_total", "counter", {}, stats["errors"]),
+            ("llm_throttled_total", "counter", {}, stats["throttled"]),
+            ("llm_throttled_seconds_total", "counter", {}, round(stats["throttled_seconds"], 6)),
+            ("llm_queued", "gauge", {}, stats["queued"]),
+            ("llm_active", "gauge", {}, stats["active"]),
+        ]
+    return collect
+
+
+def record_rows(count):
+    registry.observe("neo4j_result_rows", count)
+    registry.inc("neo4j_rows_total", count)
+
+
+def neo4j_pool_collector(database):
+    """Collector exporting a database.Neo4jDatabase's connection pool use."""
+    def collect():
+        stats = database.pool_stats()
+        samples = [
+            ("neo4j_pool_max_size", "gauge", {}, stats["max_size"]),
+            ("neo4j_reads_in_flight", "gauge", {}, stats["in_flight"]),
+        ]
+        for address, counts in sorted(stats["servers"].items()):
+            for state, count in sorted(counts.items()):
+                samples.append(("neo4j_pool_connections", "gauge", {"server": address, "state": state}, count))
+        return samples
+    return collect
+
+
+def graph_engine_collector(database):
+    """Collector exporting how many queries a graph_engine.EngineFirst answered in process."""
+    def collect():
+        stats = database.stats()
+        return [
+            ("graph_engine_queries_total", "counter", {"outcome": "served"}, stats["served"]),
+            ("graph_engine_queries_total", "counter", {"outcome": "fallback"}, stats["fallbacks"]),
+            ("graph_engine_queries_total", "counter", {"outcome": "error"}, stats["errors"]),
+        ]
+    return collect
+
+
+def cache_collector(name, cache):
+    """Expose a cache's stats() (hits, misses, entries, ...) as metrics."""
+    def collect():
+        stats = cache.stats()
+        samples = [
+            (f"{name}_hits_total", "counter", {}, stats["hits"]),
+            (f"{name}_misses_total", "counter", {}, stats["misses"]),
+            (f"{name}_hit_ratio", "gauge", {}, round(stats["hit_rate"], 6)),
+            (f"{name}_entries", "gauge", {}, stats["entries"]),
+        ]
+        if "bytes" in stats:
+            samples.append((f"{name}_bytes", "gauge", {}, stats["bytes"]))
+        if "evictions" in stats:
+            samples.append((f"{name}_evictions_total", "counter", {}, stats["evictions"]))
+        return samples
+    return collect
+
+
+def render():
+    return registry.render()
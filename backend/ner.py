@@ -0,0 +1,212 @@
+import os
+import re
+import gc
+import time
+import queue
+import threading
+import logging
+from concurrent.futures import Future
+
+logger = logging.getLogger(__name__)
+
+# trf: en_core_web_trf (most accurate, slow, ~1 GB RSS)
+# sm: en_core_web_sm (small CNN model)
+# gazetteer: rule matcher over names taken from the known Person ids, no spaCy at all
+NER_BACKEND = os.getenv("NER_BACKEND", "trf")
+NER_PRELOAD = os.getenv("NER_PRELOAD", "0") == "1"
+NER_BATCH_WINDOW_MS = float(os.getenv("NER_BATCH_WINDOW_MS", "0"))
+NER_BATCH_SIZE = int(os.getenv("NER_BATCH_SIZE", "32"))
+
+SPACY_MODELS = {"trf": "en_core_web_trf", "sm": "en_core_web_sm"}
+# Only the NER pipe is needed; the rest just costs time and memory
+SPACY_DISABLE = ["tagger", "parser", "attribute_ruler", "lemmatizer"]
+
+WORD_RX = re.compile(r"[A-Za-z][A-Za-z'\-]*")
+EMAIL_IN_TEXT_RX = re.compile(r"\S+@\S+")
+NAME_PART_RX = re.compile(r"[._\-]+")
+MAX_NAME_TOKENS = 3
+# Capitalized words that are too common to be taken as a first/last name alone
+COMMON_WORDS = {
+    "how", "many", "what", "who", "which", "when", "the", "did", "does", "emails", "email",
+    "topic", "send", "sent", "receive", "received", "responsive", "find", "show", "list",
+    "may", "will", "power", "energy", "enron",
+}
+
+
+# Model name -> loaded pipeline, one per process; a worker forked after preload_model() inherits it
+_models = {}
+_models_lock = threading.Lock()
+
+
+def _load_model(model_name):
+    nlp = _models.get(model_name)
+    if nlp is None:
+        with _models_lock:
+            nlp = _models.get(model_name)
+            if nlp is None:
+                import spacy
+                logger.info("Loading spaCy model %s", model_name)
+                nlp = _models[model_name] = spacy.load(model_name, disable=SPACY_DISABLE)
+    return nlp
+
+
+def preload_model(backend=NER_BACKEND):
+    """
+    Load the spaCy model `backend` uses, in a pre-fork master (gunicorn.conf.py),
+    so workers share its memory pages copy-on-write. gc.freeze() keeps the
+    collector from touching (and so copying) those objects later.
+    """
+    _load_model(SPACY_MODELS["sm"] if backend == "gazetteer" else SPACY_MODELS.get(backend, backend))
+    gc.freeze()
+
+
+class SpacyNER:
+    """spaCy-backed PERSON extraction; the model is loaded on first use."""
+
+    def __init__(self, model_name):
+        self.model_name = model_name
+
+    def load(self):
+        return _load_model(self.model_name)
+
+    def persons(self, texts):
+        nlp = self.load()
+        return [
+            [ent.text for ent in doc.ents if ent.label_ == "PERSON"]
+            for doc in nlp.pipe(texts, batch_size=NER_BATCH_SIZE)
+        ]
+
+
+class GazetteerNER:
+    """
+    Finds PERSON spans by matching word n-grams against name parts taken
+    from the Person ids ("jeff.dasovich@enron.com" -> "jeff dasovich",
+    "dasovich jeff", "jeff", "dasovich"). Single words only count when
+    capitalized in the text. Falls back to `fallback` while no ids are
+    available yet.
+    """
+
+    def __init__(self, index_source, fallback=None):
+        self.index_source = index_source
+        self.fallback = fallback
+        self._index = None
+        self._phrases = set()
+        self._singles = set()
+
+    def _refresh(self, index):
+        phrases, singles = set(), set()
+        for local in index.locals:
+            parts = [p for p in NAME_PART_RX.split(local) if p.isalpha()]
+            if len(parts) >= 2:
+                phrases.add(" ".join(parts))
+                phrases.add(" ".join(parts[-1:] + parts[:-1]))
+            singles.update(p for p in parts if len(p) > 2 and p not in COMMON_WORDS)
+        self._phrases, self._singles, self._index = phrases, singles, index
+
+    def _match(self, text):
+        # Addresses are already resolved; blank them out so their local parts don't match
+        masked = EMAIL_IN_TEXT_RX.sub(lambda m: " " * len(m.group(0)), text)
+        words = list(WORD_RX.finditer(masked))
+        spans, i = [], 0
+        while i < len(words):
+            found = None
+            for n in range(min(MAX_NAME_TOKENS, len(words) - i), 1, -1):
+                key = " ".join(w.group(0).lower() for w in words[i:i + n])
+                if key in self._phrases:
+                    found = n
+                    break
+            if found is None:
+                word = words[i].group(0)
+                if word[0].isupper() and word.lower() in self._singles:
+                    found = 1
+            if found:
+                spans.append(text[words[i].start():words[i + found - 1].end()])
+                i += found
+            else:
+                i += 1
+        return spans
+
+    def persons(self, texts):
+        index = self.index_source()
+        if index is None:
+            if self.fallback is None:
+                return [[] for _ in texts]
+            return self.fallback.persons(texts)
+        if index is not self._index:
+            self._refresh(index)
+        return [self._match(text) for text in texts]
+
+    def load(self):
+        return self
+
+
+class NERService:
+    """
+    Front end used by the request handlers. Single calls can be coalesced
+    into nlp.pipe batches: with NER_BATCH_WINDOW_MS > 0, calls arriving
+    within the window from different threads run as one batch.
+    """
+
+    def __init__(self, backend, batch_window_ms=NER_BATCH_WINDOW_MS, batch_size=NER_BATCH_SIZE):
+        self.backend = backend
+        self.batch_window = batch_window_ms / 1000.0
+        self.batch_size = batch_size
+        self._queue = None
+        self._lock = threading.Lock()
+
+    def preload(self):
+        """Load the model now rather than on the first question (the master's copy, if it preloaded one)."""
+        self.backend.load()
+
+    def persons(self, text):
+        if self.batch_window <= 0:
+            return self.backend.persons([text])[0]
+        future = Future()
+        self._ensure_worker().put((text, future))
+        return future.result()
+
+    def persons_batch(self, texts):
+        return self.backend.persons(list(texts)) if texts else []
+
+    def _ensure_worker(self):
+        # Started lazily so it's created in the worker process, not before fork
+        with self._lock:
+            if self._queue is None:
+                self._queue = queue.Queue()
+                threading.Thread(target=self._run, name="ner-batcher", daemon=True).start()
+            return self._queue
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(items) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            try:
+                results = self.backend.persons([text for text, _ in items])
+                for (_, future), result in zip(items, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+
+
+def create_ner(index_source, backend=NER_BACKEND):
+    """Build the configured NER service. `index_source` returns the current PersonIndex or None."""
+    if backend == "gazetteer":
+        impl = GazetteerNER(index_source, fallback=SpacyNER(SPACY_MODELS["sm"]))
+    elif backend in SPACY_MODELS:
+        impl = SpacyNER(SPACY_MODELS[backend])
+    else:
+        # Anything else is taken as a spaCy model name/path
+        impl = SpacyNER(backend)
+    service = NERService(impl)
+    if NER_PRELOAD:
+        service.preload()
+    return service
@@ -0,0 +1,193 @@
+import re
+import time
+import threading
+import logging
+from array import array
+from difflib import SequenceMatcher
+
+from database import read_session, read_query
+
+logger = logging.getLogger(__name__)
+
+PERSON_IDS_QUERY = "MATCH (p:Person) RETURN p.id AS id"
+PERSON_CONTAINS_QUERY = """
+MATCH (p:Person)
+WHERE toLower(p.id) CONTAINS $needle
+RETURN p.id AS person_id
+"""
+
+FUZZY_THRESHOLD = 0.8
+FUZZY_LIMIT = 5
+NAME_CLEAN_RX = re.compile(r"[^\w@.,'\s-]")
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def name_variants(name):
+    """
+    Normalized forms to try for a PERSON span, most likely first.
+    "Jeff Dasovich" -> ["jeff.dasovich", "dasovich.jeff"]
+    "Dasovich, Jeff" -> ["jeff.dasovich", "dasovich.jeff"]
+    """
+    cleaned = NAME_CLEAN_RX.sub("", name).strip().lower()
+    if "," in cleaned:
+        last, _, first = cleaned.partition(",")
+        parts = first.split() + last.split()
+    else:
+        parts = cleaned.split()
+    if not parts:
+        return []
+    if len(parts) == 1:
+        return [parts[0]]
+    variants = [".".join(parts), ".".join(parts[-1:] + parts[:-1])]
+    return list(dict.fromkeys(variants))
+
+
+class PersonIndex:
+    """
+    Immutable in-memory index over Person ids (email addresses).
+
+    - contains: trigram postings over the whole lowercased id, verified
+      with `in` (same answers as `toLower(p.id) CONTAINS ...`)
+    - fuzzy: trigram candidates ranked by SequenceMatcher ratio
+    """
+
+    def __init__(self, person_ids):
+        self.ids = sorted({pid for pid in person_ids if pid}, key=str.lower)
+        self.lowered = [pid.lower() for pid in self.ids]
+        self.locals = [low.split("@", 1)[0] for low in self.lowered]
+        grams = {}
+        for i, low in enumerate(self.lowered):
+            for gram in _trigrams(low):
+                grams.setdefault(gram, []).append(i)
+        # array('I') postings keep the index compact for large custodian sets
+        self._grams = {gram: array("I", postings) for gram, postings in grams.items()}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def contains(self, needle):
+        needle = needle.lower()
+        if len(needle) < 3:
+            return [pid for pid, low in zip(self.ids, self.lowered) if needle in low]
+        postings = []
+        for gram in _trigrams(needle):
+            p = self._grams.get(gram)
+            if p is None:
+                return []
+            postings.append(p)
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for p in postings[1:]:
+            candidates.intersection_update(p)
+            if not candidates:
+                return []
+        return [self.ids[i] for i in sorted(candidates) if needle in self.lowered[i]]
+
+    def fuzzy(self, needle, threshold=FUZZY_THRESHOLD, limit=FUZZY_LIMIT):
+        needle = needle.lower()
+        grams = _trigrams(needle)
+        if not grams:
+            return []
+        counts = {}
+        for gram in grams:
+            for i in self._grams.get(gram, ()):
+                counts[i] = counts.get(i, 0) + 1
+        # Only score candidates sharing a reasonable share of trigrams
+        floor = max(1, len(grams) // 3)
+        scored = []
+        for i, shared in counts.items():
+            if shared < floor:
+                continue
+            ratio = SequenceMatcher(None, needle, self.locals[i]).ratio()
+            if ratio >= threshold:
+                scored.append((-ratio, self.ids[i]))
+        scored.sort()
+        return [pid for _, pid in scored[:limit]]
+
+    def resolve(self, name):
+        """
+        Person ids matching a PERSON span, and whether they came from fuzzy
+        matching (in which case the caller should ask the user to confirm).
+        """
+        variants = name_variants(name)
+        for variant in variants:
+            matches = self.contains(variant)
+            if matches:
+                return matches, False
+        for variant in variants:
+            matches = self.fuzzy(variant)
+            if matches:
+                return matches, True
+        return [], False
+
+
+class PersonResolver:
+    """
+    Serves person lookups from a PersonIndex loaded in the background, and
+    rebuilds it when the dataset generation changes. Until the first build
+    finishes, lookups fall back to a CONTAINS query against Neo4j.
+    """
+
+    def __init__(self, driver, generation):
+        self.driver = driver
+        self.generation = generation
+        self.index = None
+        self._index_generation = None
+        self._loading = False
+        self._attempted_at = 0.0
+        self._lock = threading.Lock()
+
+    def warm_up(self):
+        self._start_reload(self.generation.current())
+
+    def _start_reload(self, generation):
+        with self._lock:
+            # Don't hammer Neo4j with reloads while it's failing
+            if self._loading or time.monotonic() - self._attempted_at < self.generation.poll_seconds:
+                return
+            self._loading = True
+            self._attempted_at = time.monotonic()
+        threading.Thread(target=self._reload, args=(generation,), name="person-index", daemon=True).start()
+
+    def _reload(self, generation):
+        try:
+            with read_session(self.driver) as session:
+                ids = [record["id"] for record in session.run(read_query(PERSON_IDS_QUERY))]
+            index = PersonIndex(ids)
+            self.index, self._index_generation = index, generation
+            logger.info("Person index loaded: %d ids (generation %s)", len(index), generation)
+        except Exception as e:
+            logger.warning("Person index load failed: %s", e)
+        finally:
+            with self._lock:
+                self._loading = False
+
+    def load_ids(self, ids, generation=None):
+        """Build the index from ids already at hand (e.g. read from the CSV) instead of from Neo4j."""
+        index = PersonIndex(ids)
+        self.index = index
+        self._index_generation = self.generation.current() if generation is None else generation
+        logger.info("Person index loaded: %d ids (generation %s)", len(index), self._index_generation)
+
+    def _current_index(self):
+        generation = self.generation.current()
+        if generation != self._index_generation:
+            self._start_reload(generation)
+        return self.index
+
+    def contains(self, needle):
+        index = self._current_index()
+        if index is not None:
+            return index.contains(needle)
+        with read_session(self.driver) as session:
+            return [r["person_id"] for r in session.run(read_query(PERSON_CONTAINS_QUERY), needle=needle.lower())]
+
+    def resolve(self, name):
+        index = self._current_index()
+        if index is not None:
+            return index.resolve(name)
+        variants = name_variants(name)
+        return (self.contains(variants[0]) if variants else []), False
@@ -0,0 +1,248 @@
+"""
+Prompt assembly for the LLM calls.
+
+Each prompt is laid out as a static prefix (system message, schema,
+rules) followed by the per-request part, so the prefix is byte-identical
+across calls and provider-side prompt caching can reuse it. The Cypher
+prompt carries only the CYPHER_EXAMPLES_K few-shot examples most similar
+to the question (ExampleIndex) instead of all of them, and every prompt
+is fitted to PROMPT_TOKEN_BUDGET: examples, history or result rows are
+dropped before the request is sent over budget.
+"""
+import os
+import re
+import json
+import math
+import logging
+from collections import Counter
+
+from translation_cache import normalize_question
+
+logger = logging.getLogger(__name__)
+
+# Tokens allowed per prompt (all messages); the parts that can shrink are cut to fit
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "2500"))
+# Few-shot examples in the Cypher prompt; 0 sends all of them
+CYPHER_EXAMPLES_K = int(os.getenv("CYPHER_EXAMPLES_K", "3"))
+TOKENIZER = os.getenv("PROMPT_TOKENIZER", "o200k_base")
+
+# Approximates BPE counts when tiktoken isn't installed: words, numbers and single symbols
+TOKEN_RX = re.compile(r"[A-Za-z]+|\d{1,3}|[^\sA-Za-z\d]")
+MESSAGE_OVERHEAD = 4
+_encoding = None
+
+
+def count_tokens(text):
+    """Tokens in `text`, with tiktoken if available, else the TOKEN_RX approximation."""
+    global _encoding
+    if _encoding is None:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(TOKENIZER)
+        except Exception:
+            _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text))
+    return len(TOKEN_RX.findall(text))
+
+
+def count_message_tokens(messages):
+    return sum(count_tokens(m.get("content") or "") + MESSAGE_OVERHEAD for m in messages)
+
+
+SCHEMA = """Nodes:
+- (:Email {id, date_time, subject, content, relevant, analysis})
+- (:Person {id})
+- (:Topic {name})
+Relationships:
+- (:Person)-[:SEND]->(:Email)
+- (:Person)-[:RECEIVE]->(:Email)
+- (:Person)-[:Cc]->(:Email)
+- (:Person)-[:Bcc]->(:Email)
+- (:Email)-[:RESPONSIVE]->(:Topic)"""
+
+CYPHER_SYSTEM = f"""You are a Neo4j Cypher expert. Convert the user's natural language query into a Cypher query for a Neo4j database with this schema:
+{SCHEMA}
+
+Rules:
+1. Always produce a valid Cypher query with a complete RETURN clause.
+2. If there isn't enough information for a valid query, output exactly: "Please clarify. Question is too ambiguous".
+3. Answer with the Cypher only, no other words.
+4. Enclose string values in single quotes (').
+5. Never truncate the query.
+6. Person ids are email addresses. If the question names a person instead of giving an email, match with `WHERE toLower(p.id) CONTAINS '<person name>'`.
+7. Relationships always point (:Person)-[:RELATION]->(:Email) and (:Email)-[:RESPONSIVE]->(:Topic). Do not reverse them."""
+
+CYPHER_EXAMPLES = [
+    ("Find all emails sent by Alice.",
+     "MATCH (p:Person {id: 'Alice'})-[:SEND]->(e:Email) RETURN e"),
+    ("Find all recipients of email ID 123.",
+     "MATCH (p:Person)-[:RECEIVE]->(e:Email {id: '123'}) RETURN p"),
+    ("Find all emails that are marked as relevant.",
+     "MATCH (e:Email) WHERE e.relevant = 'yes' RETURN e"),
+    ("How many responsive emails did jeff.dasovich@enron.com send?",
+     "MATCH (sender:Person {id: 'jeff.dasovich@enron.com'})-[:SEND]->(email:Email)-[:RESPONSIVE]->(:Topic {name:'Topic 303'}) "
+     "RETURN COUNT(email) AS responsive_emails_sent"),
+    ("How many responsive emails did steven.kean@enron.com receive?",
+     "MATCH (recipient:Person {id: 'steven.kean@enron.com'})-[:RECEIVE]->(email:Email)-[:RESPONSIVE]->(:Topic {name: 'Topic 303'}) "
+     "RETURN count(email) AS responsive_email_count"),
+    ("How many responsive emails did jeff.dasovich@enron.com send to christopher.calger@enron.com?",
+     "MATCH (sender:Person {id: 'jeff.dasovich@enron.com'})-[:SEND]->(email:Email)-[:RESPONSIVE]->(:Topic {name:'Topic 303'}) "
+     "MATCH (recipient:Person {id: 'christopher.calger@enron.com'})-[:RECEIVE]->(email) "
+     "RETURN count(email) AS responsive_email_count"),
+    ("How many responsive emails were janel.guerrero@enron.com BCC-ed on?",
+     "MATCH (bccRecipient:Person {id: 'janel.guerrero@enron.com'})-[:Bcc]->(email:Email)-[:RESPONSIVE]->(:Topic {name: 'Topic 303'}) "
+     "RETURN count(email) AS responsive_email_bcc_count"),
+    ("How many responsive emails were sent after 1997-09-10T08:00:00?",
+     "MATCH (sender:Person)-[:SEND]->(e:Email)-[:RESPONSIVE]->(:Topic {name: 'Topic 303'}) "
+     "WHERE e.date_time > datetime('1997-09-10T08:00:00') RETURN count(e) AS responsive_emails_after_date"),
+]
+
+FORMAT_SYSTEM = """You are an assistant that turns Cypher query results into clear and natural language answers.
+Give a single, concise sentence that answers the user question naturally, only using the data from the User Query, Cypher Query and Result."""
+
+
+def _terms(question):
+    """Unigrams and bigrams of the normalized question (literals become __email0__ etc.)."""
+    words = normalize_question(question)[0].split()
+    return Counter(words + [" ".join(pair) for pair in zip(words, words[1:])])
+
+
+class ExampleIndex:
+    """TF-IDF vectors of the example questions; `top` ranks them by cosine similarity."""
+
+    def __init__(self, examples):
+        self.examples = list(examples)
+        counts = [_terms(question) for question, _ in self.examples]
+        df = Counter(term for terms in counts for term in terms)
+        n = len(self.examples)
+        self.idf = {term: math.log((1 + n) / (1 + d)) + 1 for term, d in df.items()}
+        self.vectors = [self._vector(terms) for terms in counts]
+
+    def _vector(self, terms):
+        vector = {term: tf * self.idf.get(term, 0.0) for term, tf in terms.items() if term in self.idf}
+        norm = math.sqrt(sum(w * w for w in vector.values())) or 1.0
+        return {term: w / norm for term, w in vector.items()}
+
+    def top(self, question, k):
+        """The `k` most similar examples, most similar first (ties keep the listed order)."""
+        query = self._vector(_terms(question))
+        scored = [(-sum(w * vector.get(term, 0.0) for term, w in query.items()), i)
+                  for i, vector in enumerate(self.vectors)]
+        return [self.examples[i] for _, i in sorted(scored)[:k]]
+
+
+example_index = ExampleIndex(CYPHER_EXAMPLES)
+
+
+def _examples_block(examples):
+    return "\n".join(f'{i}. "{question}"\n   Cypher: {cypher}' for i, (question, cypher) in enumerate(examples, 1))
+
+
+def cypher_messages(question, k=CYPHER_EXAMPLES_K, budget=PROMPT_TOKEN_BUDGET):
+    """Messages translating `question` to Cypher: static system prefix, then the chosen examples and the question."""
+    examples = example_index.top(question, k) if k else list(CYPHER_EXAMPLES)
+    while True:
+        user = (f"Example queries:\n{_examples_block(examples)}\n\n" if examples else "") + \
+               f'User Query: "{question}"'
+        messages = [{"role": "system", "content": CYPHER_SYSTEM}, {"role": "user", "content": user}]
+        if not examples or count_message_tokens(messages) <= budget:
+            break
+        # Least similar example goes first
+        examples = examples[:-1]
+    _check(messages, budget, "cypher")
+    return messages
+
+
+def _rows_json(result, limit=None):
+    if limit is not None and isinstance(result, list) and len(result) > limit:
+        result = result[:limit] + [f"... {len(result) - limit} more rows"]
+    return json.dumps(result, default=str, ensure_ascii=False, separators=(",", ":"))
+
+
+def format_messages(question, cypher_query, result, budget=PROMPT_TOKEN_BUDGET):
+    """
+    Messages asking for a one-sentence answer from `result`, serialized as
+    compact JSON (not the Python repr) and cut to fit the budget.
+    """
+    def build(text):
+        user = f'User Query: "{question}"\nCypher Query: {cypher_query}\nResult: {text}'
+        return [{"role": "system", "content": FORMAT_SYSTEM}, {"role": "user", "content": user}]
+
+    text = _rows_json(result)
+    messages = build(text)
+    limit = len(result) if isinstance(result, list) else None
+    while count_message_tokens(messages) > budget:
+        if limit:
+            limit //= 2
+            text = _rows_json(result, limit)
+        else:
+            # A summary or a single huge row: clip the text itself
+            room = max(0, budget - count_message_tokens(build("")))
+            text = text[:room * 3] + "..."
+            messages = build(text)
+            break
+        messages = build(text)
+    _check(messages, budget, "format")
+    return messages
+
+
+def fit_history(messages, budget=PROMPT_TOKEN_BUDGET):
+    """
+    Drop the oldest conversation turns from a clarify message list until it
+    fits, keeping the developer prompts and the latest user message.
+    """
+    messages = list(messages)
+    while count_message_tokens(messages) > budget:
+        droppable = [i for i, m in enumerate(messages[:-1]) if m["role"] != "developer"]
+        if not droppable:
+            break
+        del messages[droppable[0]]
+    _check(messages, budget, "clarify")
+    return messages
+
+
+def _check(messages, budget, kind):
+    tokens = count_message_tokens(messages)
+    if tokens > budget:
+        logger.warning("%s prompt is %d tokens, over the %d budget after trimming", kind, tokens, budget)
+
+
+# Sent first in every clarify call, ahead of the conversation, so it stays a cacheable prefix
+REFRAME_QUESTION_PROMPT = f"""You are an intelligent query refiner for a Neo4j database. Take the user's natural language question, analyze its meaning and reframe it into a more precise query. Clarify ambiguous terms and confirm with the user that the reframed question represents their intent.
+
+### Neo4j Database Schema:
+{SCHEMA}
+
+### Instructions:
+1. Analyze the user's question:
+   - Identify vague or ambiguous terms (e.g., "important", "related", "best", "most relevant").
+   - Break the question down into measurable database attributes (e.g., number of emails sent, received, Bcc'd).
+   - Consider how it maps onto the schema's nodes, relationships and properties.
+2. Reframe the question with a clear definition:
+   - Most important: if the chat history has identified the email address of a person, use the email instead of the person's name.
+   - Remove ambiguity, so the question translates directly into a Cypher query.
+   - Keep it concise and specific to the schema.
+3. Confirm with the user:
+   - Explain briefly why you reframed the question this way.
+   - Ask for confirmation or clarification if the intent is still unclear.
+4. Decide whether to stop clarifying:
+   - If the user's message indicates they no longer want to clarify, reframe or refine the question (e.g., "stop", "this is good enough", "no need to clarify further"), set "termination_status": true.
+   - Otherwise set "termination_status": false.
+
+### Response Format:
+Return only a JSON object, without any other text or code block markup, with these fields:
+- "reframed_question": the clearer, more structured version of the user's question.
+- "explanation": a brief analysis of why the question was reframed this way.
+- "confirmation_message": a follow-up to the user to confirm accuracy or request more details.
+- "termination_status": whether to stop further clarification (true = stop, false = continue).
+
+### Example 1:
+User's input: "Who is the most important person around topic 303?"
+Response:
+{{"reframed_question": "Who sent the most emails about topic 303?", "explanation": "'Most important' is ambiguous. We assume it refers to the number of emails sent, so the most important person is the one who sent the most emails related to topic 303.", "confirmation_message": "Is this what you meant by 'most important', or do you have another definition in mind?", "termination_status": false}}
+
+### Example 2:
+User's input: "How many emails did Paul send to Dan?"
+Response:
+{{"reframed_question": "How many emails did Paul send to Dan?", "explanation": "The question is already clear and specific: a count of emails sent by Paul to Dan, which translates directly into a Cypher query.", "confirmation_message": "Does this accurately capture your question, or would you like to adjust any details?", "termination_status": true}}"""
@@ -0,0 +1,112 @@
+import os
+import re
+import json
+import threading
+from collections import OrderedDict
+
+from cypher_schema import READ_ONLY_PROCEDURES
+
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_MAX_ENTRY_BYTES = int(os.getenv("RESULT_CACHE_MAX_ENTRY_BYTES", str(4 * 1024 * 1024)))
+
+# Queries with any of these clauses change the graph and are never cached
+WRITE_CLAUSE_RX = re.compile(r"\b(CREATE|MERGE|SET|DELETE|REMOVE|DROP|LOAD\s+CSV)\b", re.IGNORECASE)
+# Only procedures known to be read-only (full-text lookups) are cached
+CALL_RX = re.compile(r"\bCALL\s+([\w.]+|\{)", re.IGNORECASE)
+# String literals, or runs of whitespace outside them
+TOKEN_RX = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|\s+")
+
+
+def canonicalize_cypher(query):
+    """Collapse whitespace outside string literals and drop trailing semicolons."""
+    def repl(m):
+        text = m.group(0)
+        return text if text[0] in "'\"" else " "
+    return TOKEN_RX.sub(repl, query).strip().rstrip(";").strip()
+
+
+def _estimate_size(rows):
+    return len(json.dumps(rows, default=str))
+
+
+class ResultCache:
+    """
+    Size-aware LRU cache of query results, keyed on canonical Cypher text
+    plus parameters. Entries are tagged with the dataset generation they
+    were read at; observing a newer generation drops everything.
+
+    Cached rows are shared between callers and must not be mutated.
+    """
+
+    def __init__(self, max_bytes=RESULT_CACHE_MAX_BYTES, max_entry_bytes=RESULT_CACHE_MAX_ENTRY_BYTES):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self.generation = None
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()  # key -> (rows, size)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def cacheable(query):
+        if WRITE_CLAUSE_RX.search(query):
+            return False
+        return all(name.lower() in READ_ONLY_PROCEDURES for name in CALL_RX.findall(query))
+
+    @staticmethod
+    def make_key(query, params=None):
+        return canonicalize_cypher(query), json.dumps(params or {}, sort_keys=True, default=str)
+
+    def _sync_generation(self, generation):
+        if generation != self.generation:
+            self._entries.clear()
+            self.bytes = 0
+            self.generation = generation
+
+    def get(self, key, generation):
+        with self._lock:
+            self._sync_generation(generation)
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, rows, generation):
+        size = _estimate_size(rows)
+        if size > self.max_entry_bytes:
+            return False
+        with self._lock:
+            self._sync_generation(generation)
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (rows, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes and self._entries:
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+        return True
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "bytes": self.bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+                "generation": self.generation,
+            }
@@ -0,0 +1,212 @@
+import os
+import re
+import hmac
+import json
+import base64
+import hashlib
+from collections import Counter
+
+# Rows returned per /chat response; the rest are fetched page by page with a cursor
+RESULT_PAGE_SIZE = int(os.getenv("RESULT_PAGE_SIZE", "100"))
+# Above this many rows the formatter gets a summary instead of the rows
+FORMAT_MAX_ROWS = int(os.getenv("FORMAT_MAX_ROWS", "20"))
+FORMAT_SAMPLE_ROWS = 5
+FORMAT_TOP_K = 5
+FORMAT_MAX_VALUE_CHARS = 300
+# Signs cursor tokens so clients can't hand back arbitrary Cypher. Without
+# a configured secret, cursors are only valid for the lifetime of the process.
+RESULT_CURSOR_SECRET = os.getenv("RESULT_CURSOR_SECRET", "").encode() or os.urandom(32)
+
+# Properties returned for a bare Email/Person variable instead of the whole node
+EMAIL_PROJECTION = ("id", "subject", "date_time", "relevant", "analysis")
+PERSON_PROJECTION = ("id",)
+
+STRING_RX = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+LABELLED_VAR_RX = re.compile(r"\(\s*(\w+)\s*:\s*(Email|Person)\b")
+RETURN_RX = re.compile(r"\bRETURN\b", re.IGNORECASE)
+TAIL_RX = re.compile(r"\b(ORDER\s+BY|SKIP|LIMIT)\b", re.IGNORECASE)
+UNION_RX = re.compile(r"\bUNION\b", re.IGNORECASE)
+DISTINCT_RX = re.compile(r"^\s*DISTINCT\b\s*", re.IGNORECASE)
+COLLECT_RX = re.compile(r"\bcollect\(\s*(DISTINCT\s+)?(\w+)\s*\)", re.IGNORECASE)
+
+
+def _mask_strings(query):
+    """Same-length copy of the query with string literals blanked, for keyword searches."""
+    return STRING_RX.sub(lambda m: m.group(0)[0] + "_" * (len(m.group(0)) - 2) + m.group(0)[-1], query)
+
+
+def _split_items(text, masked):
+    """Split a RETURN clause on top-level commas, returning (start, end) spans."""
+    spans, depth, start = [], 0, 0
+    for i, ch in enumerate(masked):
+        if ch in "([{":
+            depth += 1
+        elif ch in ")]}":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            spans.append((start, i))
+            start = i + 1
+    spans.append((start, len(text)))
+    return spans
+
+
+def _final_return(query):
+    """(masked query, index just past the last RETURN, index of ORDER BY/SKIP/LIMIT or end)."""
+    masked = _mask_strings(query)
+    matches = list(RETURN_RX.finditer(masked))
+    if not matches or UNION_RX.search(masked):
+        return masked, None, None
+    body_start = matches[-1].end()
+    tail = TAIL_RX.search(masked, body_start)
+    return masked, body_start, tail.start() if tail else len(query)
+
+
+def _projection(name, label):
+    fields = EMAIL_PROJECTION if label == "Email" else PERSON_PROJECTION
+    return name + " {" + ", ".join("." + f for f in fields) + "}"
+
+
+def project_nodes(query):
+    """
+    Replace bare Email/Person variables in the final RETURN with map
+    projections of the properties the client and formatter use, so whole
+    `content` strings never leave the database.
+    """
+    query = query.strip().rstrip(";").strip()
+    masked, body_start, body_end = _final_return(query)
+    if body_start is None:
+        return query
+    labels = dict((var, label) for var, label in LABELLED_VAR_RX.findall(masked))
+    if not labels:
+        return query
+    tail = masked[body_end:]
+    body = query[body_start:body_end]
+
+    def collect(m):
+        var_label = labels.get(m.group(2))
+        if var_label is None:
+            return m.group(0)
+        return f"collect({m.group(1) or ''}{_projection(m.group(2), var_label)})"
+
+    items = []
+    changed = False
+    for i, (start, end) in enumerate(_split_items(body, masked[body_start:body_end])):
+        item = body[start:end]
+        prefix = ""
+        if i == 0:
+            distinct = DISTINCT_RX.match(item)
+            if distinct:
+                prefix, item = item[:distinct.end()], item[distinct.end():]
+        name = item.strip()
+        label = labels.get(name)
+        if label is not None:
+            fields = EMAIL_PROJECTION if label == "Email" else PERSON_PROJECTION
+            # ORDER BY on a property the projection drops would silently sort on null
+            ordered_on = set(re.findall(rf"\b{re.escape(name)}\.(\w+)", tail))
+            if ordered_on <= set(fields):
+                lead = item[:len(item) - len(item.lstrip())]
+                trail = item[len(item.rstrip()):]
+                item = f"{lead}{_projection(name, label)} AS {name}{trail}"
+                changed = True
+        else:
+            # collect(e) would ship every whole node in one list
+            projected = COLLECT_RX.sub(collect, item) if not STRING_RX.search(item) else item
+            changed = changed or projected != item
+            item = projected
+        items.append(prefix + item)
+    if not changed:
+        return query
+    return query[:body_start] + ",".join(items).rstrip() + (" " + query[body_end:].lstrip() if body_end < len(query) else "")
+
+
+def paginate(query):
+    """
+    The query with `SKIP $result_skip LIMIT $result_limit` appended, or None
+    when that can't be done safely (UNION, or it already pages itself).
+    """
+    query = query.strip().rstrip(";").strip()
+    masked, body_start, _ = _final_return(query)
+    if body_start is None or re.search(r"\b(SKIP|LIMIT)\b", masked[body_start:], re.IGNORECASE):
+        return None
+    return f"{query} SKIP $result_skip LIMIT $result_limit"
+
+
+class Page(list):
+    """
+    One page of result rows; `has_more` says whether another page follows
+    and `cypher` is the query that produced it, after any repair or fix.
+    """
+
+    def __init__(self, rows=(), skip=0, has_more=False, cypher=None):
+        super().__init__(rows)
+        self.skip = skip
+        self.has_more = has_more
+        self.cypher = cypher
+
+    @property
+    def next_skip(self):
+        return self.skip + len(self)
+
+
+def encode_cursor(cypher, skip, question):
+    payload = base64.urlsafe_b64encode(
+        json.dumps({"q": cypher, "s": skip, "u": question}, separators=(",", ":")).encode("utf-8")
+    ).decode("ascii").rstrip("=")
+    signature = hmac.new(RESULT_CURSOR_SECRET, payload.encode("ascii"), hashlib.sha256).hexdigest()[:32]
+    return f"{payload}.{signature}"
+
+
+def decode_cursor(token):
+    """(cypher, skip, question) for a token made by encode_cursor, or None if it's invalid."""
+    if not isinstance(token, str) or "." not in token:
+        return None
+    payload, signature = token.rsplit(".", 1)
+    expected = hmac.new(RESULT_CURSOR_SECRET, payload.encode("ascii", "replace"), hashlib.sha256).hexdigest()[:32]
+    if not hmac.compare_digest(signature, expected):
+        return None
+    try:
+        data = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return data["q"], int(data["s"]), data.get("u", "")
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def _clip(value):
+    if isinstance(value, str) and len(value) > FORMAT_MAX_VALUE_CHARS:
+        return value[:FORMAT_MAX_VALUE_CHARS] + "..."
+    if isinstance(value, dict):
+        return {k: _clip(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_clip(v) for v in value[:FORMAT_SAMPLE_ROWS]] + (["..."] if len(value) > FORMAT_SAMPLE_ROWS else [])
+    return value
+
+
+def summarize_rows(rows, has_more=False):
+    """
+    What the formatter sees of a result: the rows themselves when there are
+    few, otherwise the row count, per-column stats (numeric range and sum,
+    most common values) and a few sample rows. Long strings are clipped.
+    """
+    if len(rows) <= FORMAT_MAX_ROWS and not has_more:
+        return [_clip(row) for row in rows]
+    columns = {}
+    for row in rows:
+        for key, value in row.items():
+            columns.setdefault(key, []).append(value)
+    stats = {}
+    for key, values in columns.items():
+        numbers = [v for v in values if isinstance(v, (int, float)) and not isinstance(v, bool)]
+        if numbers and len(numbers) == len(values):
+            stats[key] = {"min": min(numbers), "max": max(numbers), "sum": sum(numbers)}
+            continue
+        hashable = [v if isinstance(v, (str, int, float, bool)) else (v or {}).get("id") if isinstance(v, dict) else None
+                    for v in values]
+        counts = Counter(v for v in hashable if v is not None)
+        if counts:
+            stats[key] = {"distinct": len(counts),
+                          "most_common": [[_clip(v), n] for v, n in counts.most_common(FORMAT_TOP_K)]}
+    return {
+        "row_count": len(rows) if not has_more else f"more than {len(rows)}",
+        "columns": stats,
+        "sample_rows": [_clip(row) for row in rows[:FORMAT_SAMPLE_ROWS]],
+    }
@@ -0,0 +1,713 @@
+"""
+Semantic search over Email content and analysis text.
+
+Each email is cut into overlapping word windows of its content (prefixed
+with the subject) plus its analysis, and every segment is embedded on the
+CPU. The vectors live on disk under EMBEDDING_INDEX_PATH and are memory-
+mapped, so the server only pages in the rows a search touches:
+
+- manifest.json: the embedding model, the shards and the ANN state
+- <shard>.vectors.npy / <shard>.meta.npz: one append-only shard per
+  update (vectors; email id, field, character span and IVF list per row)
+- <shard>.alive.npy: tombstones for segments of changed or removed emails
+- centroids.npy: the IVF coarse quantizer (spherical k-means)
+- emails.json: content hash per email, so an update only embeds what changed
+
+Below ANN_MIN_ROWS every live row is scored; above it a query is scored
+against the ANN_PROBES nearest IVF lists only. Updates append a shard and
+tombstone replaced rows; once there are too many shards or dead rows the
+index is compacted into one shard and the centroids are retrained.
+
+The index is built offline, incrementally:
+
+    python semantic_index.py --csv Prompt_Eng_Topic_303_2-20.csv
+    python semantic_index.py --csv new_drop.csv --delete-missing
+
+`parse` recognizes content questions ("what did X say about fuel cell
+pricing after 2001-01-01?") and splits them into the text to search for
+and the graph filters (sender/recipient, dates, responsive) that the
+server applies in Neo4j; see server.semantic_answer.
+"""
+import os
+import re
+import json
+import zlib
+import calendar
+import hashlib
+import importlib.util
+import argparse
+import threading
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_INDEX_PATH = os.getenv("EMBEDDING_INDEX_PATH", "embeddings")
+# sentence-transformers: EMBEDDING_MODEL run on the CPU
+# hashing: feature-hashed words and word pairs, no model needed, but lexical only
+# auto: sentence-transformers if it is installed, else hashing
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "auto")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+EMBEDDING_DIM = int(os.getenv("EMBEDDING_DIM", "512"))
+SEGMENT_WORDS = int(os.getenv("EMBEDDING_SEGMENT_WORDS", "120"))
+SEGMENT_OVERLAP = 30
+ENCODE_BATCH = 256
+
+ANN_MIN_ROWS = int(os.getenv("ANN_MIN_ROWS", "2000"))
+ANN_PROBES = int(os.getenv("ANN_PROBES", "8"))
+KMEANS_SAMPLE = 20000
+MAX_SHARDS = 8
+MAX_DEAD_RATIO = 0.3
+
+CONTENT, ANALYSIS = 0, 1
+FIELDS = ("content", "analysis")
+
+WORD_RX = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+SPAN_RX = re.compile(r"\S+")
+STOP_WORDS = frozenset("""
+a an the and or but if of to in on at by for with from as is are was were be been being it its this that
+these those there here i me my we our you your he him his she her they them their what which who whom
+how when where why do does did done have has had not no so than too very can will would should could
+may might must about into over under again any all some such only own same just also any each other
+email emails mail message messages say said says tell told talk talked wrote write written mention
+mentioned mentions discuss discussed discussing regarding concerning
+""".split())
+SUFFIXES = ("ing", "ed", "es", "s", "e")
+
+
+def _stem(word):
+    for suffix in SUFFIXES:
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3:
+            return word[:-len(suffix)]
+    return word
+
+
+class HashingEmbedder:
+    """
+    Signed feature hashing of stemmed words (weight 1) and adjacent word
+    pairs (weight 0.5) into `dim` buckets, L2-normalized. Lexical rather
+    than semantic, but deterministic, instant and dependency-free.
+    """
+
+    def __init__(self, dim=EMBEDDING_DIM):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+
+    def _features(self, text):
+        words = [_stem(w) for w in WORD_RX.findall(text.lower()) if w not in STOP_WORDS]
+        return [(w, 1.0) for w in words] + [(f"{a} {b}", 0.5) for a, b in zip(words, words[1:])]
+
+    def encode(self, texts):
+        out = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            features = self._features(text)
+            if not features:
+                continue
+            hashes = np.fromiter((zlib.crc32(f.encode("utf-8")) for f, _ in features), dtype=np.uint32,
+                                 count=len(features))
+            weights = np.array([w for _, w in features], dtype=np.float32)
+            signs = np.where(hashes & 0x80000000, 1.0, -1.0).astype(np.float32)
+            np.add.at(out[i], (hashes % self.dim).astype(np.int64), signs * weights)
+        return _normalize(out)
+
+
+class SentenceTransformerEmbedder:
+    """sentence-transformers model on the CPU; loaded on first use."""
+
+    def __init__(self, model_name=EMBEDDING_MODEL):
+        self.name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+                    logger.info("Loading embedding model %s", self.name)
+                    self._model = SentenceTransformer(self.name, device="cpu")
+        return self._model
+
+    @property
+    def dim(self):
+        return self.load().get_sentence_embedding_dimension()
+
+    def encode(self, texts):
+        vectors = self.load().encode(list(texts), batch_size=64, convert_to_numpy=True, normalize_embeddings=True)
+        return vectors.astype(np.float32, copy=False)
+
+
+def create_embedder(model=None):
+    """The embedder for `model` (an index's manifest entry), or the one EMBEDDING_BACKEND selects."""
+    if model is None:
+        backend = EMBEDDING_BACKEND
+        if backend == "auto":
+            backend = "sentence-transformers" if importlib.util.find_spec("sentence_transformers") else "hashing"
+            if backend == "hashing":
+                logger.warning("sentence-transformers is not installed; using hashing embeddings, which match "
+                               "words rather than meaning (pip install sentence-transformers)")
+        model = f"hashing-{EMBEDDING_DIM}" if backend == "hashing" else EMBEDDING_MODEL
+    if model.startswith("hashing-"):
+        return HashingEmbedder(int(model.split("-", 1)[1]))
+    return SentenceTransformerEmbedder(model)
+
+
+def _normalize(vectors):
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+
+def segment(email):
+    """(field, start, end, text to embed) for each segment of a parsed email; spans index the field's text."""
+    segments = []
+    content = email.get("content") or ""
+    subject = email.get("subject") or ""
+    words = [m.span() for m in SPAN_RX.finditer(content)]
+    stride = max(1, SEGMENT_WORDS - SEGMENT_OVERLAP)
+    for i in range(0, max(len(words) - SEGMENT_OVERLAP, 1), stride):
+        window = words[i:i + SEGMENT_WORDS]
+        if not window:
+            break
+        start, end = window[0][0], window[-1][1]
+        segments.append((CONTENT, start, end, f"{subject}\n{content[start:end]}"))
+    analysis = email.get("analysis") or ""
+    if analysis:
+        segments.append((ANALYSIS, 0, len(analysis), analysis))
+    if not segments and subject:
+        segments.append((CONTENT, 0, 0, subject))
+    return segments
+
+
+def email_hash(email):
+    encoded = json.dumps([email.get("subject"), email.get("content"), email.get("analysis")], default=str)
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def _kmeans(vectors, k, iterations=10, seed=0):
+    """Spherical k-means: unit centroids maximizing cosine similarity to their members."""
+    rng = np.random.default_rng(seed)
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = _assign(vectors, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        empty = ~sums.any(axis=1)
+        sums[empty] = centroids[empty]
+        centroids = _normalize(sums)
+    return centroids
+
+
+def _assign(vectors, centroids, block=65536):
+    """Nearest centroid per row, scored in blocks to bound memory."""
+    if centroids is None:
+        return np.full(len(vectors), -1, dtype=np.int32)
+    out = np.empty(len(vectors), dtype=np.int32)
+    for i in range(0, len(vectors), block):
+        out[i:i + block] = np.argmax(np.asarray(vectors[i:i + block]) @ centroids.T, axis=1)
+    return out
+
+
+class Shard:
+    """One append-only batch of segment vectors (memory-mapped) and their metadata."""
+
+    def __init__(self, root, name):
+        self.root, self.name = root, name
+        self.vectors = np.load(self._file("vectors.npy"), mmap_mode="r")
+        with np.load(self._file("meta.npz")) as meta:
+            self.email_ids = meta["email_ids"]
+            self.field = meta["field"]
+            self.start = meta["start"]
+            self.end = meta["end"]
+            self.lists = meta["lists"]
+        self.alive = np.load(self._file("alive.npy"))
+        self._index_lists()
+
+    def _file(self, suffix):
+        return os.path.join(self.root, f"{self.name}.{suffix}")
+
+    def _index_lists(self):
+        self.order = np.argsort(self.lists, kind="stable")
+        n_lists = int(self.lists.max()) + 1 if len(self.lists) and self.lists.max() >= 0 else 0
+        self.bounds = np.searchsorted(self.lists[self.order], np.arange(n_lists + 1))
+
+    def rows_in(self, lists):
+        """Rows assigned to any of the IVF `lists`."""
+        parts = [self.order[self.bounds[l]:self.bounds[l + 1]] for l in lists if l + 1 < len(self.bounds)]
+        return np.sort(np.concatenate(parts)) if parts else np.empty(0, dtype=np.int64)
+
+    @staticmethod
+    def write(root, name, vectors, email_ids, field, start, end, lists):
+        np.save(os.path.join(root, f"{name}.vectors.npy"), vectors.astype(np.float32, copy=False))
+        np.savez(os.path.join(root, f"{name}.meta.npz"), email_ids=np.array(email_ids, dtype=str),
+                 field=np.asarray(field, dtype=np.int8), start=np.asarray(start, dtype=np.int32),
+                 end=np.asarray(end, dtype=np.int32), lists=np.asarray(lists, dtype=np.int32))
+        _save_atomic(os.path.join(root, f"{name}.alive.npy"), np.ones(len(email_ids), dtype=bool))
+
+    def save_alive(self):
+        _save_atomic(self._file("alive.npy"), self.alive)
+
+    def delete_files(self):
+        for suffix in ("vectors.npy", "meta.npz", "alive.npy"):
+            try:
+                os.remove(self._file(suffix))
+            except OSError:
+                pass
+
+
+def _save_atomic(path, array):
+    tmp = path + ".tmp.npy"
+    np.save(tmp, array)
+    os.replace(tmp, path)
+
+
+def _write_json(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+class SemanticIndex:
+    """
+    The on-disk index. `open` is all the server needs; `update`, `remove`
+    and `compact` are for the offline builder. The manifest is written last,
+    so a reader never sees a shard list whose files aren't complete.
+    """
+
+    def __init__(self, root, model, dim):
+        self.root, self.model, self.dim = root, model, dim
+        self.shards = []
+        self.centroids = None
+        self.trained_rows = 0
+        self.next_shard = 0
+        self.hashes = {}
+        self._email_rows = None
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.root, "manifest.json")
+
+    @classmethod
+    def open(cls, root=EMBEDDING_INDEX_PATH, embedder=None):
+        """The index under `root`; a new empty one (for `embedder`) if there is none yet."""
+        path = os.path.join(root, "manifest.json")
+        if not os.path.exists(path):
+            if embedder is None:
+                raise FileNotFoundError(path)
+            os.makedirs(root, exist_ok=True)
+            return cls(root, embedder.name, embedder.dim)
+        with open(path) as f:
+            manifest = json.load(f)
+        index = cls(root, manifest["model"], manifest["dim"])
+        index.shards = [Shard(root, name) for name in manifest["shards"]]
+        index.trained_rows = manifest.get("trained_rows", 0)
+        index.next_shard = manifest.get("next_shard", len(index.shards))
+        if manifest.get("centroids"):
+            index.centroids = np.load(os.path.join(root, manifest["centroids"]))
+        return index
+
+    def __len__(self):
+        return int(sum(shard.alive.sum() for shard in self.shards))
+
+    @property
+    def total_rows(self):
+        return sum(len(shard.alive) for shard in self.shards)
+
+    def load_hashes(self):
+        path = os.path.join(self.root, "emails.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                self.hashes = json.load(f)
+        return self.hashes
+
+    def _save(self):
+        _write_json(os.path.join(self.root, "emails.json"), self.hashes)
+        _write_json(self.manifest_path, {
+            "model": self.model,
+            "dim": self.dim,
+            "shards": [shard.name for shard in self.shards],
+            "next_shard": self.next_shard,
+            "centroids": "centroids.npy" if self.centroids is not None else None,
+            "trained_rows": self.trained_rows,
+        })
+
+    # --- building ------------------------------------------------------
+
+    def _tombstone(self, email_ids):
+        email_ids = np.array(sorted(email_ids), dtype=str)
+        for shard in self.shards:
+            dead = shard.alive & np.isin(shard.email_ids, email_ids)
+            if dead.any():
+                shard.alive &= ~dead
+                shard.save_alive()
+
+    def update(self, items, embedder):
+        """Embed new or changed emails (parsed by ingest.parse_chunk) into a new shard; returns how many."""
+        if embedder.name != self.model:
+            raise ValueError(f"Index was built with {self.model}, not {embedder.name}; rebuild it")
+        self._email_rows = None
+        if not self.hashes:
+            self.load_hashes()
+        latest = {item["email"]["id"]: item["email"] for item in items}
+        changed = {email_id: email for email_id, email in latest.items()
+                   if self.hashes.get(email_id) != email_hash(email)}
+        if not changed:
+            return 0
+        self._tombstone(set(changed) & set(self.hashes))
+
+        email_ids, field, start, end, texts = [], [], [], [], []
+        for email_id, email in changed.items():
+            for seg_field, seg_start, seg_end, text in segment(email):
+                email_ids.append(email_id)
+                field.append(seg_field)
+                start.append(seg_start)
+                end.append(seg_end)
+                texts.append(text)
+        if texts:
+            vectors = np.concatenate([embedder.encode(texts[i:i + ENCODE_BATCH])
+                                      for i in range(0, len(texts), ENCODE_BATCH)])
+            name = f"shard-{self.next_shard:06d}"
+            self.next_shard += 1
+            Shard.write(self.root, name, vectors, email_ids, field, start, end, _assign(vectors, self.centroids))
+            self.shards.append(Shard(self.root, name))
+        for email_id, email in changed.items():
+            self.hashes[email_id] = email_hash(email)
+        if self._needs_compaction():
+            self.compact()
+        else:
+            self._save()
+        return len(changed)
+
+    def remove(self, email_ids):
+        if not self.hashes:
+            self.load_hashes()
+        gone = [email_id for email_id in email_ids if email_id in self.hashes]
+        if not gone:
+            return
+        self._email_rows = None
+        self._tombstone(gone)
+        for email_id in gone:
+            del self.hashes[email_id]
+        if self._needs_compaction():
+            self.compact()
+        else:
+            self._save()
+
+    def _needs_compaction(self):
+        total, alive = self.total_rows, len(self)
+        if len(self.shards) > MAX_SHARDS or (total and (total - alive) / total > MAX_DEAD_RATIO):
+            return True
+        # Centroids are (re)trained once there are enough rows, and again as they grow
+        return alive >= ANN_MIN_ROWS and (self.centroids is None or alive > 4 * self.trained_rows)
+
+    def compact(self):
+        """Merge the live rows into one shard and retrain the IVF centroids."""
+        old = self.shards
+        parts = [(shard, np.flatnonzero(shard.alive)) for shard in old]
+        vectors = np.concatenate([np.asarray(shard.vectors[rows]) for shard, rows in parts]) if parts \
+            else np.empty((0, self.dim), dtype=np.float32)
+        columns = {name: np.concatenate([getattr(shard, name)[rows] for shard, rows in parts]) if parts else []
+                   for name in ("email_ids", "field", "start", "end")}
+        self.centroids, self.trained_rows = None, 0
+        if len(vectors) >= ANN_MIN_ROWS:
+            n_lists = int(np.sqrt(len(vectors)))
+            sample = vectors[np.random.default_rng(0).permutation(len(vectors))[:KMEANS_SAMPLE]]
+            self.centroids = _kmeans(sample, n_lists)
+            self.trained_rows = len(vectors)
+            _save_atomic(os.path.join(self.root, "centroids.npy"), self.centroids)
+        name = f"shard-{self.next_shard:06d}"
+        self.next_shard += 1
+        Shard.write(self.root, name, vectors, columns["email_ids"], columns["field"], columns["start"],
+                    columns["end"], _assign(vectors, self.centroids))
+        self.shards = [Shard(self.root, name)]
+        self._save()
+        for shard in old:
+            shard.delete_files()
+        logger.info("Compacted %d shards into %s: %d rows, %s IVF lists", len(old), name, len(vectors),
+                    len(self.centroids) if self.centroids is not None else "no")
+
+    # --- searching -----------------------------------------------------
+
+    def _rows_of(self, email_ids):
+        """Live rows of the given emails, per shard."""
+        if self._email_rows is None:
+            rows = {}
+            for s, shard in enumerate(self.shards):
+                for row, email_id in enumerate(shard.email_ids.tolist()):
+                    rows.setdefault(email_id, []).append((s, row))
+            self._email_rows = rows
+        per_shard = [[] for _ in self.shards]
+        for email_id in email_ids:
+            for s, row in self._email_rows.get(email_id, ()):
+                per_shard[s].append(row)
+        return [np.array(sorted(rows), dtype=np.int64) for rows in per_shard]
+
+    def search(self, vector, k, email_ids=None):
+        """
+        The `k` emails whose best segment scores highest against `vector`,
+        as [{'id', 'score', 'field', 'start', 'end'}]. Restricted to
+        `email_ids` (scored exactly) when given, else approximate above
+        ANN_MIN_ROWS.
+        """
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        if email_ids is not None:
+            candidates = self._rows_of(email_ids)
+        elif self.centroids is not None:
+            probes = np.argsort(-(self.centroids @ vector))[:ANN_PROBES]
+            candidates = [shard.rows_in(probes) for shard in self.shards]
+        else:
+            candidates = [np.flatnonzero(shard.alive) for shard in self.shards]
+
+        scores, where = [], []
+        for s, (shard, rows) in enumerate(zip(self.shards, candidates)):
+            rows = rows[shard.alive[rows]]
+            if len(rows):
+                scores.append(np.asarray(shard.vectors[rows]) @ vector)
+                where.append(np.stack([np.full(len(rows), s), rows], 1))
+        if not scores:
+            return []
+        scores, where = np.concatenate(scores), np.concatenate(where)
+        hits, seen = [], set()
+        for i in np.argsort(-scores, kind="stable"):
+            shard, row = self.shards[where[i, 0]], where[i, 1]
+            email_id = str(shard.email_ids[row])
+            if email_id in seen:
+                continue
+            seen.add(email_id)
+            hits.append({"id": email_id, "score": float(scores[i]), "field": FIELDS[shard.field[row]],
+                         "start": int(shard.start[row]), "end": int(shard.end[row])})
+            if len(hits) >= k:
+                break
+        return hits
+
+
+class SemanticStore:
+    """
+    Serves the index built by this module's CLI, opening it on first use
+    and reopening it when the manifest changes. `current()` is None while
+    there is no index, in which case content questions take the normal path.
+    """
+
+    def __init__(self, path=EMBEDDING_INDEX_PATH):
+        self.path = path
+        self.index = None
+        self.embedder = None
+        self._mtime = None
+        self._lock = threading.Lock()
+
+    def set(self, index, embedder):
+        """Serve an index opened elsewhere instead of watching `path`."""
+        self.index, self.embedder, self.path = index, embedder, None
+
+    def current(self):
+        if self.path is None:
+            return self.index
+        try:
+            mtime = os.stat(os.path.join(self.path, "manifest.json")).st_mtime_ns
+        except OSError:
+            return self.index
+        if mtime != self._mtime:
+            with self._lock:
+                if mtime != self._mtime:
+                    try:
+                        index = SemanticIndex.open(self.path)
+                        if self.embedder is None or self.embedder.name != index.model:
+                            self.embedder = create_embedder(index.model)
+                        self.index = index
+                        logger.info("Semantic index loaded: %d segments (%s) from %s",
+                                    len(index), index.model, self.path)
+                    except (OSError, ValueError, KeyError) as e:
+                        logger.warning("Semantic index load failed: %s", e)
+                    self._mtime = mtime
+        return self.index
+
+    def search(self, text, k, email_ids=None):
+        index = self.current()
+        if index is None:
+            return []
+        return index.search(self.embedder.encode([text])[0], k, email_ids)
+
+
+# --- content-question parser ------------------------------------------
+
+ADDRESS = r"[\w.+'-]+@[\w-]+(?:\.[\w-]+)+"
+DATE = r"\d{4}-\d{2}-\d{2}(?:[tT ]\d{2}:\d{2}(?::\d{2})?)?"
+TRIGGER_RX = re.compile(
+    r"\b(?:about|regarding|concerning|mention(?:s|ed|ing)?|discuss(?:es|ed|ing)?|refer(?:s|red)? to)\s+(?P<text>.+)$",
+    re.IGNORECASE)
+DATE_CLAUSE_RX = re.compile(rf"\b(?P<dir>after|before|since|until)\s+(?P<date>{DATE})", re.IGNORECASE)
+SENDER_RX = re.compile(rf"\b(?:from|by)\s+(?P<a>{ADDRESS})", re.IGNORECASE)
+RECIPIENT_RX = re.compile(rf"\b(?:to|cc|bcc)\s+(?P<a>{ADDRESS})", re.IGNORECASE)
+# "what did X receive about ..." makes an otherwise unplaced address a recipient
+RECEIVED_RX = re.compile(r"\b(?:receive[ds]?|get|got)\b", re.IGNORECASE)
+ADDRESS_RX = re.compile(ADDRESS)
+RESPONSIVE_RX = re.compile(r"\b(?:responsive|relevant)\b", re.IGNORECASE)
+# Aggregates ("how many", "who sent the most", "list the emails ...") are what Cypher and the analytics are for
+SKIP_RX = re.compile(r"^\s*(?:how many|who|whom|which (?:person|people|sender|recipient)s?|list|count|show)\b"
+                     r"|\b(?:the most|the fewest|the least|top \d+|number of)\b", re.IGNORECASE)
+# So is topic membership, wherever the topic is named
+TOPIC_RX = re.compile(r"\btopic\s+\w+", re.IGNORECASE)
+MONTHS = ("january", "february", "march", "april", "may", "june", "july", "august", "september", "october",
+          "november", "december")
+# "in 2001", "during March 2001": a date range, not part of what the emails say
+PERIOD_RX = re.compile(rf"\b(?:in|during)\s+(?:(?P<month>{'|'.join(MONTHS)})\s+)?(?P<year>\d{{4}})\b",
+                       re.IGNORECASE)
+# What's left of "sent by X" / "received from X" once the address is taken out
+TRAILING_VERB_RX = re.compile(r"(?:\s+(?:that|which)\s+(?:was|were))?\s+(?:sent|received|written|forwarded|copied)"
+                              r"(?:\s+(?:to|by|from|on))?$", re.IGNORECASE)
+# A quoted phrase anywhere asks for that exact text: a keyword lookup (fulltext.py), not a semantic one.
+# Single quotes only count away from letters, so "Ken's" isn't a quote
+QUOTED_RX = re.compile(r"[\"\u201c][^\"\u201d]+[\"\u201d]|\u2018[^\u2019]+\u2019|(?<!\w)'[^']+'(?!\w)")
+
+
+def _period(match):
+    """(first, last) instant of the year or month a PERIOD_RX match names."""
+    year = int(match.group("year"))
+    if match.group("month") is None:
+        return f"{year}-01-01T00:00:00", f"{year}-12-31T23:59:59"
+    month = MONTHS.index(match.group("month").lower()) + 1
+    last = calendar.monthrange(year, month)[1]
+    return f"{year}-{month:02d}-01T00:00:00", f"{year}-{month:02d}-{last:02d}T23:59:59"
+
+
+def _substitute_names(text, persons):
+    """`text` with each whole-word name in `persons` replaced by its address, all in one pass."""
+    if not persons:
+        return text
+    by_name = {name.lower(): person for name, person in persons.items()}
+    # Longest first, so "Jeff Dasovich" wins over "jeff"; never inside a word or an address
+    names = "|".join(re.escape(name) for name in sorted(persons, key=len, reverse=True))
+    rx = re.compile(rf"(?<![\w.@'+-])(?:{names})(?![\w@'-]|\.\w)", re.IGNORECASE)
+    return rx.sub(lambda m: by_name[m.group(0).lower()], text)
+
+
+def parse(question, persons=None):
+    """
+    Split a content question into {'text', 'senders', 'recipients',
+    'after', 'before', 'inclusive', 'responsive'}, or None if `question`
+    isn't one. `persons` maps names the NER resolved to their addresses.
+    """
+    text = _substitute_names(question.strip(), persons)
+    m = TRIGGER_RX.search(text)
+    # Aggregate wording counts before the subject only: "say about the number of plants" is content
+    if (m is None or SKIP_RX.search(text[:m.start("text")]) or TOPIC_RX.search(m.group("text"))
+            or QUOTED_RX.search(text)):
+        return None
+
+    after = before = None
+    inclusive = False
+    for date in DATE_CLAUSE_RX.finditer(text):
+        value = date.group("date").upper().replace(" ", "T")
+        if date.group("dir").lower() in ("after", "since"):
+            after = value
+        else:
+            before = value
+        inclusive = date.group("dir").lower() in ("since", "until")
+    period = PERIOD_RX.search(text)
+    if period and after is None and before is None:
+        after, before = _period(period)
+        inclusive = True
+    senders = [r.group("a") for r in SENDER_RX.finditer(text)]
+    recipients = [r.group("a") for r in RECIPIENT_RX.finditer(text)]
+    unplaced = [a for a in ADDRESS_RX.findall(text) if a not in senders and a not in recipients]
+    (recipients if RECEIVED_RX.search(text) else senders).extend(unplaced)
+
+    subject = PERIOD_RX.sub(" ", DATE_CLAUSE_RX.sub(" ", m.group("text")))
+    subject = ADDRESS_RX.sub(" ", RECIPIENT_RX.sub(" ", SENDER_RX.sub(" ", subject)))
+    subject = re.sub(r"\s+", " ", subject).strip(" ?.!,")
+    subject = TRAILING_VERB_RX.sub("", subject).strip(" ?.!,")
+    if not subject:
+        return None
+    return {
+        "text": subject,
+        "senders": senders,
+        "recipients": recipients,
+        "after": after,
+        "before": before,
+        "inclusive": inclusive,
+        "responsive": bool(RESPONSIVE_RX.search(text)),
+    }
+
+
+def filter_cypher(query, topic, restrict=True):
+    """
+    (cypher, params) applying `query`'s graph filters to Email nodes. With
+    `restrict` the emails are limited to $ids (the semantic hits) and their
+    text is returned; without it only the ids of every matching email are
+    (up to $limit), to search within.
+    """
+    conditions = ["e.id IN $ids"] if restrict else []
+    params = {}
+    for i, person in enumerate(query["senders"]):
+        conditions.append(f"EXISTS {{ MATCH (:Person {{id: $sender{i}}})-[:SEND]->(e) }}")
+        params[f"sender{i}"] = person
+    for i, person in enumerate(query["recipients"]):
+        conditions.append(f"EXISTS {{ MATCH (:Person {{id: $recipient{i}}})-[:RECEIVE|Cc|Bcc]->(e) }}")
+        params[f"recipient{i}"] = person
+    if query["after"]:
+        conditions.append(f"e.date_time {'>=' if query['inclusive'] else '>'} datetime($after)")
+        params["after"] = query["after"]
+    if query["before"]:
+        conditions.append(f"e.date_time {'<=' if query['inclusive'] else '<'} datetime($before)")
+        params["before"] = query["before"]
+    if query["responsive"]:
+        conditions.append("EXISTS { MATCH (e)-[:RESPONSIVE]->(:Topic {name: $topic}) }")
+        params["topic"] = topic
+    where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+    if restrict:
+        return (f"MATCH (e:Email){where} RETURN e.id AS id, e.subject AS subject, e.date_time AS date_time, "
+                f"e.content AS content, e.analysis AS analysis"), params
+    return f"MATCH (e:Email){where} RETURN e.id AS id LIMIT $limit", params
+
+
+def has_filters(query):
+    return bool(query["senders"] or query["recipients"] or query["after"] or query["before"]
+                or query["responsive"])
+
+
+def build(csv_path, root=EMBEDDING_INDEX_PATH, chunk_size=2000, delete_missing=False, embedder=None):
+    """
+    Add the emails in `csv_path` (a CSV or a table from email_table.py) to
+    the index under `root`, embedding only new or changed ones.
+    """
+    from email_table import read_chunks
+
+    embedder = embedder or create_embedder()
+    index = SemanticIndex.open(root, embedder)
+    index.load_hashes()
+    seen, embedded = set(), 0
+    for parsed in read_chunks(csv_path, chunk_size):
+        seen.update(item["email"]["id"] for item in parsed)
+        embedded += index.update(parsed, embedder)
+    removed = 0
+    if delete_missing:
+        missing = [email_id for email_id in index.hashes if email_id not in seen]
+        index.remove(missing)
+        removed = len(missing)
+    if not os.path.exists(index.manifest_path):
+        index._save()
+    logger.info("Semantic index %s: %d emails embedded, %d removed, %d live segments in %d shards",
+                root, embedded, removed, len(index), len(index.shards))
+    return embedded
+
+
+def main(argv=None):
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build or update the semantic index over email text.")
+    parser.add_argument("--csv", default="Prompt_Eng_Topic_303_2-20.csv",
+                        help="email CSV, or a table converted from one by email_table.py")
+    parser.add_argument("--path", default=EMBEDDING_INDEX_PATH, help="index directory")
+    parser.add_argument("--chunk-size", type=int, default=2000, help="emails read per chunk")
+    parser.add_argument("--delete-missing", action="store_true",
+                        help="drop emails from the index that are not in --csv")
+    parser.add_argument("--compact", action="store_true", help="merge shards and retrain the ANN centroids")
+    args = parser.parse_args(argv)
+    build(args.csv, args.path, chunk_size=args.chunk_size, delete_missing=args.delete_missing)
+    if args.compact:
+        SemanticIndex.open(args.path).compact()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,32 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 import os
-import requests
+import time
+import atexit
+import asyncio
+import threading
 import logging
 import re
 import json
 from flask_cors import CORS
-from tenacity import retry, stop_after_attempt, wait_fixed
-from neo4j import GraphDatabase
-import spacy
+from llm_client import LLMClient, LLMError, run_sync, set_priority, PRIORITY_SPECULATIVE, PRIORITY_BATCH
+from translation_cache import TranslationCache, normalize_question
+from person_index import PersonResolver
+from database import Neo4jDatabase
+from email_table import EmailTable, EMAIL_TABLE_PATH
+from prompts import (REFRAME_QUESTION_PROMPT, cypher_messages, format_messages, fit_history,
+                     count_message_tokens)
+from analytics import AnalyticsStore, route as analytics_route
+from semantic_index import SemanticStore, parse as semantic_parse, filter_cypher, has_filters
+from graph_engine import GRAPH_ENGINE, GraphEngineStore, EngineFirst
+from fulltext import (TextIndexStore, rewrite as fulltext_rewrite, lucene_query, FULLTEXT_BACKEND,
+                      FULLTEXT_QUERY, FULLTEXT_INDEX_NAME, FULLTEXT_MAX_IDS)
+from ner import create_ner
+from sessions import create_session_store, open_conversation
+import metrics
+from cypher_params import PreparedQueries
+from cypher_schema import validate, repair, schema_summary, CypherValidationError
+from result_pages import (RESULT_PAGE_SIZE, Page, project_nodes, paginate, summarize_rows,
+                          encode_cursor, decode_cursor)
 
 app = Flask(__name__)
 CORS(app)
@@ -22,124 +41,46 @@ NEO4J_URI = os.getenv("NEO4J_URI", "bolt://localhost:7687")
 NEO4J_USER = os.getenv("NEO4J_USER", "neo4j")
 NEO4J_PASSWORD = os.getenv("NEO4J_PASSWORD", "ML10051005")
 
-# Load NLP model for entity extraction
-ner = spacy.load("en_core_web_trf")
-
-# Retryable OpenAI request
-def send_request(payload):
-    @retry(stop=stop_after_attempt(5), wait=wait_fixed(2))
-    def do_post(p):
-        return requests.post(
-            endpoint,
-            headers={"Content-Type": "application/json", "api-key": api_key},
-            json={
-            "messages": [
-                {"role": "system", "content": "You are a Neo4j Cypher expert."},
-                {"role": "user", "content": p}
-            ],
-            "max_tokens": 200,
-            "temperature": 0.1,
-            "top_p": 0.95
-        },
-            timeout=10
-        )
-    return do_post(payload)
-
-REFRAME_QUESTION_PROMPT = """
-You are an intelligent query refiner for a Neo4j database. Your task is to take a user's natural language question, analyze its meaning, and reframe it into a more precise query. You should clarify ambiguous terms and confirm with the user that the reframed question correctly represents their intent.
-
-### Neo4j Database Schema:
-Nodes:
-- (:Email {{id, date_time, subject, content, relevant, analysis}})
-- (:Person {{id}})
-- (:Topic {{name}})
-
-Relationships:
-- (:Person)-[:SEND]->(:Email)
-- (:Person)-[:RECEIVE]->(:Email)
-- (:Person)-[:Cc]->(:Email)
-- (:Person)-[:Bcc]->(:Email)
-- (:Email)-[:RESPONSIVE]->(:Topic)
-
-### Instructions:
-Given a natural language question, perform the following steps:
-
-1. **Analyze the user's question:**
-    - Identify vague or ambiguous terms (e.g., "important," "related," "best," "most relevant").
-    - Break down the question into measurable database attributes (e.g., number of emails sent, received, Bcc'd).
-    - Consider how the question aligns with Neo4j's data structure (e.g., nodes, relationships, and properties).
-
-2. **Reframe the question with a clear definition:**
-    - Most important!:If in the chat history, assistant or user has identified email address for persons, please use email instead of person's name.
-    - Rewrite the question to remove ambiguity.
-    - Ensure that it can be directly translated into a Cypher query.
-    - Keep it concise and specific to the database schema.
-
-3. **Confirm with the user:**
-    - Explain why you redefined the question in a concise, logical explanation.
-    - Ask the user for confirmation or clarification if the intent is still unclear.
-
-4. **Determine whether to terminate the clarification process:**
-    - If the user's message indicates they no longer want to clarify, reframe, or refine the question (e.g., "stop," "this is good enough," "no need to clarify further"), then set `"termination_status": true`.
-    - Otherwise, set `"termination_status": false`.
-
-### Response Format:
-Return a JSON object with the following fields:
-
-- "reframed_question": The clearer, more structured version of the user's question.
-- "explanation": A brief analysis of why the question was reframed this way.
-- "confirmation_message": A follow-up prompt to the user to ensure accuracy or request more details.
-- "termination_status": Boolean indicating whether to stop further clarification (true = stop, false = continue).
-
-Return only valid JSON format, without any additional explanatory text or code block markup
-
-### Example 1:
-
-#### User's Input:
-"Who is the most important person around topic 303?"
-
-#### Generated JSON Response:
-```json
-{{
-  "reframed_question": "Who sent the most emails about topic 303?",
-  "explanation": "The term 'most important' is ambiguous. We assume it refers to the number of emails sent. Thus, the most important person is the one who has sent the most emails related to topic 303.",
-  "confirmation_message": "Is this what you meant by 'most important,' or do you have another definition in mind?",
-  "termination_status": false
-}}"
-
-### Example 2:
-
-#### User's Input:
-"How many emails did Paul send to Dan?"
-
-Most important!:If in the chat history, assistant or user has identified email address for persons, please use email instead of person's name.
-
-#### Generated JSON Response:
-```json
-{{
-  "reframed_question": "How many emails did Paul send to Dan?",
-  "explanation": "The original question is already clear and specific, asking for a count of emails sent by Paul to Dan. This can be directly translated into a Cypher query to retrieve the relevant data.",
-  "confirmation_message": "Does this accurately capture your question, or would you like to adjust any details?",
-  "termination_status": true
-}}"
-
-Most important!:If in the chat history, assistant or user has identified email address for persons, please use email instead of person's name.
-
-"""
+# Shared, pooled client for the completions endpoint; it also rate-limits,
+# coalesces identical calls and retries (LLM_RPM, LLM_TPM, LLM_MAX_ATTEMPTS)
+llm = LLMClient(endpoint, api_key)
+atexit.register(llm.close_sync)
+metrics.registry.add_collector(metrics.llm_collector(llm))
+
+def completion_payload(prompt):
+    """Payload for a plain prompt string, or for messages already assembled by prompts.py."""
+    if isinstance(prompt, str):
+        prompt = [
+            {"role": "system", "content": "You are a Neo4j Cypher expert."},
+            {"role": "user", "content": prompt}
+        ]
+    metrics.record_prompt_tokens(count_message_tokens(prompt))
+    return {
+        "messages": prompt,
+        "max_tokens": 200,
+        "temperature": 0.1,
+        "top_p": 0.95
+    }
+
+# OpenAI request; retries and backoff are handled by the client
+async def send_request(payload):
+    payload = completion_payload(payload)
+    metrics.count_llm_call()
+    response_json = await llm.complete(payload, timeout=10)
+    metrics.record_usage(response_json.get('usage'))
+    return response_json
+
+# Static system prompts live in prompts.py
 
 message_list = [
     {"role": "developer", "content": REFRAME_QUESTION_PROMPT}
 ]   # message_list is a list of dictionaries that keeps all dialogue history between user and assistant
 
 
-def clarify_user_question(message_list):
-    # API Request Headers
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": api_key
-    }
-
-    # API request payload
+async def clarify_user_question(message_list):
+    # API request payload; old turns are dropped if the history outgrows the token budget
+    message_list = fit_history(message_list)
+    metrics.record_prompt_tokens(count_message_tokens(message_list))
     payload = {
         "messages": message_list,
         "max_tokens": 300,
@@ -149,13 +90,12 @@ def clarify_user_question(message_list):
         "presence_penalty": 0,
     }
 
-    logger.info("Sending request to OpenAI API: %s", payload['messages'])
+    logger.debug("Sending request to OpenAI API: %s", payload['messages'])
     try:
         # Send request to OpenAI API
-        response = requests.post(endpoint, headers=headers, json=payload)
-        print(response)
-        response.raise_for_status()  # Raise an exception if there's an error
-        response_json = response.json()
+        metrics.count_llm_call()
+        response_json = await llm.complete(payload)
+        metrics.record_usage(response_json.get('usage'))
         # Extract the generated response
         if "choices" in response_json and len(response_json["choices"]) > 0:
             gpt_response_text = response_json["choices"][0]["message"]["content"]
@@ -182,175 +122,251 @@ def clarify_user_question(message_list):
         else:
             return {"error": "No response from OpenAI API"}
 
-    except requests.exceptions.RequestException as e:
-        print(f"API Error: {e}")
-        if e.response is not None:
-            print(f"Status code: {e.response.status_code}")
-            print(f"Response body: {e.response.text}")
+    except LLMError as e:
+        logger.error("API Error: %s (status %s, body %s)", e, e.status, e.body)
         return {"error": "API request failed"}
 
     except json.JSONDecodeError as e:
-        print(f"JSON Decode Error: {e}")
+        logger.error("JSON Decode Error: %s", e)
         return {"error": "Failed to parse JSON response"}
-    
-
-cy_prompt = f"""
-      Convert the following natural language query into a Cypher query that runs on a Neo4j database with the following schema:
-
-      Nodes:
-      - (:Email {{id, date_time, subject, content, relevant, analysis}})
-      - (:Person {{id}})
-      - (:Topic {{name}})
-
-      Relationships:
-      - (:Person)-[:SEND]->(:Email)
-      - (:Person)-[:RECEIVE]->(:Email)
-      - (:Person)-[:Cc]->(:Email)
-      - (:Person)-[:Bcc]->(:Email)
-      - (:Email)-[:RESPONSIVE]->(:Topic)
-
-      Example queries:
-      1. "Find all emails sent by Alice."
-        Cypher: MATCH (p:Person {{id: 'Alice'}})-[:SEND]->(e:Email) RETURN e
-
-      2. "Find all recipients of email ID 123."
-        Cypher: MATCH (p:Person)-[:RECEIVE]->(e:Email {{id: '123'}}) RETURN p
-
-      3. "Find all emails that are marked as relevant."
-        Cypher: MATCH (e:Email) WHERE e.relevant = 'yes' RETURN e
-
-      4. "How many responsive emails did jeff.dasovich@enron.com send?"
-        Cypher: MATCH (sender:Person {{id: 'jeff.dasovich@enron.com'}})-[:SEND]->(email:Email)-[:RESPONSIVE]->(:Topic {{name:'Topic 303'}})
-        RETURN COUNT(email) AS responsive_emails_sent;
-
-      5. "How many responsive emails did steven.kean@enron.com receive?"
-        Cypher: MATCH (recipient:Person {{id: 'steven.kean@enron.com'}})-[:RECEIVE]->(email:Email)-[:RESPONSIVE]->(:Topic {{name: 'Topic 303'}})
-        RETURN count(email) AS responsive_email_count;
-
-     6. "How many responsive emails did jeff.dasovich@enron.com send to christopher.calger@enron.com?"
-        Cypher: MATCH (sender:Person {{id: 'jeff.dasovich@enron.com'}})-[:SEND]->(email:Email)-[:RESPONSIVE]->(:Topic {{name:'Topic 303'}})
-        MATCH (recipient:Person {{id: 'christopher.calger@enron.com'}})-[:RECEIVE]->(email)
-        RETURN count(email) AS responsive_email_count;
-
-    7. "How many responsive emails were janel.guerrero@enron.com BCC-ed on?"
-        Cypher: MATCH (bccRecipient:Person {{id: 'janel.guerrero@enron.com'}})-[:Bcc]->(email:Email)-[:RESPONSIVE]->(:Topic {{name: 'Topic 303'}})
-        RETURN count(email) AS responsive_email_bcc_count;
-
-    8. "How many responsive emails were sent after "1997-09-10T08:00:00?"
-        Cypher: MATCH (sender:Person)-[:SEND]->(e:Email)-[:RESPONSIVE]->(:Topic {{name: 'Topic 303'}})
-        WHERE e.date_time > datetime("1997-09-10T08:00:00")
-        RETURN count(e) AS responsive_emails_after_date;
-
-      Notice:
-      1. Always produce a valid Cypher query that includes a complete RETURN clause.
-      2. If you do not have enough information to produce a valid Cypher query, output exactly this text instead:
-       "Please clarify. Question is too ambiguous".
-      3. Only answer the cypher, do not add any words.
-      4. Always enclose string values in single quotes (`'`)
-      5. Never truncate the output. The query must be returned in one complete response.
-      6.- All Person nodes use their **email address** as the `id`.
-        - If a user's question includes a person's **name**, and not their email, you can generate a Cypher such as:
-        `WHERE toLower(p.id) CONTAINS "<person name>"`
-        This ensures the system can perform **fuzzy matching** on email IDs.
-      7. Always use the correct relationship direction: (:Person)-[:RELATION]->(:Email). Do not reverse it.
-
-      Cypher Query:
-      """
+# Normalized question -> Cypher template cache, see translation_cache.py
+translation_cache = TranslationCache()
 
 # Generate Cypher query via OpenAI
-@retry(stop=stop_after_attempt(5), wait=wait_fixed(2))
-def prompt_to_cypher(user_input=None,prompt=None):
-  gen_prompt = f"""
-      {cy_prompt}
-      User Query: "{user_input}"
-
-      """
+async def prompt_to_cypher(user_input=None,prompt=None):
+  # Only plain translations are cached; debug/fix prompts always go to the LLM
+  use_cache = prompt is None and bool(user_input)
+  if use_cache:
+      cached_query = translation_cache.lookup(user_input)
+      if cached_query:
+          return cached_query
   if prompt==None:
-      prompt=gen_prompt
-  else:
-      prompt=prompt
+      # Static system prefix, then the few examples closest to this question
+      prompt=cypher_messages(user_input)
   try:
-      response = send_request(prompt)
-      response.raise_for_status()
-      generated_text = response.json()['choices'][0]['message']['content']
+      response_json = await send_request(prompt)
+      generated_text = response_json['choices'][0]['message']['content']
       # Remove markdown markers using replace instead of strip:
       cleaned_query = generated_text.replace("```cypher", "").replace("```", "").strip()
-      print(cleaned_query)
+      logger.info("Generated Cypher: %s", cleaned_query)
+      if use_cache and cleaned_query and not cleaned_query.startswith("Please clarify."):
+          translation_cache.store(user_input, cleaned_query)
       return cleaned_query
-  except requests.exceptions.RequestException as e:
-      print(f"An error occurred: {e}")
-      if hasattr(e, 'response') and e.response:
-          print(f"Status code: {e.response.status_code}")
-          print(f"Response body: {e.response.text}")
-# Neo4j driver wrapper
-class Neo4jDatabase:
-    def __init__(self, uri, user, password):
-        self.driver = GraphDatabase.driver(uri, auth=(user, password))
-    def close(self):
-        self.driver.close()
-    def execute_cypher(self, query):
-        with self.driver.session() as session:
-            return [record.data() for record in session.run(query)]
-
-
-def execute_cypher(query):
-    """
-    Execute a Cypher query using the Neo4j driver.
-    """
-    # If `db` is a driver instance
-    try:
-        with db.session() as session:
-            return [record.data() for record in session.run(query)]
-    except AttributeError:
-        # Fallback for wrapper with `driver`
-        with db.driver.session() as session:
-            return [record.data() for record in session.run(query)]
-        
+  except LLMError as e:
+      logger.error("Cypher generation failed: %s (status %s, body %s)", e, e.status, e.body)
 # Initialize Neo4j
 db = Neo4jDatabase(NEO4J_URI, NEO4J_USER, NEO4J_PASSWORD)
 
+# With GRAPH_ENGINE=1 reads are answered from an in-process snapshot of the
+# graph when it supports the query, and by Neo4j otherwise (graph_engine.py)
+graph_engine_store = GraphEngineStore(db.driver, db.generation)
+if GRAPH_ENGINE:
+    db = EngineFirst(db, graph_engine_store)
+    metrics.registry.add_collector(metrics.graph_engine_collector(db))
+
+# Cache hit rates are read from the caches' own counters when /metrics is scraped
+metrics.registry.add_collector(metrics.cache_collector('translation_cache', translation_cache))
+metrics.registry.add_collector(metrics.cache_collector('result_cache', db.result_cache))
+metrics.registry.add_collector(metrics.neo4j_pool_collector(db))
+
+# Generated query text -> parameterized template; see cypher_params.py
+prepared_queries = PreparedQueries()
+
+def prepared_collector():
+    stats = prepared_queries.stats()
+    return [
+        ('cypher_prepared_hits_total', 'counter', {}, stats['hits']),
+        ('cypher_prepared_misses_total', 'counter', {}, stats['misses']),
+        ('cypher_templates', 'gauge', {}, stats['templates']),
+        ('cypher_executions_total', 'counter', {}, stats['executions']),
+        # Share of executions whose template Neo4j has already planned
+        ('cypher_template_reuse_ratio', 'gauge', {}, round(stats['template_reuse_rate'], 6)),
+    ]
+metrics.registry.add_collector(prepared_collector)
+
+# In-process Person id index for demo_check; rebuilt when the dataset changes
+person_resolver = PersonResolver(db.driver, db.generation)
+if GRAPH_ENGINE:
+    # Each snapshot also refreshes the person index, without a second read of every Person
+    graph_engine_store.on_load = lambda engine, generation: person_resolver.load_ids(engine.person_ids(), generation)
+    graph_engine_store.warm_up()
+elif EMAIL_TABLE_PATH:
+    # The converted dataset has every address already; no scan of the Person nodes.
+    # Only trusted while its CSV is unchanged, since the ids are stamped with Neo4j's current generation
+    try:
+        table = EmailTable(EMAIL_TABLE_PATH)
+        table.check_source()
+        person_resolver.load_ids(table.person_ids())
+    except (OSError, ValueError) as e:
+        logger.warning("Could not read person ids from %s (%s), loading them from Neo4j", EMAIL_TABLE_PATH, e)
+        person_resolver.warm_up()
+else:
+    person_resolver.warm_up()
+
+# Aggregates saved by ingest.py; common count questions are answered from them directly
+analytics_store = AnalyticsStore()
+
+# Keyword index saved by ingest.py; CONTAINS on email text becomes an id lookup (fulltext.py)
+text_index_store = TextIndexStore()
+
+def fulltext_candidates(field, value):
+    """Ids of the emails whose `field` may contain `value`, from the FULLTEXT_BACKEND; None to scan."""
+    backend = FULLTEXT_BACKEND
+    if backend == "auto":
+        backend = "local" if text_index_store.current() is not None else "neo4j"
+    if backend == "local":
+        index = text_index_store.current()
+        return index.candidates(field, value) if index is not None else None
+    if backend == "neo4j":
+        query = lucene_query(field, value)
+        if query is None:
+            return None
+        try:
+            rows = db.execute_cypher(FULLTEXT_QUERY, {'index': FULLTEXT_INDEX_NAME, 'query': query,
+                                                      'limit': FULLTEXT_MAX_IDS + 1})
+        except Exception as e:
+            logger.warning("Full-text lookup failed, scanning instead: %s", e)
+            return None
+        return [row['id'] for row in rows]
+    return None
+
+# Vector index over email text built by semantic_index.py; opened on the first content question
+semantic_store = SemanticStore()
+SEMANTIC_TOP_K = int(os.getenv("SEMANTIC_TOP_K", "5"))
+SEMANTIC_MIN_SCORE = float(os.getenv("SEMANTIC_MIN_SCORE", "0.05"))
+# Nearest emails fetched per result wanted when graph filters may reject some of them
+SEMANTIC_OVERSAMPLE = 10
+# Most emails passing the filters that are searched within when the nearest ones don't
+SEMANTIC_FILTER_LIMIT = 5000
+SNIPPET_CHARS = 400
+RESPONSIVE_TOPIC = os.getenv("RESPONSIVE_TOPIC", "Topic 303")
+
+# NER for PERSON spans; backend picked by NER_BACKEND, loaded on first use
+ner = create_ner(lambda: person_resolver.index)
+
+async def iterate_in_thread(gen):
+    """Consume a blocking generator from a worker thread, yielding its items asynchronously."""
+    loop = asyncio.get_running_loop()
+    done = object()
+    # Serializes step() and close() in case we're cancelled mid-step
+    lock = threading.Lock()
+    def step():
+        with lock:
+            try:
+                return next(gen)
+            except StopIteration:
+                return done
+    def close():
+        with lock:
+            gen.close()
+    try:
+        while True:
+            item = await loop.run_in_executor(None, step)
+            if item is done:
+                return
+            yield item
+    finally:
+        await loop.run_in_executor(None, close)
+
+def trim_record(record):
+    # Whole Email nodes are reduced to the fields the client shows
+    if record.get('email'):
+        return {'analysis': record['email']['analysis'], 'id': record['email']['id']}
+    if record.get('e'):
+        return {'analysis': record['e']['analysis'], 'id': record['e']['id']}
+    return record
+
 # Execute Cypher with syntax-fix retry
-def error_handling_query(cypher_query,prompt=None):
+async def error_handling_query(cypher_query,prompt=None,on_rows=None,skip=0,limit=RESULT_PAGE_SIZE):
+    """
+    Run a query, fixing a syntax error once via the LLM, and return one Page
+    of at most `limit` rows starting at row `skip` (None if it can't be run).
+    Common mistakes (reversed relationships, Cc/Bcc case, a missing RETURN,
+    ...) are repaired locally first, so the LLM is only asked about what
+    `repair` can't fix. The query is checked against the schema, its literals are lifted into
+    parameters (so Neo4j reuses one plan per template), CONTAINS on email
+    text is narrowed by a full-text lookup, whole Email/Person
+    nodes in the RETURN are projected to a few properties and the page is
+    cut server-side with SKIP/LIMIT where the query allows.
+    If `on_rows` is given it is awaited with each batch of rows as it arrives.
+    """
     tried_debug = False #this makes sure we only go through syntax fixing once
+    use_paging = True
     if prompt==None:
-        prompt= cy_prompt
+        # The schema is all a fix needs; the whole translation prompt only adds tokens
+        prompt= schema_summary()
     while True:
+        res=[]
+        cypher_query, repairs = repair(cypher_query)
+        if repairs:
+            metrics.registry.inc('cypher_local_repairs_total', len(repairs))
+            logger.info("🔧 Repaired query locally: %s", "; ".join(repairs))
+        problems = validate(cypher_query)
+        template, params = prepared_queries.prepare(cypher_query)
+        if FULLTEXT_BACKEND != "off" and not problems:
+            template, params, rewritten = await asyncio.to_thread(fulltext_rewrite, template, params,
+                                                                  fulltext_candidates)
+            if rewritten:
+                metrics.registry.inc('cypher_fulltext_rewrites_total', rewritten)
+        query = project_nodes(template)
+        paged = paginate(query) if use_paging else None
+        to_skip, has_more = skip, False
+        if paged:
+            # One extra row tells us whether there is a next page
+            query, to_skip = paged, 0
+            params.update(result_skip=skip, result_limit=limit + 1)
         try:
+            if problems:
+                metrics.registry.inc('cypher_validation_failures_total')
+                raise CypherValidationError("Query does not match the schema: " + "; ".join(problems))
             # Execute Cypher Query in Neo4j
-            results = db.execute_cypher(cypher_query)
-
-            # Display results
-            if results:
-                res=[]
-                print("🔍 Query Results:")
-                for record in results:
-                    if record.get('email'):
-                        new_record = {}
-                        new_record['analysis'] = record['email']['analysis']
-                        new_record['id'] = record['email']['id']
-                        record=new_record
-                    elif record.get('e'):
-                        new_record = {}
-                        new_record['analysis'] = record['e']['analysis']
-                        new_record['id'] = record['e']['id']
-                        record=new_record
-                    print("record:",record,"\n")
-                    res.append(record)
-                print('res',res)
-                return res
+            # Neo4j calls are blocking, so the cursor is drained from a worker thread
+            rows = iterate_in_thread(db.stream_cypher(query, params))
+            try:
+                async for batch in rows:
+                    if to_skip:
+                        dropped = min(to_skip, len(batch))
+                        batch, to_skip = batch[dropped:], to_skip - dropped
+                    room = limit - len(res)
+                    if len(batch) > room:
+                        batch, has_more = batch[:room], True
+                    batch = [trim_record(record) for record in batch]
+                    if logger.isEnabledFor(logging.DEBUG):
+                        for record in batch:
+                            logger.debug("record: %s", record)
+                    res.extend(batch)
+                    if on_rows is not None and batch:
+                        await on_rows(batch)
+                    if has_more:
+                        # Stop reading; closing the cursor discards the rest on the server
+                        break
+            finally:
+                await rows.aclose()
+
+            metrics.record_rows(len(res))
+            if res:
+                logger.info("🔍 Query returned %d rows%s", len(res), " (more available)" if has_more else "")
             else:
-                print("⚠ No results found.")
-                return []
-            return
+                logger.info("⚠ No results found.")
+            return Page(res, skip, has_more, cypher=cypher_query)
         #adding an exept clause to deal with syntax errors:
         except Exception as e:
             error_str = str(e)
 
-            if "SyntaxError" in error_str or "invalid input" in error_str:
+            if paged and not res and ("SyntaxError" in error_str or "invalid input" in error_str):
+                # Our SKIP/LIMIT may be what broke it; try the query as generated first
+                logger.info("Paged query failed, retrying without SKIP/LIMIT: %s", error_str)
+                use_paging = False
+                continue
+
+            # Rows already streamed to the caller can't be taken back, so only retry clean failures
+            fixable = isinstance(e, CypherValidationError) or "SyntaxError" in error_str or "invalid input" in error_str
+            if fixable and not res:
                 # Try debugging once
                 if not tried_debug:
                     tried_debug = True
-                    print("⛔ Syntax error encountered, attempting to fix with LLM...")
+                    logger.warning("⛔ Syntax error encountered, attempting to fix with LLM...")
+                    metrics.registry.inc('cypher_llm_fixes_total')
 
                     # Build a "debug" prompt that can be passed to the same LLM:
                     debug_prompt = f"""
@@ -368,28 +384,26 @@ def error_handling_query(cypher_query,prompt=None):
                     """
 
                     # Reuse prompt_to_cypher to fix the query
-                    debugged_query = prompt_to_cypher(prompt=debug_prompt)
+                    with metrics.span('syntax_fix'):
+                        debugged_query = await prompt_to_cypher(prompt=debug_prompt)
 
                     # If the LLM returned something, retry
                     if debugged_query:
                         cypher_query = debugged_query
                         continue  # Retry the while loop with new query
                     else:
-                        print("No corrected query was returned by the LLM. Stopping.")
-                        print("Original error:", error_str)
+                        logger.error("No corrected query was returned by the LLM. Original error: %s", error_str)
                         return
                 else:
                     # Already tried once
-                    print("⛔ Query still failing after one debug attempt.")
-                    print("Error:", error_str)
+                    logger.error("⛔ Query still failing after one debug attempt: %s", error_str)
                     return
             else:
                 # Some non-syntax error, just print and stop
-                print("⛔ A non-syntax error occurred:")
-                print(error_str)
+                logger.error("⛔ A non-syntax error occurred: %s", error_str)
                 return []
             
-def check_person_existence(person_id):
+async def check_person_existence(person_id):
     # name_search_prompt = f"""
     # Given a user's input containing a person's name (e.g., "jeff dasovich", "Dasovich, Jeff", "Jeff Dasovich?"), generate a Cypher query that finds all :Person nodes whose `id` field (email address) contains the normalized version of the name.
 
@@ -436,100 +450,282 @@ def check_person_existence(person_id):
     else:
         person_id=person_id[0]
 
-    check_query = f"""
-    MATCH (p:Person)
-    WHERE toLower(p.id) CONTAINS toLower('{person_id}')
-    RETURN p.id AS person_id
-    """
     # check_query=prompt_to_cypher(prompt=name_search_prompt)
-    results = error_handling_query(check_query)
-    match_count = len(results)
-    print(match_count)
-    matched_ids = [r['person_id'] for r in results]
+    matched_ids = await asyncio.to_thread(person_resolver.contains, person_id)
+    match_count = len(matched_ids)
+    logger.debug("%d persons match %s", match_count, person_id)
     return (match_count, matched_ids)
 
-def process_query(cypher_query):
+async def process_query(cypher_query):
     """
     Execute a Cypher query and display the results,
     with pre-check for person ID existence and uniqueness.
     """
-    return error_handling_query(cypher_query)
+    return await error_handling_query(cypher_query)
 
 # Format results into natural language via OpenAI
-def format_result_naturally(user_input, cypher_query, cypher_result):
-    prompt = f"""
-You are an assistant that turns Cypher query results into clear and natural language answers.
-
-User Query: "{user_input}"
-Cypher Query: {cypher_query}
-Result: {cypher_result}
-
-Give a single, concise sentence that answers the user question naturally,only using the data from User Query,Cypher Query and result.
-"""
+async def format_result_naturally(user_input, cypher_query, cypher_result, emit=None):
+    prompt = format_messages(user_input, cypher_query, cypher_result)
     try:
-        response = send_request(prompt)
-        response.raise_for_status()
-        generated_text = response.json()['choices'][0]['message']['content'].strip()
+        if emit is not None:
+            # Stream tokens to the client as they arrive
+            parts = []
+            try:
+                metrics.count_llm_call()
+                async for token in llm.stream(completion_payload(prompt)):
+                    parts.append(token)
+                    await emit('token', {'text': token})
+            except LLMError as e:
+                metrics.record_usage({'completion_tokens': len(parts)})
+                if parts:
+                    raise
+                logger.warning("Streaming failed before the first token, retrying without: %s", e)
+            if parts:
+                # Streamed responses carry no usage block; each delta is about one token
+                metrics.record_usage({'completion_tokens': len(parts)})
+                generated_text = "".join(parts).strip()
+                logger.info("Generated natural language output: %s", generated_text)
+                return generated_text
+        response_json = await send_request(prompt)
+        generated_text = response_json['choices'][0]['message']['content'].strip()
         logger.info("Generated natural language output: %s", generated_text)
         return generated_text
     except Exception as e:
         logger.error("LLM formatting failed: %s", e)
         return "Sorry, I couldn't generate a natural language response."
 
-def demo_check(reframed_question):
+def demo_check(reframed_question, person_entities=None):
     """
     Validate PERSON entities in the reframed question and return structured results:
       - {'error': msg} if a name isn't found
       - {'ambiguous_names': [...]} if multiple matches
-      - {'cleaned_question': reframed_question} otherwise
+      - {'cleaned_question': reframed_question, 'persons': {name: id}} otherwise
+    `person_entities` are the question's PERSON spans if NER has already run (/chat/batch).
     """
-    doc = ner(reframed_question)
-    person_entities = [ent.text for ent in doc.ents if ent.label_ == "PERSON"]
+    if person_entities is None:
+        person_entities = ner.persons(reframed_question)
     ambiguous = []
+    persons = {}
 
     for name in person_entities:
-        parts = name.split()
-        normalized = ".".join(parts).lower() if len(parts) > 1 else parts[0].lower()
-        query = f"""
-        MATCH (p:Person)
-        WHERE toLower(p.id) CONTAINS '{normalized}'
-        RETURN p.id AS person_id
-        """
-        results = execute_cypher(query)
-        count = len(results)
+        matches, fuzzy = person_resolver.resolve(name)
+        count = len(matches)
         if count == 0:
             return {'error': f"Person '{name}' not found in database."}
-        if count > 1:
-            ambiguous.append({'name': name, 'options': [r['person_id'] for r in results]})
+        # Fuzzy hits are never taken on trust, the user confirms the address
+        if count > 1 or fuzzy:
+            ambiguous.append({'name': name, 'options': matches})
+        else:
+            persons[name] = matches[0]
 
     if ambiguous:
-        print("multiple matches:", ambiguous)
+        logger.info("multiple matches: %s", ambiguous)
         return {'ambiguous_names': ambiguous}
-    return {'cleaned_question': reframed_question}
+    return {'cleaned_question': reframed_question, 'persons': persons}
 
 EMAIL_RX = re.compile(r"^[^@]+@[^@]+\.[^@]+$")
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    data = request.get_json() or {}
-    user_input = data.get('user_input', '').strip()
-    history = data.get('history', [])
+# Conversation state keyed by conversation_id; backend picked by SESSION_BACKEND
+session_store = create_session_store()
+
+async def handle_chat(data, emit=None):
+    """
+    Run the /chat pipeline for one request body and return (response_dict, status).
+    Shared by the Flask route below and the ASGI app in asgi.py.
+
+    Clients send `conversation_id` plus the new `user_input`; the history is
+    kept server-side (sessions.py). A full `history` array is still accepted
+    from older clients and seeds a new conversation.
+
+    `emit(event, payload)`, if given, is awaited as each stage completes:
+    'reframed', 'cypher', 'rows' (one per batch off the cursor) and 'token'
+    (natural-language answer, streamed).
+
+    Every stage is timed (metrics.py). With `"trace": true` in the request
+    the body also carries `trace`: the trace id and per-stage timings.
+    """
+    if emit is None:
+        async def emit(event, payload):
+            pass
 
+    trace = metrics.start_trace(data.get('trace_id') if isinstance(data.get('trace_id'), str) else None)
+    user_input = data.get('user_input', '').strip()
     if not user_input:
-        return jsonify({'error': "Missing 'user_input'"}), 400
+        return {'error': "Missing 'user_input'"}, 400
+
+    conversation = await asyncio.to_thread(
+        open_conversation, session_store, data.get('conversation_id'), data.get('history'),
+        lambda text: not EMAIL_RX.match(text)
+    )
+    try:
+        body, status = await answer_question(user_input, conversation, emit)
+    except Exception:
+        metrics.registry.inc('chat_requests_total', status=500)
+        raise
+
+    conversation.append('user', user_input, question=not EMAIL_RX.match(user_input))
+    conversation.append('assistant', reply_text(body))
+    await asyncio.to_thread(session_store.save, conversation)
+    body['conversation_id'] = conversation.id
+
+    metrics.registry.observe('chat_request_seconds', trace.elapsed())
+    metrics.registry.inc('chat_requests_total', status=status)
+    timings = trace.to_dict()
+    logger.info("trace %s: %s ms total, %s", trace.id, timings['total_ms'],
+                ", ".join(f"{item['stage']}={item['ms']}ms" for item in timings['spans']))
+    if data.get('trace'):
+        body['trace'] = timings
+    return body, status
+
+def reply_text(body):
+    """The assistant message as the client displays it, kept as conversation history."""
+    if body.get('error'):
+        return body['error']
+    if body.get('clarify_person'):
+        options = "\n".join(f"{item['name']}: {', '.join(item['options'])}" for item in body['ambiguous_names'])
+        return f"{body['message']}\n{options}"
+    if body.get('reframed_question') and body.get('termination_status') is False:
+        return f"{body['reframed_question']}\n{body['confirmation_message']}"
+    return body.get('natural_response', '')
+
+async def fast_answer(question, persons, emit):
+    """
+    The response for `question` straight from the materialized analytics,
+    or None if it isn't one of the aggregate questions they cover.
+    """
+    with metrics.span('analytics'):
+        answer = analytics_route(analytics_store.current(), question, persons)
+    if answer is None:
+        return None
+    metrics.registry.inc('analytics_fast_path_total', intent=answer['intent'])
+    logger.info("Answered from analytics (%s)", answer['intent'])
+    await emit('cypher', {'cypher_query': answer['cypher_query']})
+    await emit('rows', {'rows': answer['results']})
+    return {
+        'cypher_query': answer['cypher_query'],
+        'results': answer['results'],
+        'natural_response': answer['natural_response'],
+        'source': 'analytics',
+    }
+
+async def semantic_hits(query, k, email_ids=None):
+    hits = await asyncio.to_thread(semantic_store.search, query['text'], k, email_ids)
+    return [hit for hit in hits if hit['score'] >= SEMANTIC_MIN_SCORE]
+
+async def semantic_answer(question, persons, emit):
+    """
+    The response for a content question ("what did X say about fuel cell
+    pricing?") from the semantic index: the emails with the nearest text,
+    kept only if they pass the question's graph filters (sender, recipient,
+    dates, responsive) in Neo4j. When too few of the nearest ones pass, the
+    search is rerun within the emails that do. None if `question` isn't a
+    content question or there is no index.
+    """
+    query = semantic_parse(question, persons)
+    if query is None or semantic_store.current() is None:
+        return None
+    filtered = has_filters(query)
+    cypher, params = filter_cypher(query, RESPONSIVE_TOPIC)
+    try:
+        with metrics.span('semantic_search'):
+            hits = await semantic_hits(query, SEMANTIC_TOP_K * SEMANTIC_OVERSAMPLE if filtered else SEMANTIC_TOP_K)
+            rows = await asyncio.to_thread(db.execute_cypher, cypher, {**params, 'ids': [h['id'] for h in hits]})
+            if filtered and len(rows) < SEMANTIC_TOP_K:
+                ids_cypher, ids_params = filter_cypher(query, RESPONSIVE_TOPIC, restrict=False)
+                allowed = await asyncio.to_thread(db.execute_cypher, ids_cypher,
+                                                  {**ids_params, 'limit': SEMANTIC_FILTER_LIMIT})
+                hits = await semantic_hits(query, SEMANTIC_TOP_K, [row['id'] for row in allowed])
+                rows = await asyncio.to_thread(db.execute_cypher, cypher, {**params, 'ids': [h['id'] for h in hits]})
+    except Exception as e:
+        logger.warning("Semantic search failed, taking the Cypher path: %s", e)
+        return None
+
+    by_id = {row['id']: row for row in rows}
+    results = []
+    for hit in hits:
+        row = by_id.get(hit['id'])
+        if row is None:
+            continue
+        text = row.get(hit['field']) or ''
+        results.append({'id': hit['id'], 'subject': row.get('subject'), 'date_time': row.get('date_time'),
+                        'score': round(hit['score'], 3), 'snippet': text[hit['start']:hit['end']][:SNIPPET_CHARS]})
+        if len(results) >= SEMANTIC_TOP_K:
+            break
+    metrics.registry.inc('semantic_search_total', outcome='hit' if results else 'empty')
+    logger.info("Semantic search for %r: %d emails", query['text'], len(results))
+    await emit('cypher', {'cypher_query': cypher})
+    if not results:
+        return {'cypher_query': cypher, 'results': [], 'natural_response': "No matching emails found.",
+                'source': 'semantic'}
+    await emit('rows', {'rows': results})
+    with metrics.span('format_result_naturally'):
+        natural = await format_result_naturally(question, cypher, results, emit=emit)
+    return {'cypher_query': cypher, 'results': results, 'natural_response': natural, 'source': 'semantic'}
+
+# Resolve names and draft the Cypher for the raw question while clarify runs
+SPECULATIVE_CHAT = os.getenv("SPECULATIVE_CHAT", "0") == "1"
+
+async def speculate(question, calls):
+    """
+    demo_check and a Cypher draft for `question` as typed, for when clarify
+    turns out to return it unchanged. Returns (check, cypher); cypher is None
+    when the check failed or the analytics or semantic index can answer without one.
+    """
+    metrics.track_llm_calls(calls)
+    # Interactive calls from other requests go first
+    set_priority(PRIORITY_SPECULATIVE)
+    with metrics.span('speculation'):
+        check = await asyncio.to_thread(demo_check, question)
+        if 'cleaned_question' not in check:
+            return check, None
+        if analytics_route(analytics_store.current(), check['cleaned_question'], check.get('persons')):
+            return check, None
+        if semantic_parse(check['cleaned_question'], check.get('persons')) and semantic_store.current():
+            return check, None
+        return check, await prompt_to_cypher(user_input=check['cleaned_question'])
+
+async def settle_speculation(task, calls, clar, user_input):
+    """
+    (check, cypher) from the speculative `task` if clarify kept the question
+    as typed, else None after cancelling it (and any completion it alone was
+    waiting on) and counting the LLM calls it wasted.
+    """
+    if task is None:
+        return None
+    keep = ('error' not in clar and clar['termination_status'] is True
+            and normalize_question(clar['reframed_question']) == normalize_question(user_input))
+    if keep:
+        try:
+            result = await task
+            metrics.registry.inc('speculation_total', outcome='hit')
+            return result
+        except Exception as e:
+            logger.warning("Speculative run failed, redoing it: %s", e)
+            keep = False
+    # 'cancelled' means it was still running, possibly with a completion in flight
+    outcome = 'miss' if task.done() else 'cancelled'
+    task.cancel()
+    try:
+        await task
+    except BaseException:
+        pass
+    metrics.registry.inc('speculation_total', outcome=outcome)
+    if calls[0]:
+        metrics.registry.inc('speculation_wasted_llm_calls_total', calls[0])
+    return None
+
+async def answer_question(user_input, conversation, emit):
+    async def emit_rows(batch):
+        await emit('rows', {'rows': batch})
 
     logger.info("User Query: %s", user_input)
 
     # --- Email‐only response branch ---------------------------
     # If the user just typed an email address, assume they're
     # picking from the earlier "multiple matches" list.
-    if EMAIL_RX.match(user_input) and history:
-        # find the last non-email user question in history
-        original_q = None
-        for msg in reversed(history):
-            if msg['role']=='user' and not EMAIL_RX.match(msg['content']):
-                original_q = msg['content']
-                break
+    if EMAIL_RX.match(user_input) and conversation.messages:
+        # the last non-email user question, tracked by the conversation
+        original_q = conversation.last_question
 
         if original_q:
             # replace the first capitalized token (the name) with the email
@@ -538,86 +734,353 @@ def chat():
                 fixed_q = original_q.replace(name_m.group(0), user_input)
             else:
                 fixed_q = original_q
+            fast = await fast_answer(fixed_q, {}, emit)
+            if fast is not None:
+                fast['termination_status'] = True
+                return fast, 200
             # now jump straight to Cypher
-            cypher = prompt_to_cypher(user_input=fixed_q)
+            with metrics.span('prompt_to_cypher'):
+                cypher = await prompt_to_cypher(user_input=fixed_q)
+            if cypher:
+                await emit('cypher', {'cypher_query': cypher})
             if not cypher:
-                return jsonify({'error': "Failed to generate Cypher"}), 500
+                return {'error': "Failed to generate Cypher"}, 500
             if cypher.startswith("Please clarify."):
-                return jsonify({'natural_response': cypher,
-                                'termination_status': False
-                                }), 200
-
-            results = error_handling_query(cypher)
+                return {'natural_response': cypher,
+                        'termination_status': False
+                        }, 200
+
+            with metrics.span('error_handling_query'):
+                results = await error_handling_query(cypher, on_rows=emit_rows)
+            if results is None:
+                translation_cache.invalidate(fixed_q)
+            elif results:
+                cypher = results.cypher
             if not results:
-                return jsonify({
+                return {
                     'cypher_query': cypher,
                     'results': [],
                     'natural_response': "No matching data found."
-                }), 200
+                }, 200
 
-            natural = format_result_naturally(original_q, cypher, results)
-            return jsonify({
+            with metrics.span('format_result_naturally'):
+                natural = await format_result_naturally(original_q, cypher, summarize_rows(results, results.has_more), emit=emit)
+            return with_cursor({
                 'cypher_query': cypher,
                 'results': results,
                 'natural_response': natural,
                 'termination_status': True
-            }), 200
+            }, cypher, results, original_q), 200
 
-    # 1) Clarify via LLM
+    # 1) Clarify via LLM, with a bounded window of the conversation
     msg_list = [{'role': 'developer', 'content': REFRAME_QUESTION_PROMPT}]
-    msg_list.extend([
-        m for m in history
-        if isinstance(m.get("content"), str) and m["content"].strip()
-    ])
+    summary = conversation.summary()
+    if summary:
+        msg_list.append({'role': 'developer', 'content': summary})
+    msg_list.extend(conversation.messages)
     if not any(m["content"] == user_input for m in msg_list if m["role"] == "user"):
         msg_list.append({'role': 'user', 'content': user_input})
 
-    clar = clarify_user_question(msg_list)
+    speculation, calls = None, [0]
+    if SPECULATIVE_CHAT:
+        speculation = asyncio.create_task(speculate(user_input, calls))
+    try:
+        with metrics.span('clarify'):
+            clar = await clarify_user_question(msg_list)
+    except BaseException:
+        if speculation is not None:
+            speculation.cancel()
+        raise
+    speculated = await settle_speculation(speculation, calls, clar, user_input)
 
     if 'error' in clar:
-        return jsonify({'error': clar['error']}), 500
+        return {'error': clar['error']}, 500
+    await emit('reframed', {
+        'reframed_question': clar['reframed_question'],
+        'termination_status': clar['termination_status']
+    })
 
     if clar['termination_status'] == False:        
-        return jsonify({
+        return {
             'reframed_question': clar['reframed_question'],
             'explanation':      clar['explanation'],
             'confirmation_message': clar['confirmation_message'],
             'termination_status': False
-        }), 200
+        }, 200
 
     # 2) Disambiguate PERSON entities
-    check = demo_check(clar['reframed_question'])
+    if speculated is not None:
+        check, cypher = speculated
+    else:
+        cypher = None
+        with metrics.span('demo_check'):
+            check = await asyncio.to_thread(demo_check, clar['reframed_question'])
+    return await answer_checked(user_input, check, emit, cypher)
+
+async def answer_checked(user_input, check, emit, cypher=None):
+    """
+    The rest of answer_question once demo_check has run (`check`): the
+    analytics, semantic search, or Cypher generation, execution and
+    formatting. `cypher` is a draft already generated for the question.
+    """
+    async def emit_rows(batch):
+        await emit('rows', {'rows': batch})
+
     if 'error' in check:
-        return jsonify({'error': check['error']}), 400
+        return {'error': check['error']}, 400
     if 'ambiguous_names' in check:
-        return jsonify({
+        return {
             'clarify_person': True,
             'message':       "Multiple persons matched; please choose one.",
             'ambiguous_names': check['ambiguous_names'],
             'termination_status': False
-        }), 200
-    # 3) Generate Cypher
-    cypher = prompt_to_cypher(user_input=check['cleaned_question'])
+        }, 200
+    # Aggregate counts come straight from the analytics, no Cypher or Neo4j needed
+    fast = await fast_answer(check['cleaned_question'], check.get('persons'), emit)
+    if fast is not None:
+        return fast, 200
+    # Questions about what emails say are searched by meaning rather than translated to CONTAINS
+    semantic = await semantic_answer(check['cleaned_question'], check.get('persons'), emit)
+    if semantic is not None:
+        return semantic, 200
+    # 3) Generate Cypher, unless the speculative draft already did
+    if not cypher:
+        with metrics.span('prompt_to_cypher'):
+            cypher = await prompt_to_cypher(user_input=check['cleaned_question'])
+    if cypher:
+        await emit('cypher', {'cypher_query': cypher})
     if not cypher:
-        return jsonify({'error': "Failed to generate Cypher"}), 500
+        return {'error': "Failed to generate Cypher"}, 500
     if cypher.startswith("Please clarify."):
-        return jsonify({'natural_response': cypher}), 200
+        return {'natural_response': cypher}, 200
 
     # 4) Execute & 5) Format
-    results = error_handling_query(cypher)
+    with metrics.span('error_handling_query'):
+        results = await error_handling_query(cypher, on_rows=emit_rows)
+    if results is None:
+        # Query couldn't be run even after the fix attempt; don't replay it
+        translation_cache.invalidate(check['cleaned_question'])
+    elif results:
+        cypher = results.cypher
     if not results:
-        return jsonify({
+        return {
             'cypher_query': cypher,
             'results': [],
             'natural_response': "No matching data found."
-        }), 200
+        }, 200
 
-    natural = format_result_naturally(user_input, cypher, results)
-    return jsonify({
+    with metrics.span('format_result_naturally'):
+        natural = await format_result_naturally(user_input, cypher, summarize_rows(results, results.has_more), emit=emit)
+    return with_cursor({
         'cypher_query': cypher,
         'results': results,
         'natural_response': natural
-    }), 200
+    }, cypher, results, user_input), 200
+
+def with_cursor(body, cypher, page, question):
+    """Add `next_cursor` for fetching the next page from /chat/results."""
+    if page.has_more:
+        body['next_cursor'] = encode_cursor(cypher, page.next_skip, question)
+    return body
+
+async def handle_results(data):
+    """Next page of an earlier /chat answer, for the `next_cursor` it returned."""
+    decoded = decode_cursor(data.get('cursor'))
+    if decoded is None:
+        return {'error': "Invalid or expired cursor"}, 400
+    cypher, skip, question = decoded
+    with metrics.span('error_handling_query'):
+        page = await error_handling_query(cypher, skip=skip)
+    if page is None:
+        return {'error': "Query failed"}, 500
+    return with_cursor({'cypher_query': cypher, 'results': page, 'skip': skip}, cypher, page, question), 200
+
+# /chat/batch: questions answered in parallel, without a conversation
+BATCH_MAX_QUESTIONS = int(os.getenv("BATCH_MAX_QUESTIONS", "1000"))
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_CLARIFY_MODES = ("skip", "auto")
+
+def batch_request(data):
+    """
+    (questions, clarify, concurrency) from a /chat/batch body, where
+    questions is [(id, text)]. Raises ValueError if the body is malformed.
+    """
+    questions = data.get('questions')
+    if not isinstance(questions, list) or not questions:
+        raise ValueError("'questions' must be a non-empty list")
+    if len(questions) > BATCH_MAX_QUESTIONS:
+        raise ValueError(f"At most {BATCH_MAX_QUESTIONS} questions per batch")
+    out = []
+    for index, item in enumerate(questions):
+        question_id, text = index, item
+        if isinstance(item, dict):
+            question_id, text = item.get('id', index), item.get('question')
+        if not isinstance(text, str) or not text.strip():
+            raise ValueError(f"Question {index} is empty")
+        out.append((question_id, text.strip()))
+    clarify = data.get('clarify', 'skip')
+    if clarify not in BATCH_CLARIFY_MODES:
+        raise ValueError(f"'clarify' must be one of {', '.join(BATCH_CLARIFY_MODES)}")
+    concurrency = data.get('concurrency', BATCH_CONCURRENCY)
+    if not isinstance(concurrency, int) or concurrency < 1:
+        raise ValueError("'concurrency' must be a positive integer")
+    return out, clarify, min(concurrency, BATCH_CONCURRENCY)
+
+async def answer_batch_question(question, person_entities, clarify):
+    """
+    (body, status) for one batch question. With clarify='auto' the question
+    is reframed first and the reframing is taken as final, there being no
+    one to confirm it; `person_entities` then no longer apply.
+    """
+    async def emit(event, payload):
+        pass
+
+    # Interactive /chat requests get the LLM first
+    set_priority(PRIORITY_BATCH)
+    reframed = None
+    if clarify == 'auto':
+        with metrics.span('clarify'):
+            clar = await clarify_user_question([{'role': 'developer', 'content': REFRAME_QUESTION_PROMPT},
+                                                {'role': 'user', 'content': question}])
+        if 'error' in clar:
+            return {'error': clar['error']}, 500
+        reframed, person_entities = clar['reframed_question'], None
+    with metrics.span('demo_check'):
+        check = await asyncio.to_thread(demo_check, reframed or question, person_entities)
+    body, status = await answer_checked(reframed or question, check, emit)
+    if reframed is not None:
+        body['reframed_question'] = reframed
+    return body, status
+
+async def answer_batch(questions, clarify='skip', concurrency=BATCH_CONCURRENCY):
+    """
+    Answer `questions` [(id, text)] for /chat/batch and batch_questions.py.
+    Yields one dict per question as it finishes (so not in input order; see
+    `index`), with its /chat body, `status` and stage timings, then a final
+    {'summary': ...}.
+
+    NER runs once over all the questions. Up to `concurrency` questions are
+    in flight at a time; their LLM calls queue behind interactive ones and
+    under the client's rate limits, and their queries each take a session
+    from the driver's pool.
+    """
+    started = time.perf_counter()
+    entities = [None] * len(questions)
+    if clarify == 'skip':
+        with metrics.span('ner_batch'):
+            entities = await asyncio.to_thread(ner.persons_batch, [text for _, text in questions])
+    ner_ms = round((time.perf_counter() - started) * 1000, 2)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    lines = asyncio.Queue()
+    async def run(index, question_id, text, person_entities):
+        async with semaphore:
+            trace = metrics.start_trace()
+            try:
+                body, status = await answer_batch_question(text, person_entities, clarify)
+            except Exception as e:
+                logger.exception("Batch question %r failed", question_id)
+                body, status = {'error': str(e)}, 500
+            metrics.registry.inc('batch_questions_total', status=status)
+            await lines.put({'index': index, 'id': question_id, 'question': text, 'status': status,
+                             **body, 'timings': trace.to_dict()})
+
+    tasks = [asyncio.create_task(run(index, question_id, text, person_entities))
+             for index, ((question_id, text), person_entities) in enumerate(zip(questions, entities))]
+    statuses = {}
+    try:
+        for _ in tasks:
+            line = await lines.get()
+            statuses[line['status']] = statuses.get(line['status'], 0) + 1
+            yield line
+    finally:
+        # Client went away: don't answer the rest for nobody
+        for task in tasks:
+            task.cancel()
+    yield {'summary': {'questions': len(questions), 'statuses': statuses, 'ner_ms': ner_ms,
+                       'total_ms': round((time.perf_counter() - started) * 1000, 2)}}
+
+async def json_lines(agen):
+    async for item in agen:
+        yield json.dumps(item, default=str) + "\n"
+
+def sse_event(event, payload):
+    return f"event: {event}\ndata: {json.dumps(payload, default=str)}\n\n"
+
+async def stream_chat(data):
+    """
+    Server-Sent Events version of /chat: yields one event per pipeline stage
+    as it completes, then a final 'result' event carrying the same body
+    /chat would have returned (plus its 'status').
+    """
+    events = asyncio.Queue()
+    async def emit(event, payload):
+        await events.put(sse_event(event, payload))
+    async def run():
+        try:
+            body, status = await handle_chat(data, emit)
+            await events.put(sse_event('result', {**body, 'status': status}))
+        except Exception as e:
+            logger.exception("Streaming chat failed")
+            await events.put(sse_event('error', {'error': str(e)}))
+        finally:
+            await events.put(None)
+    task = asyncio.create_task(run())
+    try:
+        while True:
+            chunk = await events.get()
+            if chunk is None:
+                return
+            yield chunk
+    finally:
+        # Client went away: stop the pipeline instead of finishing it for nobody
+        task.cancel()
+
+def iterate_sync(agen):
+    """Drive an async generator on the shared loop from a WSGI thread."""
+    try:
+        while True:
+            try:
+                yield run_sync(agen.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        run_sync(agen.aclose())
+
+SSE_HEADERS = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+METRICS_CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+BATCH_CONTENT_TYPE = 'application/x-ndjson'
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    data = request.get_json() or {}
+    body, status = run_sync(handle_chat(data))
+    return jsonify(body), status
+
+@app.route('/chat/stream', methods=['POST'])
+def chat_stream():
+    data = request.get_json() or {}
+    return Response(iterate_sync(stream_chat(data)), mimetype='text/event-stream', headers=SSE_HEADERS)
+
+@app.route('/chat/results', methods=['POST'])
+def chat_results():
+    data = request.get_json() or {}
+    body, status = run_sync(handle_results(data))
+    return jsonify(body), status
+
+@app.route('/chat/batch', methods=['POST'])
+def chat_batch():
+    data = request.get_json() or {}
+    try:
+        questions, clarify, concurrency = batch_request(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return Response(iterate_sync(json_lines(answer_batch(questions, clarify, concurrency))),
+                    mimetype=BATCH_CONTENT_TYPE)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
 
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file
@@ -0,0 +1,198 @@
+import os
+import re
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# memory | sqlite | redis
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "memory")
+SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "sessions.db")
+SESSION_REDIS_URL = os.getenv("SESSION_REDIS_URL", "redis://localhost:6379/0")
+SESSION_TTL = float(os.getenv("SESSION_TTL", str(12 * 3600)))
+SESSION_MAX = int(os.getenv("SESSION_MAX", "10000"))
+# Messages kept verbatim for the clarification prompt; older ones are folded into a summary
+SESSION_CONTEXT_MESSAGES = int(os.getenv("SESSION_CONTEXT_MESSAGES", "8"))
+
+CONVERSATION_ID_RX = re.compile(r"^[\w-]{1,64}$")
+EMAIL_MENTION_RX = re.compile(r"[\w.+'-]+@[\w-]+(?:\.[\w-]+)+")
+MAX_SUMMARY_EMAILS = 20
+MAX_SUMMARY_QUESTIONS = 3
+MAX_SUMMARY_QUESTION_CHARS = 200
+
+
+class Conversation:
+    """
+    Server-side state for one chat: the last few messages verbatim plus a
+    compact summary (addresses already identified, earlier questions) of
+    everything older, so the clarification prompt stays the same size
+    however long the conversation gets.
+    """
+
+    def __init__(self, conversation_id, messages=None, emails=None,
+                 earlier_questions=None, last_question=None, updated_at=None):
+        self.id = conversation_id
+        self.messages = messages or []
+        self.emails = emails or []
+        self.earlier_questions = earlier_questions or []
+        self.last_question = last_question
+        self.updated_at = updated_at or time.time()
+
+    def append(self, role, content, question=False, window=SESSION_CONTEXT_MESSAGES):
+        """Add a message; `question` marks a user message as the latest question asked."""
+        if not isinstance(content, str) or not content.strip():
+            return
+        self.messages.append({"role": role, "content": content})
+        if question:
+            self.last_question = content
+        while len(self.messages) > window:
+            self._fold(self.messages.pop(0))
+        self.updated_at = time.time()
+
+    def _fold(self, message):
+        for email in EMAIL_MENTION_RX.findall(message["content"]):
+            email = email.lower()
+            if email not in self.emails:
+                self.emails.append(email)
+        del self.emails[:-MAX_SUMMARY_EMAILS]
+        if message["role"] == "user":
+            self.earlier_questions.append(message["content"][:MAX_SUMMARY_QUESTION_CHARS])
+            del self.earlier_questions[:-MAX_SUMMARY_QUESTIONS]
+
+    def summary(self):
+        lines = []
+        if self.emails:
+            lines.append("Email addresses already identified in this conversation: " + ", ".join(self.emails))
+        if self.earlier_questions:
+            lines.append("Earlier questions: " + " | ".join(self.earlier_questions))
+        if not lines:
+            return ""
+        return "Summary of the earlier conversation:\n" + "\n".join(lines)
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "messages": self.messages,
+            "emails": self.emails,
+            "earlier_questions": self.earlier_questions,
+            "last_question": self.last_question,
+            "updated_at": self.updated_at,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["id"], data.get("messages"), data.get("emails"),
+                   data.get("earlier_questions"), data.get("last_question"), data.get("updated_at"))
+
+
+class MemorySessionStore:
+    """LRU + TTL store held in process memory."""
+
+    def __init__(self, max_sessions=SESSION_MAX, ttl=SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, conversation_id):
+        with self._lock:
+            data = self._sessions.get(conversation_id)
+            if data is None:
+                return None
+            if time.time() - data["updated_at"] > self.ttl:
+                del self._sessions[conversation_id]
+                return None
+            self._sessions.move_to_end(conversation_id)
+            return Conversation.from_dict(json.loads(json.dumps(data)))
+
+    def save(self, conversation):
+        with self._lock:
+            self._sessions[conversation.id] = conversation.to_dict()
+            self._sessions.move_to_end(conversation.id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+
+class SQLiteSessionStore:
+    """Sessions in a local SQLite file, so they survive restarts; expired rows are purged on write."""
+
+    PURGE_EVERY = 100
+
+    def __init__(self, path=SESSION_SQLITE_PATH, ttl=SESSION_TTL):
+        self.ttl = ttl
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS sessions "
+            "(id TEXT PRIMARY KEY, data TEXT NOT NULL, updated_at REAL NOT NULL)"
+        )
+        self._db.commit()
+        self._writes = 0
+        self._lock = threading.Lock()
+
+    def get(self, conversation_id):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT data FROM sessions WHERE id = ? AND updated_at > ?",
+                (conversation_id, time.time() - self.ttl),
+            ).fetchone()
+        return Conversation.from_dict(json.loads(row[0])) if row else None
+
+    def save(self, conversation):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO sessions (id, data, updated_at) VALUES (?, ?, ?)",
+                (conversation.id, json.dumps(conversation.to_dict()), conversation.updated_at),
+            )
+            self._writes += 1
+            if self._writes % self.PURGE_EVERY == 0:
+                self._db.execute("DELETE FROM sessions WHERE updated_at <= ?", (time.time() - self.ttl,))
+            self._db.commit()
+
+
+class RedisSessionStore:
+    """Sessions in Redis (or anything speaking its protocol), expired by key TTL."""
+
+    def __init__(self, url=SESSION_REDIS_URL, ttl=SESSION_TTL):
+        import redis
+        self.ttl = int(ttl)
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, conversation_id):
+        raw = self._redis.get(f"chat:session:{conversation_id}")
+        return Conversation.from_dict(json.loads(raw)) if raw else None
+
+    def save(self, conversation):
+        self._redis.set(f"chat:session:{conversation.id}", json.dumps(conversation.to_dict()), ex=self.ttl)
+
+
+def create_session_store(backend=SESSION_BACKEND):
+    if backend == "sqlite":
+        return SQLiteSessionStore()
+    if backend == "redis":
+        return RedisSessionStore()
+    return MemorySessionStore()
+
+
+def open_conversation(store, conversation_id=None, history=None, is_question=lambda text: True):
+    """
+    Load the conversation for `conversation_id`, or start a new one. Clients
+    that still send the full `history` seed a new conversation with it.
+    """
+    if conversation_id and CONVERSATION_ID_RX.match(str(conversation_id)):
+        conversation = store.get(conversation_id)
+        if conversation is not None:
+            return conversation
+    else:
+        conversation_id = uuid.uuid4().hex
+    conversation = Conversation(conversation_id)
+    for message in history or []:
+        if isinstance(message, dict) and message.get("role") in ("user", "assistant"):
+            content = message.get("content")
+            question = message["role"] == "user" and isinstance(content, str) and is_question(content)
+            conversation.append(message["role"], content, question=question)
+    return conversation
@@ -0,0 +1,180 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+TRANSLATION_CACHE_SIZE = int(os.getenv("TRANSLATION_CACHE_SIZE", "1024"))
+TRANSLATION_CACHE_TTL = float(os.getenv("TRANSLATION_CACHE_TTL", str(24 * 3600)))
+TRANSLATION_CACHE_PATH = os.getenv("TRANSLATION_CACHE_PATH", "")
+
+EMAIL_LITERAL_RX = re.compile(r"[\w.+'-]+@[\w-]+(?:\.[\w-]+)+")
+DATE_LITERAL_RX = re.compile(r"\b\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2})?)?\b")
+PUNCT_RX = re.compile(r"[^\w\s]")
+SPACE_RX = re.compile(r"\s+")
+
+
+def normalize_question(question):
+    """
+    Reduce a question to a cache key plus the literals abstracted out of it.
+
+    Emails and ISO dates become numbered slots (__email0__, __date0__, ...),
+    then case, punctuation and whitespace are folded, so
+    "How many responsive emails did jeff.dasovich@enron.com send?" and
+    "how many responsive emails did kay.mann@enron.com send" share a key.
+    """
+    params = {}
+    counters = {"email": 0, "date": 0, "datetime": 0}
+
+    def slot(kind, value):
+        name = f"{kind}{counters[kind]}"
+        counters[kind] += 1
+        params[name] = value
+        return f" __{name}__ "
+
+    text = EMAIL_LITERAL_RX.sub(lambda m: slot("email", m.group(0).rstrip(".").lower()), question)
+    # Dates and datetimes get separate slots: a template built for one can
+    # have a time suffix appended that would be wrong for the other
+    text = DATE_LITERAL_RX.sub(
+        lambda m: slot("datetime" if len(m.group(0)) > 10 else "date", m.group(0).replace(" ", "T")),
+        text,
+    )
+    text = PUNCT_RX.sub(" ", text.lower())
+    key = SPACE_RX.sub(" ", text).strip()
+    return key, params
+
+
+def to_template(cypher, params):
+    """
+    Replace the question's literals in a generated query with <<slot>> markers.
+    Returns None when a literal can't be located, since replaying such a
+    query with different values would silently keep the old literal.
+    """
+    template = cypher
+    # Longest values first so a date doesn't clobber part of a datetime
+    for name, value in sorted(params.items(), key=lambda kv: -len(kv[1])):
+        pattern = re.compile(re.escape(value), re.IGNORECASE)
+        if not pattern.search(template):
+            return None
+        template = pattern.sub(f"<<{name}>>", template)
+    return template
+
+
+def fill_template(template, params):
+    query = template
+    for name, value in params.items():
+        query = query.replace(f"<<{name}>>", value)
+    if "<<" in query:
+        return None
+    return query
+
+
+class TranslationCache:
+    """
+    LRU/TTL cache of natural-language -> Cypher templates, keyed on
+    normalize_question(), with an optional SQLite file so entries survive
+    a restart.
+    """
+
+    def __init__(self, max_entries=TRANSLATION_CACHE_SIZE, ttl=TRANSLATION_CACHE_TTL, path=TRANSLATION_CACHE_PATH):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (template, created_at)
+        self._lock = threading.Lock()
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS translations "
+                "(key TEXT PRIMARY KEY, template TEXT NOT NULL, created_at REAL NOT NULL)"
+            )
+            self._db.commit()
+
+    def _expired(self, created_at):
+        return self.ttl > 0 and time.time() - created_at > self.ttl
+
+    def _load(self, key):
+        if self._db is None:
+            return None
+        row = self._db.execute(
+            "SELECT template, created_at FROM translations WHERE key = ?", (key,)
+        ).fetchone()
+        return row
+
+    def lookup(self, question):
+        """Return a ready-to-run query for the question, or None on a miss."""
+        key, params = normalize_question(question)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._load(key)
+                if entry is not None:
+                    self._remember(key, entry)
+            if entry is not None and self._expired(entry[1]):
+                self._remove(key)
+                entry = None
+            query = fill_template(entry[0], params) if entry is not None else None
+            if query is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        logger.info("Translation cache hit for key: %s", key)
+        return query
+
+    def store(self, question, cypher):
+        key, params = normalize_question(question)
+        template = to_template(cypher, params)
+        if template is None:
+            return False
+        entry = (template, time.time())
+        with self._lock:
+            self._remember(key, entry)
+            if self._db is not None:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO translations (key, template, created_at) VALUES (?, ?, ?)",
+                    (key, template, entry[1]),
+                )
+                self._db.commit()
+        return True
+
+    def _remember(self, key, entry):
+        """Keep `entry` in memory as the most recent, evicting the least recently used past max_entries."""
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, question):
+        key, _ = normalize_question(question)
+        with self._lock:
+            self._remove(key)
+
+    def _remove(self, key):
+        self._entries.pop(key, None)
+        if self._db is not None:
+            self._db.execute("DELETE FROM translations WHERE key = ?", (key,))
+            self._db.commit()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM translations")
+                self._db.commit()
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
@@ -3,6 +3,8 @@ import "./App.css";
 import axios from "axios";
 
 const BACKEND_URL = import.meta.env.VITE_BACKEND_URL;
+// Stream answers over /chat/stream (SSE) unless explicitly disabled
+const USE_STREAMING = import.meta.env.VITE_USE_STREAMING !== "false";
 
 interface Message {
   role: "user" | "assistant";
@@ -13,8 +15,75 @@ interface ChatSession {
   id: number;
   title: string;
   messages: Message[];
+  // Key of the server-side conversation state; history isn't resent
+  conversationId: string;
 }
 
+const newConversationId = () =>
+  typeof crypto !== "undefined" && crypto.randomUUID
+    ? crypto.randomUUID()
+    : `${Date.now()}-${Math.random().toString(36).slice(2)}`;
+
+// Turn a /chat response body into the assistant message text
+const buildBotContent = (data: any): string => {
+  let content = "No response generated.";
+  if (data.error) {
+    content = data.error;
+  } else if (data.clarify_person) {
+    const optionsList = data.ambiguous_names
+      .map((item: any) => `${item.name}: ${item.options.join(", ")}`)
+      .join("\n");
+    content = `${data.message}\n${optionsList}`;
+  } else if (data.reframed_question && data.termination_status === false) {
+    content = `${data.reframed_question}\n${data.confirmation_message}`;
+  } else if (data.results && data.results[0] && data.results[0]["analysis"]) {
+    for (const record in data.results) {
+      if (data.results[record]["analysis"]) {
+        content = data.results[record]["analysis"] + data.natural_response;
+      }
+    }
+  } else if (data.natural_response) {
+    content = data.natural_response;
+  }
+  return content;
+};
+
+// POST to /chat/stream and call onEvent for every server-sent event
+const streamChat = async (
+  body: object,
+  onEvent: (event: string, data: any) => void
+) => {
+  const response = await fetch(`${BACKEND_URL}/chat/stream`, {
+    method: "POST",
+    headers: { "Content-Type": "application/json" },
+    body: JSON.stringify(body),
+  });
+  if (!response.ok || !response.body) {
+    throw new Error(`Stream request failed: ${response.status}`);
+  }
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  while (true) {
+    const { done, value } = await reader.read();
+    if (done) break;
+    buffer += decoder.decode(value, { stream: true });
+    // Events are separated by a blank line
+    let sep: number;
+    while ((sep = buffer.indexOf("\n\n")) !== -1) {
+      const block = buffer.slice(0, sep);
+      buffer = buffer.slice(sep + 2);
+      let event = "message";
+      let data = "";
+      for (const line of block.split("\n")) {
+        if (line.startsWith("event:")) event = line.slice(6).trim();
+        else if (line.startsWith("data:")) data += line.slice(5).trim();
+      }
+      if (data) onEvent(event, JSON.parse(data));
+    }
+  }
+};
+
 const App: React.FC = () => {
   const [chats, setChats] = useState<ChatSession[]>([]);
   const [activeChatId, setActiveChatId] = useState<number | null>(null);
@@ -28,94 +97,104 @@ const App: React.FC = () => {
       id: Date.now(),
       title: `Chat ${chats.length + 1}`,
       messages: [],
+      conversationId: newConversationId(),
     };
     setChats((prev) => [...prev, newChat]);
     setActiveChatId(newChat.id);
     setInput("");        
   };
 
+  const appendMessage = (chatId: number, msg: Message) => {
+    setChats((prev) =>
+      prev.map((chat) =>
+        chat.id === chatId
+          ? { ...chat, messages: [...chat.messages, msg] }
+          : chat
+      )
+    );
+  };
+
+  // Replace the content of the last message in a chat (the streaming reply)
+  const updateLastMessage = (chatId: number, content: string) => {
+    setChats((prev) =>
+      prev.map((chat) =>
+        chat.id === chatId
+          ? {
+              ...chat,
+              messages: chat.messages.map((m, i) =>
+                i === chat.messages.length - 1 ? { ...m, content } : m
+              ),
+            }
+          : chat
+      )
+    );
+  };
+
   const sendMessage = async () => {
     if (!input.trim() || activeChatId === null) return;
 
+    const chatId = activeChatId;
     // Build the new user message
     const userMsg: Message = { role: "user", content: input };
+    const request = {
+      user_input: input,
+      conversation_id: chats.find((c) => c.id === chatId)?.conversationId,
+    };
 
     // 1) Optimistically add user message to state
-    setChats((prev) =>
-      prev.map((chat) =>
-        chat.id === activeChatId
-          ? { ...chat, messages: [...chat.messages, userMsg] }
-          : chat
-      )
-    );
+    appendMessage(chatId, userMsg);
+    setInput("");
 
     try {
-      const { data } = await axios.post(`${BACKEND_URL}/chat`, {
-        user_input: input,
-        history: chats.find((c) => c.id === activeChatId)?.messages,
-      });
-      let botMsg: Message = {
-        role: "assistant",
-        content: "No response generated.",
-      };
-      
-      console.log(data);
-      if (data.clarify_person) {
-        const optionsList = data.ambiguous_names
-          .map((item: any) => `${item.name}: ${item.options.join(", ")}`)
-          .join("\n");
-        botMsg = {
-          role: "assistant",
-          content: `${data.message}\n${optionsList}`,
-        };
-      } else if (data.reframed_question && data.termination_status === false) {
-        botMsg = {
-          role: "assistant",
-          content: `${data.reframed_question}\n${data.confirmation_message}`,
-        };
-      } else {
-        if (data.results && data.results[0] && data.results[0]["analysis"]) {
-          for (const record in data.results) {
-            if (data.results[record]["analysis"]) {
-              botMsg = {
-                role: "assistant",
-                content: data.results[record]["analysis"] + data.natural_response,
-              };
+      if (USE_STREAMING) {
+        // 2) Placeholder reply, filled in as stage events arrive
+        appendMessage(chatId, { role: "assistant", content: "Thinking..." });
+        let progress = "";
+        let answer = "";
+        let rowCount = 0;
+        let finished = false;
+        await streamChat(request, (event, data) => {
+          if (event === "reframed" && data.termination_status !== false) {
+            progress = `Understood as: ${data.reframed_question}`;
+            updateLastMessage(chatId, `${progress}\nGenerating query...`);
+          } else if (event === "cypher") {
+            progress = `${progress}\nRunning query...`.trim();
+            updateLastMessage(chatId, progress);
+          } else if (event === "rows") {
+            rowCount += data.rows.length;
+            updateLastMessage(chatId, `${progress}\n${rowCount} result(s) received...`);
+          } else if (event === "token") {
+            answer += data.text;
+            updateLastMessage(chatId, answer);
+          } else if (event === "result") {
+            finished = true;
+            updateLastMessage(chatId, buildBotContent(data));
+          } else if (event === "error") {
+            finished = true;
+            updateLastMessage(chatId, "Error fetching response.");
           }
-        } 
-      }else if (data.natural_response) {
-        botMsg = {
-          role: "assistant",
-          content: data.natural_response,
-        };
-      }
+        });
+        if (!finished) {
+          updateLastMessage(chatId, answer || "Error fetching response.");
+        }
+      } else {
+        const { data } = await axios.post(`${BACKEND_URL}/chat`, request);
+        console.log(data);
+        // 3) Append bot response
+        appendMessage(chatId, { role: "assistant", content: buildBotContent(data) });
       }
-      
-
-      // 3) Append bot response
-      setChats((prev) =>
-        prev.map((chat) =>
-          chat.id === activeChatId
-            ? { ...chat, messages: [...chat.messages, botMsg] }
-            : chat
-        )
-      );
     } catch (err) {
       console.error(err);
       const errorMsg: Message = {
         role: "assistant",
         content: "Error fetching response.",
       };
-      setChats((prev) =>
-        prev.map((chat) =>
-          chat.id === activeChatId
-            ? { ...chat, messages: [...chat.messages, errorMsg] }
-            : chat
-        )
-      );
+      if (USE_STREAMING) {
+        updateLastMessage(chatId, errorMsg.content);
+      } else {
+        appendMessage(chatId, errorMsg);
+      }
     }
-
-    setInput("");
   };
 
   /** Sidebar Resize Handlers **/